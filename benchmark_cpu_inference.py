@@ -0,0 +1,129 @@
+"""Measures detector throughput on CPU (or GPU with --cuda) at TEST.SCALES=(600,).
+
+Runs the full inference path of extract_features.py on every image: backbone, RPN, ROI pooling and head,
+then box decoding and class-aware NMS. The images are read from --image_dir or, without it, generated at
+--image_size (CLEVR images are 480x320), and every --threads setting is timed separately. Without a
+checkpoint the network is randomly initialized, which does not change the amount of computation.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import argparse
+import time
+import numpy as np
+import cv2
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg, cfg_from_file, cfg_from_list
+from model.utils.blob import prep_im_for_blob, im_list_to_blob
+from model.utils.device import inference_device, configure_threads, check_device_support, place_model
+from model.utils.postprocess import decode_boxes, detect
+from model.faster_rcnn.vgg16 import vgg16
+from model.faster_rcnn.resnet import resnet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark detector inference throughput')
+    parser.add_argument('--net', default='res101', help='vgg16, res50, res101, res152')
+    parser.add_argument('--cfg', dest='cfg_file', default='cfgs/res101.yml')
+    parser.add_argument('--checkpoint', default=None, help='faster_rcnn_*.pth, random weights without it')
+    parser.add_argument('--num_classes', default=97, type=int, help='only used without a checkpoint')
+    parser.add_argument('--image_dir', default=None, help='time these images instead of synthetic ones')
+    parser.add_argument('--image_size', default='480x320', help='WxH of the synthetic images')
+    parser.add_argument('--num_images', default=20, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--threads', default='1,4,8', help='comma separated intra-op thread counts to time')
+    parser.add_argument('--interop_threads', default=0, type=int)
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def load_images(args):
+    if args.image_dir is not None:
+        names = sorted(os.listdir(args.image_dir))[:args.num_images]
+        return [cv2.imread(os.path.join(args.image_dir, name)) for name in names]
+    width, height = [int(x) for x in args.image_size.split('x')]
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, (height, width, 3)).astype(np.uint8) for _ in range(args.num_images)]
+
+
+def build_model(args, device):
+    num_classes = args.num_classes
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location=(lambda storage, loc: storage))
+        num_classes = checkpoint['model']['RCNN_cls_score.weight'].size(0)
+    classes = ['__background__'] + ['class{}'.format(i) for i in range(1, num_classes)]
+    if args.net == 'vgg16':
+        fasterRCNN = vgg16(classes, pretrained=False)
+    else:
+        fasterRCNN = resnet(classes, int(args.net[3:]), pretrained=False)
+    fasterRCNN.create_architecture()
+    if checkpoint is not None:
+        fasterRCNN.load_state_dict(checkpoint['model'])
+        if 'pooling_mode' in checkpoint.keys():
+            cfg.POOLING_MODE = checkpoint['pooling_mode']
+    fasterRCNN = place_model(fasterRCNN, device)
+    check_device_support(device)
+    fasterRCNN.eval()
+    return fasterRCNN, num_classes
+
+
+def run_image(fasterRCNN, holders, im, num_classes, device):
+    """Returns the (preprocess, network, postprocess) time of one image in seconds."""
+    im_data, im_info, gt_boxes, num_boxes = holders
+    tic = time.time()
+    blob, scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE)
+    blob = im_list_to_blob([blob])
+    im_data_pt = torch.from_numpy(blob).permute(0, 3, 1, 2)
+    im_data.data.resize_(im_data_pt.size()).copy_(im_data_pt)
+    im_info.data.resize_(1, 3).copy_(torch.FloatTensor([[blob.shape[1], blob.shape[2], scale]]))
+    gt_boxes.data.resize_(1, 1, 5).zero_()
+    num_boxes.data.resize_(1).zero_()
+    preprocessed = time.time()
+
+    rois, cls_prob, bbox_pred = fasterRCNN(im_data, im_info, gt_boxes, num_boxes)[:3]
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    forwarded = time.time()
+
+    pred_boxes = decode_boxes(rois.data, bbox_pred.data, im_info.data, [scale], num_classes)
+    detect(cls_prob.data[0], pred_boxes[0])
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return preprocessed - tic, forwarded - preprocessed, time.time() - forwarded
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    cfg.TEST.SCALES = (600,)
+
+    device = inference_device(args.cuda)
+    fasterRCNN, num_classes = build_model(args, device)
+    images = load_images(args)
+    holders = [Variable(tensor.to(device), volatile=True) for tensor in
+               (torch.FloatTensor(1), torch.FloatTensor(1), torch.FloatTensor(1), torch.LongTensor(1))]
+    print('{} on {}, {} images of {}x{}, TEST.SCALES={}, POOLING_MODE={}'.format(
+        args.net, device, len(images), images[0].shape[1], images[0].shape[0], cfg.TEST.SCALES, cfg.POOLING_MODE))
+
+    # the inter-op pool can only be sized before it is first used
+    configure_threads(0, args.interop_threads)
+    for threads in [int(t) for t in args.threads.split(',')]:
+        intra_op, inter_op = configure_threads(threads)
+        for im in images[:args.warmup]:
+            run_image(fasterRCNN, holders, im, num_classes, device)
+        times = np.array([run_image(fasterRCNN, holders, im, num_classes, device) for im in images])
+        total = times.sum(axis=1)
+        print('{:2d} intra-op / {} inter-op threads: {:.2f} images/s, {:.0f} ms/image '
+              '(preprocess {:.0f} ms, network {:.0f} ms, postprocess {:.0f} ms, p95 {:.0f} ms)'.format(
+                  intra_op, inter_op, len(images) / total.sum(), 1000 * total.mean(),
+                  *(1000 * times.mean(axis=0)).tolist() + [1000 * np.percentile(total, 95)]))
@@ -0,0 +1,95 @@
+"""Times decoding and resizing per image decoder backend (cfg.IMAGE_DECODER, see lib/model/utils/image_io.py).
+
+Example, JPEGs of COCO/VG and the PNGs of CLEVR:
+    python benchmark_decoders.py --image_dirs data/coco/images/val2014 data/vg/VG_100K ${ROOT}/CLEVR/images/val
+
+Every image is read and resized to --target_size like the test-time preprocessing, once per backend. Besides
+the time, the mean absolute difference of the resized pixels to those of the scipy backend is reported,
+which is non-zero when a backend decodes at a reduced size. The same is reported for a copy of the first
+image of every directory tagged with a rotating EXIF orientation: every backend has to ignore the tag and
+decode the stored pixels like scipy, otherwise the image no longer matches its boxes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+import cv2
+from PIL import Image
+
+from model.utils.image_io import DECODERS, read_image, resize_scale
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the image decoder backends')
+    parser.add_argument('--image_dirs', nargs='+', required=True)
+    parser.add_argument('--num_images', default=100, type=int, help='images per directory')
+    parser.add_argument('--backends', default=','.join(DECODERS))
+    parser.add_argument('--target_size', default=600, type=int)
+    parser.add_argument('--max_size', default=1000, type=int)
+    return parser.parse_args()
+
+
+EXIF_ORIENTATION = 0x0112
+
+
+def exif_rotated_copy(path, out_dir):
+    """Writes path as a JPEG tagged with EXIF orientation 6 (rotate 90 degrees clockwise for display)."""
+    out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '_exif6.jpg')
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    Image.open(path).convert('RGB').save(out_path, 'JPEG', quality=95, exif=exif.tobytes())
+    return out_path
+
+
+def decode_and_resize(path, backend, target_size, max_size):
+    """Returns the resized image and the decode and resize times."""
+    tic = time.time()
+    im, _ = read_image(path, target_size, max_size, backend=backend)
+    decoded = time.time()
+    im_scale = resize_scale(im.shape[0], im.shape[1], target_size, max_size)
+    im = cv2.resize(np.ascontiguousarray(im), None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
+    return im, decoded - tic, time.time() - decoded
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    backends = args.backends.split(',')
+    exif_dir = tempfile.mkdtemp(prefix='exif_')
+    print('{:<32} {:<6} {:>10} {:>10} {:>10} {:>9} {:>9}'.format('images', 'backend', 'decode ms', 'resize ms',
+                                                                'total ms', 'pixel MAE', 'EXIF MAE'))
+    for image_dir in args.image_dirs:
+        names = sorted(os.listdir(image_dir))[:args.num_images]
+        paths = [os.path.join(image_dir, name) for name in names]
+        exif_path = exif_rotated_copy(paths[0], exif_dir)
+        reference = {}
+        for backend in backends:
+            times, errors = [], []
+            for path in paths:
+                im, decode_time, resize_time = decode_and_resize(path, backend, args.target_size, args.max_size)
+                times.append((decode_time, resize_time))
+                if backend == 'scipy':
+                    reference[path] = im
+                elif path in reference and reference[path].shape == im.shape:
+                    errors.append(np.abs(reference[path].astype(np.float32) - im).mean())
+            im = decode_and_resize(exif_path, backend, args.target_size, args.max_size)[0]
+            if backend == 'scipy':
+                reference[exif_path] = im
+                exif_error = '-'
+            elif exif_path not in reference:
+                exif_error = '-'
+            elif reference[exif_path].shape != im.shape:
+                exif_error = 'rotated'
+            else:
+                exif_error = '{:.2f}'.format(np.abs(reference[exif_path].astype(np.float32) - im).mean())
+            decode_ms, resize_ms = (1000 * np.mean(times, axis=0)).tolist()
+            print('{:<32} {:<6} {:>10.1f} {:>10.1f} {:>10.1f} {:>9} {:>9}'.format(
+                os.path.basename(os.path.normpath(image_dir))[:32], backend, decode_ms, resize_ms,
+                decode_ms + resize_ms, '{:.2f}'.format(np.mean(errors)) if errors else '-', exif_error))
+    shutil.rmtree(exif_dir)
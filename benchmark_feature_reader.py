@@ -0,0 +1,80 @@
+"""Measures random-access batch reads from a features file, FeatureStore against plain h5py.
+
+The plain h5py baseline is what the VQA data loaders do today: translate every id through the JSON ids
+map and read each image with its own h5py call.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import json
+import time
+import numpy as np
+import h5py
+
+from feature_store.reader import FeatureStore, default_ids_map_filename
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark random-access reads of extracted features')
+    parser.add_argument('--h5', required=True, help='features file, e.g. ${ROOT}/CLEVR/faster-rcnn/val.hdf5')
+    parser.add_argument('--ids_map', default=None, help='defaults to {split}_ids_map.json next to the features')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_batches', default=200, type=int)
+    parser.add_argument('--cache_mb', default=256, type=int, help='chunk cache size of FeatureStore')
+    return parser.parse_args()
+
+
+def random_batches(image_ids, args):
+    rng = np.random.RandomState(0)
+    return [[image_ids[i] for i in rng.randint(0, len(image_ids), args.batch_size)]
+            for _ in range(args.num_batches)]
+
+
+def read_h5py(h5_filename, image_id_to_ix, batches):
+    with h5py.File(h5_filename, 'r') as f:
+        image_features, spatial_features = f['image_features'], f['spatial_features']
+        for batch in batches:
+            rows = [image_id_to_ix[str(image_id)] for image_id in batch]
+            np.stack([image_features[row] for row in rows])
+            np.stack([spatial_features[row] for row in rows])
+
+
+def read_store(store, batches):
+    for batch in batches:
+        store.get(batch)
+
+
+def report(name, elapsed, args):
+    num_images = args.batch_size * args.num_batches
+    print('{:>12}: {:.2f}s, {:.1f} batches/sec, {:.1f} images/sec'.format(
+        name, elapsed, args.num_batches / elapsed, num_images / elapsed))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    ids_map_filename = args.ids_map or default_ids_map_filename(args.h5)
+    with open(ids_map_filename) as f:
+        image_id_to_ix = json.load(f)['image_id_to_ix']
+    with h5py.File(args.h5, 'r') as f:
+        dataset = f['image_features']
+        print('{} images, image_features {} {}, chunks {}, compression {}'.format(
+            len(image_id_to_ix), dataset.shape, dataset.dtype, dataset.chunks, dataset.compression))
+
+    store = FeatureStore(args.h5, ids_map_filename, cache_bytes=args.cache_mb * 2 ** 20)
+    batches = random_batches(store.index.ids.tolist(), args)
+
+    tic = time.time()
+    read_h5py(args.h5, image_id_to_ix, batches)
+    report('h5py', time.time() - tic, args)
+
+    # first pass opens the file and fills the chunk cache, second pass is warm
+    for name in ('store (cold)', 'store (warm)'):
+        tic = time.time()
+        read_store(store, batches)
+        report(name, time.time() - tic, args)
+    if store.cache.hits + store.cache.misses > 0:
+        print('chunk cache: {} hits, {} misses'.format(store.cache.hits, store.cache.misses))
+    store.close()
@@ -0,0 +1,101 @@
+"""Compares HDF5 layouts of the extracted features: file size, write throughput and random-read throughput.
+
+Every layout (storage type x compression x chunk size) is written with the buffered slab writer used by
+extract_features.py, then read back one randomly chosen image at a time, the access pattern of a
+training data loader. Features are taken from an existing extraction (--from_file) when available,
+otherwise synthetic ReLU-like features with a similar fraction of zeros are used.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import argparse
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from feature_store.h5_writer import BufferedRowWriter, create_feature_dataset
+
+num_fixed_boxes = 15
+feature_length = 2048
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark HDF5 feature layouts')
+    parser.add_argument('--from_file', default=None,
+                        help='existing features file whose image_features/spatial_features are used as input')
+    parser.add_argument('--num_images', default=2000, type=int)
+    parser.add_argument('--num_reads', default=2000, type=int, help='number of random single-image reads')
+    parser.add_argument('--write_buffer', default=32, type=int)
+    parser.add_argument('--dtypes', default='float32,float16')
+    parser.add_argument('--compressions', default='none,lzf,gzip')
+    parser.add_argument('--chunk_rows', default='0,1,8,32',
+                        help='images per chunk, 0 is the contiguous layout (only used without compression)')
+    parser.add_argument('--tmp_dir', default=None)
+    return parser.parse_args()
+
+
+def load_features(args):
+    if args.from_file is not None:
+        with h5py.File(args.from_file, 'r') as f:
+            num_images = min(args.num_images, f['image_features'].shape[0])
+            return f['image_features'][:num_images], f['spatial_features'][:num_images]
+    rng = np.random.RandomState(0)
+    feats = np.maximum(rng.randn(args.num_images, num_fixed_boxes, feature_length), 0).astype(np.float32)
+    spatial = rng.rand(args.num_images, num_fixed_boxes, 6).astype(np.float32)
+    return feats, spatial
+
+
+def benchmark_layout(filename, feats, spatial, dtype, compression, chunk_rows, args):
+    num_images = feats.shape[0]
+    tic = time.time()
+    with h5py.File(filename, 'w') as f:
+        datasets = [create_feature_dataset(f, 'image_features', feats.shape, dtype=dtype, compression=compression,
+                                           chunk_rows=chunk_rows),
+                    create_feature_dataset(f, 'spatial_features', spatial.shape, dtype=dtype,
+                                           compression=compression, chunk_rows=chunk_rows)]
+        writer = BufferedRowWriter(datasets, buffer_rows=args.write_buffer)
+        for row in range(num_images):
+            writer.write(row, feats[row], spatial[row])
+        writer.flush()
+    write_time = time.time() - tic
+    size = os.path.getsize(filename)
+
+    rows = np.random.RandomState(1).randint(0, num_images, args.num_reads)
+    tic = time.time()
+    with h5py.File(filename, 'r') as f:
+        image_features, spatial_features = f['image_features'], f['spatial_features']
+        for row in rows:
+            image_features[row]
+            spatial_features[row]
+    read_time = time.time() - tic
+    return size, num_images / write_time, args.num_reads / read_time
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    feats, spatial = load_features(args)
+    print('{} images, {:.1f} MB of float32 features'.format(feats.shape[0], (feats.nbytes + spatial.nbytes) / 2 ** 20))
+
+    layouts = []
+    for dtype in args.dtypes.split(','):
+        for compression in args.compressions.split(','):
+            for chunk_rows in [int(c) for c in args.chunk_rows.split(',')]:
+                if compression != 'none' and chunk_rows == 0:
+                    continue
+                layouts.append((dtype, compression, chunk_rows))
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    print('{:>8} {:>6} {:>6} {:>10} {:>14} {:>14}'.format('dtype', 'comp', 'chunk', 'size (MB)', 'write (img/s)',
+                                                         'read (img/s)'))
+    for dtype, compression, chunk_rows in layouts:
+        filename = os.path.join(tmp_dir, 'features_{}_{}_{}.hdf5'.format(dtype, compression, chunk_rows))
+        size, write_speed, read_speed = benchmark_layout(filename, feats, spatial, dtype, compression, chunk_rows,
+                                                         args)
+        os.remove(filename)
+        print('{:>8} {:>6} {:>6} {:>10.1f} {:>14.1f} {:>14.1f}'.format(
+            dtype, compression, chunk_rows if chunk_rows > 0 else '-', size / 2 ** 20, write_speed, read_speed))
+    os.rmdir(tmp_dir)
@@ -0,0 +1,144 @@
+"""Times detection post-processing on a synthetic 300 ROI x 96 class workload.
+
+Compares the per-class loop that test_net.py used to run (one sort and one NMS call per class followed
+by an np.hstack/np.sort max-per-image cut) with model.utils.postprocess, and checks that both keep the
+same detections. The same is done for the per-ROI confidences behind extract_features.py --adaptive_boxes:
+the per-class loop of generate_tsv.py, a single class aware NMS call over every ROI/class pair, and one
+over the pairs scoring above --conf_thresh. Finally the per-class loop and postprocess.detect are compared
+once more with the --vg_classes classes of Visual Genome on --vg_image_size px images, where the class
+offsets of the single NMS call are largest.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.utils.config import cfg
+from model.nms.nms_wrapper import nms
+from model.utils.postprocess import decode_boxes, detect, dets_per_class, best_class_boxes, nms_max_confidence, \
+    per_class_nms_max_confidence
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark detection post-processing')
+    parser.add_argument('--num_rois', default=300, type=int)
+    parser.add_argument('--num_classes', default=96, type=int)
+    parser.add_argument('--iters', default=50, type=int)
+    parser.add_argument('--thresh', default=0.0, type=float)
+    parser.add_argument('--max_per_image', default=100, type=int)
+    parser.add_argument('--conf_thresh', default=0.2, type=float,
+                        help='confidence of the boxes kept by extract_features.py --adaptive_boxes')
+    parser.add_argument('--vg_classes', default=1601, type=int, help='classes (with background) of the VG check')
+    parser.add_argument('--vg_image_size', default=1000, type=int)
+    parser.add_argument('--vg_thresh', default=0.01, type=float, help='score threshold of the VG check')
+    parser.add_argument('--cuda', action='store_true')
+    return parser.parse_args()
+
+
+def synthetic_outputs(args, num_classes, image_size=500):
+    """Network outputs for an image of image_size x 1.33 image_size px, resized by 1.6."""
+    rng = np.random.RandomState(0)
+    xy = rng.uniform(0, 0.8 * image_size, (1, args.num_rois, 2))
+    wh = rng.uniform(10, 0.4 * image_size, (1, args.num_rois, 2))
+    rois = np.concatenate((np.zeros((1, args.num_rois, 1)), xy, xy + wh), axis=2) * 1.6
+    logits = rng.randn(args.num_rois, num_classes) * 3
+    scores = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    bbox_pred = rng.randn(1, args.num_rois, 4 * num_classes) * 0.1
+    im_info = np.array([[1.6 * image_size, 1.6 * image_size * 4 / 3, 1.6]])
+    tensors = [torch.from_numpy(a.astype(np.float32)) for a in (rois, scores, bbox_pred, im_info)]
+    if args.cuda:
+        tensors = [t.cuda() for t in tensors]
+    return tensors
+
+
+def legacy_postprocess(scores, pred_boxes, args, thresh):
+    """The per-class loop previously copied into test_net.py, demo.py and the extractors."""
+    num_classes = scores.size(1)
+    all_boxes = [None] * num_classes
+    for j in range(1, num_classes):
+        inds = torch.nonzero(scores[:, j] > thresh).view(-1)
+        if inds.numel() > 0:
+            cls_scores = scores[:, j][inds]
+            _, order = torch.sort(cls_scores, 0, True)
+            cls_boxes = pred_boxes[inds][:, j * 4:(j + 1) * 4]
+            cls_dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)[order]
+            keep = nms(cls_dets, cfg.TEST.NMS, force_cpu=not args.cuda)
+            all_boxes[j] = cls_dets[keep.view(-1).long()].cpu().numpy()
+        else:
+            all_boxes[j] = np.zeros((0, 5), dtype=np.float32)
+    image_scores = np.hstack([all_boxes[j][:, -1] for j in range(1, num_classes)])
+    if len(image_scores) > args.max_per_image:
+        image_thresh = np.sort(image_scores)[-args.max_per_image]
+        for j in range(1, num_classes):
+            all_boxes[j] = all_boxes[j][all_boxes[j][:, -1] >= image_thresh]
+    return all_boxes
+
+
+def legacy_best_class_boxes(scores, pred_boxes):
+    _, class_ixs = torch.max(scores, 1)
+    pred_boxes = pred_boxes.view(pred_boxes.shape[0], -1, 4)
+    return np.array([box[class_ixs[ix]].cpu().numpy().tolist() for ix, box in enumerate(pred_boxes)])
+
+
+def timeit(fn, args):
+    fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+    tic = time.time()
+    for _ in range(args.iters):
+        result = fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+    return result, (time.time() - tic) / args.iters * 1000
+
+
+def same_detections(legacy, shared):
+    return all(len(legacy[j]) == len(shared[j]) and np.allclose(np.sort(legacy[j][:, -1]), np.sort(shared[j][:, -1]))
+               for j in range(1, len(legacy)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg.USE_GPU_NMS = args.cuda
+    rois, scores, bbox_pred, im_info = synthetic_outputs(args, args.num_classes)
+    pred_boxes = decode_boxes(rois, bbox_pred, im_info, [1.6], args.num_classes).squeeze(0)
+    print('{} ROIs x {} classes, {} iterations'.format(args.num_rois, args.num_classes, args.iters))
+
+    legacy, legacy_ms = timeit(lambda: legacy_postprocess(scores, pred_boxes, args, args.thresh), args)
+    shared, shared_ms = timeit(lambda: dets_per_class(*detect(scores, pred_boxes, args.thresh, args.max_per_image),
+                                                      num_classes=args.num_classes), args)
+    print('per-class loop: {:.2f} ms/image, postprocess.detect: {:.2f} ms/image ({:.1f}x)'.format(
+        legacy_ms, shared_ms, legacy_ms / shared_ms))
+    num_legacy = sum(len(dets) for dets in legacy[1:])
+    num_shared = sum(len(dets) for dets in shared[1:])
+    print('detections kept: {} vs {}, same per-class scores: {}'.format(num_legacy, num_shared,
+                                                                         same_detections(legacy, shared)))
+
+    boxes = best_class_boxes(scores, pred_boxes)[0]
+    thresh = float(np.nextafter(np.float32(args.conf_thresh), np.float32(0)))
+    per_class, per_class_ms = timeit(lambda: per_class_nms_max_confidence(scores, boxes), args)
+    _, all_pairs_ms = timeit(lambda: nms_max_confidence(scores, boxes), args)
+    above, above_ms = timeit(lambda: nms_max_confidence(scores, boxes, thresh=thresh), args)
+    same = np.array_equal(np.flatnonzero(per_class >= args.conf_thresh), np.flatnonzero(above >= args.conf_thresh))
+    print('adaptive box confidences: per-class loop {:.2f} ms/image, all pairs {:.2f} ms/image, above '
+          '{} {:.2f} ms/image, same boxes kept: {}'.format(per_class_ms, all_pairs_ms, args.conf_thresh,
+                                                          above_ms, same))
+
+    legacy_boxes, legacy_ms = timeit(lambda: legacy_best_class_boxes(scores, pred_boxes), args)
+    shared_boxes, shared_ms = timeit(lambda: best_class_boxes(scores, pred_boxes)[0].cpu().numpy(), args)
+    print('best-class boxes: loop {:.2f} ms/image, gather {:.2f} ms/image, identical: {}'.format(
+        legacy_ms, shared_ms, np.array_equal(legacy_boxes.astype(np.float32), shared_boxes)))
+
+    rois, scores, bbox_pred, im_info = synthetic_outputs(args, args.vg_classes, args.vg_image_size)
+    pred_boxes = decode_boxes(rois, bbox_pred, im_info, [1.6], args.vg_classes).squeeze(0)
+    legacy = legacy_postprocess(scores, pred_boxes, args, args.vg_thresh)
+    shared = dets_per_class(*detect(scores, pred_boxes, args.vg_thresh, args.max_per_image),
+                            num_classes=args.vg_classes)
+    print('{} classes on {} px images: detections kept: {} vs {}, same per-class scores: {}'.format(
+        args.vg_classes, args.vg_image_size, sum(len(dets) for dets in legacy[1:]),
+        sum(len(dets) for dets in shared[1:]), same_detections(legacy, shared)))
@@ -0,0 +1,152 @@
+"""Compares float16/bfloat16 inference (lib/model/utils/precision.py) with float32 on the same images.
+
+Parity: the pooled features written by extract_features.py are compared on the float32 proposals (mean
+cosine similarity and largest relative difference), and the detections of both runs are matched per class
+(share of float32 detections above --score_thresh found again with IoU >= --iou_thresh). Cost: images/s,
+weight memory and, on CUDA, the peak memory allocated on top of the weights while running an image.
+Without a checkpoint the network is randomly initialized, which only makes the timings meaningful.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg, cfg_from_file, cfg_from_list
+from model.utils.device import inference_device
+from model.utils.postprocess import decode_boxes, detect
+from model.utils.precision import PRECISIONS, PRECISION_STAGES, set_inference_precision, parameter_bytes
+from benchmark_cpu_inference import load_images, build_model
+from export_detector import to_holders
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare reduced precision inference with float32')
+    parser.add_argument('--net', default='res101', help='vgg16, res50, res101, res152')
+    parser.add_argument('--cfg', dest='cfg_file', default='cfgs/res101.yml')
+    parser.add_argument('--checkpoint', default=None, help='faster_rcnn_*.pth, random weights without it')
+    parser.add_argument('--num_classes', default=97, type=int, help='only used without a checkpoint')
+    parser.add_argument('--image_dir', default=None, help='compare on these images instead of synthetic ones')
+    parser.add_argument('--image_size', default='480x320', help='WxH of the synthetic images')
+    parser.add_argument('--num_images', default=20, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--precision', default='bfloat16', choices=PRECISIONS[1:])
+    parser.add_argument('--precision_stages', default='base,head',
+                        help='comma separated stages, of ' + ','.join(sorted(PRECISION_STAGES)))
+    parser.add_argument('--score_thresh', default=0.5, type=float, help='float32 detections that are matched')
+    parser.add_argument('--iou_thresh', default=0.9, type=float)
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def run_detector(model, holders, num_classes):
+    """Returns rois, pooled features and (dets, class_ixs) of the image in the holders."""
+    im_data, im_info, gt_boxes, num_boxes = holders
+    outputs = model(im_data, im_info, gt_boxes, num_boxes, return_feats=True)
+    rois, cls_prob, bbox_pred, pooled_feat = outputs[0], outputs[1], outputs[2], outputs[8]
+    pred_boxes = decode_boxes(rois.data, bbox_pred.data, im_info.data, [im_info.data[0][2]], num_classes)
+    return rois.data, pooled_feat.data, detect(cls_prob.data[0], pred_boxes[0])
+
+
+def box_iou(a, b):
+    """IoU of every box of a (N x 4) with every box of b (M x 4), in pixel coordinates."""
+    widths = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]) + 1
+    heights = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]) + 1
+    inter = np.maximum(widths, 0) * np.maximum(heights, 0)
+    area_a = (a[:, 2] - a[:, 0] + 1) * (a[:, 3] - a[:, 1] + 1)
+    area_b = (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def matched_detections(reference, candidate, score_thresh, iou_thresh):
+    """(matched, total) float32 detections scoring above score_thresh with a same-class candidate box."""
+    ref_dets, ref_classes = [x.cpu().numpy() for x in reference]
+    cand_dets, cand_classes = [x.cpu().numpy() for x in candidate]
+    keep = ref_dets[:, 4] > score_thresh if len(ref_dets) else np.zeros(0, dtype=bool)
+    ref_dets, ref_classes = ref_dets[keep], ref_classes[keep]
+    if len(ref_dets) == 0 or len(cand_dets) == 0:
+        return 0, len(ref_dets)
+    ious = box_iou(ref_dets[:, :4], cand_dets[:, :4])
+    ious[ref_classes[:, None] != cand_classes[None, :]] = 0
+    return int((ious.max(axis=1) >= iou_thresh).sum()), len(ref_dets)
+
+
+def feature_parity(reference, candidate):
+    """Mean cosine similarity and largest difference relative to the largest float32 value."""
+    cosine = (reference * candidate).sum(1) / (reference.norm(2, 1) * candidate.norm(2, 1)).clamp(min=1e-12)
+    return float(cosine.mean()), float((reference - candidate).abs().max() / reference.abs().max())
+
+
+def time_model(model, holders, images, num_classes, device, warmup):
+    """Returns images/s and the peak CUDA activation memory in MB (None on the CPU)."""
+    for im in images[:warmup]:
+        to_holders(im, holders)
+        run_detector(model, holders, num_classes)
+    reset_peak = getattr(torch.cuda, 'reset_peak_memory_stats',
+                         getattr(torch.cuda, 'reset_max_memory_allocated', None))
+    if device.type == 'cuda' and reset_peak is not None:
+        torch.cuda.synchronize()
+        reset_peak()
+    # both models are resident, only count what running one of them allocates
+    allocated = torch.cuda.memory_allocated() if device.type == 'cuda' else 0
+    tic = time.time()
+    for im in images:
+        to_holders(im, holders)
+        run_detector(model, holders, num_classes)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.time() - tic
+    peak_mb = (torch.cuda.max_memory_allocated() - allocated) / 2 ** 20 if device.type == 'cuda' else None
+    return len(images) / elapsed, peak_mb
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    cfg.TEST.SCALES = (600,)
+
+    device = inference_device(args.cuda)
+    fasterRCNN, num_classes = build_model(args, device)
+    reduced = set_inference_precision(copy.deepcopy(fasterRCNN), args.precision, device,
+                                      args.precision_stages.split(','))
+    images = load_images(args)
+    holders = [Variable(tensor.to(device), volatile=True) for tensor in
+               (torch.FloatTensor(1), torch.FloatTensor(1), torch.FloatTensor(1), torch.LongTensor(1))]
+    print('{} on {}: {} ({}) against float32, {} images'.format(
+        args.net, device, args.precision, args.precision_stages, len(images)))
+
+    cosines, rel_diffs, matched, total = [], [], 0, 0
+    with torch.no_grad():
+        for im in images:
+            to_holders(im, holders)
+            rois, pooled_feat, dets = run_detector(fasterRCNN, holders, num_classes)
+            _, _, reduced_dets = run_detector(reduced, holders, num_classes)
+            # pooled features of the same proposals, the proposals themselves may differ slightly
+            reduced_pooled_feat = reduced(*holders, return_feats=True, oracle_rois=rois.cpu().numpy())[8].data
+            cosine, rel_diff = feature_parity(pooled_feat, reduced_pooled_feat)
+            cosines.append(cosine)
+            rel_diffs.append(rel_diff)
+            image_matched, image_total = matched_detections(dets, reduced_dets, args.score_thresh, args.iou_thresh)
+            matched += image_matched
+            total += image_total
+    print('pooled features: mean cosine similarity {:.5f}, max relative difference {:.2e}'.format(
+        np.mean(cosines), max(rel_diffs)))
+    print('detections: {}/{} float32 detections with score > {} matched at IoU >= {} ({:.1%})'.format(
+        matched, total, args.score_thresh, args.iou_thresh, matched / max(total, 1)))
+
+    with torch.no_grad():
+        for name, model in (('float32', fasterRCNN), (args.precision, reduced)):
+            images_per_sec, peak_mb = time_model(model, holders, images, num_classes, device, args.warmup)
+            print('{:<9} {:.2f} images/s, weights {:.1f} MB{}'.format(
+                name, images_per_sec, parameter_bytes(model) / 2 ** 20,
+                '' if peak_mb is None else ', peak activations {:.0f} MB'.format(peak_mb)))
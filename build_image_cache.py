@@ -0,0 +1,68 @@
+"""Decodes and resizes the training images once, for trainval_net.py --image_cache.
+
+Example:
+    python build_image_cache.py --imdb clevr_train --out data/cache/clevr_train_images
+    python trainval_net.py --dataset clevr --net res101 --image_cache data/cache/clevr_train_images
+
+Every image of the roidb is stored at every scale of cfg.TRAIN.SCALES (see
+lib/roi_data_layer/image_cache.py). --measure N times get_minibatch() on N images with and without the
+cache and extrapolates the decode+resize time to an epoch.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+
+from roi_data_layer.roidb import combined_roidb
+from roi_data_layer.minibatch import get_minibatch
+from roi_data_layer.image_cache import build_image_cache
+from model.utils.config import cfg, cfg_from_file, cfg_from_list
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cache the pre-resized training images')
+    parser.add_argument('--imdb', dest='imdb_name', required=True, help='e.g. clevr_train or voc_2007_trainval')
+    parser.add_argument('--cfg', dest='cfg_file', default='cfgs/res101.yml')
+    parser.add_argument('--out', required=True, help='cache directory')
+    parser.add_argument('--nw', dest='num_workers', default=8, type=int, help='decoding threads')
+    parser.add_argument('--shard_gb', default=1., type=float, help='size of a shard file')
+    parser.add_argument('--measure', default=200, type=int,
+                        help='images timed with and without the cache afterwards, 0 to skip')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def time_minibatches(roidb, num_classes, ixs):
+    tic = time.time()
+    for ix in ixs:
+        get_minibatch([roidb[ix]], num_classes)
+    return (time.time() - tic) / len(ixs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    cfg.TRAIN.USE_FLIPPED = False
+
+    imdb, roidb, _, _ = combined_roidb(args.imdb_name)
+    tic = time.time()
+    num_images = build_image_cache(roidb, args.out, cfg.TRAIN.SCALES, shard_bytes=int(args.shard_gb * 2 ** 30),
+                                   num_workers=args.num_workers)
+    print('Cached {} images at scales {} in {:.1f}s'.format(num_images, tuple(cfg.TRAIN.SCALES), time.time() - tic))
+
+    if args.measure > 0:
+        ixs = np.linspace(0, len(roidb) - 1, min(args.measure, len(roidb))).astype(int).tolist()
+        cfg.TRAIN.IMAGE_CACHE = ''
+        decoded = time_minibatches(roidb, imdb.num_classes, ixs)
+        cfg.TRAIN.IMAGE_CACHE = args.out
+        cached = time_minibatches(roidb, imdb.num_classes, ixs)
+        print('get_minibatch: {:.1f} ms/image decoding, {:.1f} ms/image from the cache, '
+              '{:.0f}s vs {:.0f}s per epoch of {} images'.format(1000 * decoded, 1000 * cached, decoded * len(roidb),
+                                                                 cached * len(roidb), len(roidb)))
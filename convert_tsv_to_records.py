@@ -0,0 +1,32 @@
+"""Converts the base64 TSV files of generate_tsv.py into one binary region record file.
+
+The TSV rows are decoded once; afterwards readers use feature_store.region_records.RegionRecordReader,
+which seeks to an image through the offset index of the record file instead of parsing CSV.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import os
+import time
+
+from feature_store.region_records import convert_tsv, index_filename
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert generate_tsv.py output to region records')
+    parser.add_argument('tsv_files', nargs='+', help='tsv files, e.g. the per-gpu outputs test.tsv.0 test.tsv.1')
+    parser.add_argument('--out', required=True, help='record file to write, e.g. test.rec')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    tic = time.time()
+    count = convert_tsv(args.tsv_files, args.out)
+    tsv_bytes = sum(os.path.getsize(tsv_file) for tsv_file in args.tsv_files)
+    rec_bytes = os.path.getsize(args.out) + os.path.getsize(index_filename(args.out))
+    print('Converted {} images in {:.1f}s: {:.1f} MB of tsv -> {:.1f} MB of records'.format(
+        count, time.time() - tic, tsv_bytes / 2 ** 20, rec_bytes / 2 ** 20))
@@ -23,17 +23,17 @@ import torch.optim as optim
 
 import torchvision.transforms as transforms
 import torchvision.datasets as dset
-from scipy.misc import imread
 from roi_data_layer.roidb import combined_roidb
 from roi_data_layer.roibatchLoader import roibatchLoader
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
-from model.rpn.bbox_transform import clip_boxes
-from model.nms.nms_wrapper import nms
-from model.rpn.bbox_transform import bbox_transform_inv
 from model.utils.net_utils import save_net, load_net, vis_detections
+from model.utils.device import inference_device, check_device_support, place_model
+from model.utils.postprocess import decode_boxes, detect, dets_per_class
 from model.utils.blob import im_list_to_blob
+from model.utils.image_io import read_image
 from model.faster_rcnn.vgg16 import vgg16
 from model.faster_rcnn.resnet import resnet
+from model.faster_rcnn.export import ExportedDetector
 import pdb
 import json
 
@@ -64,6 +64,8 @@ def parse_args():
                         help='directory to load models',
                         default="/hdd/robik/FasterRCNN/models")
     parser.add_argument('--load_subdir', required=False, help="uses dataset.lower() if not provided")
+    parser.add_argument('--exported', default=None,
+                        help='TorchScript artifact written by export_detector.py, used instead of the checkpoint')
     parser.add_argument('--cuda', dest='cuda',
                         help='whether use CUDA',
                         action='store_true')
@@ -154,6 +156,7 @@ if __name__ == '__main__':
         cfg_from_list(args.set_cfgs)
 
     cfg.USE_GPU_NMS = args.cuda
+    device = inference_device(args.cuda)
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -162,47 +165,54 @@ if __name__ == '__main__':
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
 
-    input_dir = args.load_dir + "/" + args.net + "/"# + args.dataset.lower()
-    if args.load_subdir is None:
-        input_dir += args.dataset.lower()
+    if args.exported is not None:
+        # one TorchScript artifact replaces the model code and the checkpoint
+        fasterRCNN = ExportedDetector(args.exported, device)
+        classes = fasterRCNN.classes
+        load_name = args.exported
+        print('load exported model %s' % (args.exported))
     else:
-        input_dir += args.load_subdir
-
-    if not os.path.exists(input_dir):
-        raise Exception('There is no input directory for loading network from ' + input_dir)
-    load_name = os.path.join(input_dir,
-                             'faster_rcnn_{}_{}_{}.pth'.format(args.checksession, args.checkepoch, args.checkpoint))
-
-    with open('/hdd/robik/CLEVR/faster-rcnn/objects_count.json') as ovf:
-        classes = list(json.load(ovf).keys())
-        print("classes: {}".format(classes))
-
-
-    # initilize the network here.
-    if args.net == 'vgg16':
-        fasterRCNN = vgg16(classes, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res101':
-        fasterRCNN = resnet(classes, 101, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res50':
-        fasterRCNN = resnet(classes, 50, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res152':
-        fasterRCNN = resnet(classes, 152, pretrained=False, class_agnostic=args.class_agnostic)
-    else:
-        print("network is not defined")
-        pdb.set_trace()
+        input_dir = args.load_dir + "/" + args.net + "/"# + args.dataset.lower()
+        if args.load_subdir is None:
+            input_dir += args.dataset.lower()
+        else:
+            input_dir += args.load_subdir
+
+        if not os.path.exists(input_dir):
+            raise Exception('There is no input directory for loading network from ' + input_dir)
+        load_name = os.path.join(input_dir,
+                                 'faster_rcnn_{}_{}_{}.pth'.format(args.checksession, args.checkepoch, args.checkpoint))
+
+        with open('/hdd/robik/CLEVR/faster-rcnn/objects_count.json') as ovf:
+            classes = list(json.load(ovf).keys())
+            print("classes: {}".format(classes))
+
+
+        # initilize the network here.
+        if args.net == 'vgg16':
+            fasterRCNN = vgg16(classes, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res101':
+            fasterRCNN = resnet(classes, 101, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res50':
+            fasterRCNN = resnet(classes, 50, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res152':
+            fasterRCNN = resnet(classes, 152, pretrained=False, class_agnostic=args.class_agnostic)
+        else:
+            print("network is not defined")
+            pdb.set_trace()
 
-    fasterRCNN.create_architecture()
+        fasterRCNN.create_architecture()
 
-    print("load checkpoint %s" % (load_name))
-    if args.cuda > 0:
-        checkpoint = torch.load(load_name)
-    else:
-        checkpoint = torch.load(load_name, map_location=(lambda storage, loc: storage))
-    fasterRCNN.load_state_dict(checkpoint['model'])
-    if 'pooling_mode' in checkpoint.keys():
-        cfg.POOLING_MODE = checkpoint['pooling_mode']
+        print("load checkpoint %s" % (load_name))
+        if args.cuda > 0:
+            checkpoint = torch.load(load_name)
+        else:
+            checkpoint = torch.load(load_name, map_location=(lambda storage, loc: storage))
+        fasterRCNN.load_state_dict(checkpoint['model'])
+        if 'pooling_mode' in checkpoint.keys():
+            cfg.POOLING_MODE = checkpoint['pooling_mode']
 
-    print('load model successfully!')
+        print('load model successfully!')
 
     # pdb.set_trace()
 
@@ -214,12 +224,11 @@ if __name__ == '__main__':
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
 
-    # ship to cuda
-    if args.cuda > 0:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the inference device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data, volatile=True)
@@ -227,11 +236,8 @@ if __name__ == '__main__':
     num_boxes = Variable(num_boxes, volatile=True)
     gt_boxes = Variable(gt_boxes, volatile=True)
 
-    if args.cuda > 0:
-        cfg.CUDA = True
-
-    if args.cuda > 0:
-        fasterRCNN.cuda()
+    fasterRCNN = place_model(fasterRCNN, device)
+    check_device_support(device, 1)
 
     fasterRCNN.eval()
 
@@ -266,13 +272,12 @@ if __name__ == '__main__':
         # Load the demo image
         else:
             im_file = os.path.join(args.image_dir, imglist[num_images])
-            # im = cv2.imread(im_file)
-            im_in = np.array(imread(im_file, mode='RGB'))
+            # BGR, the detections are drawn on the decoded (possibly already shrunk) image
+            im_in, _ = read_image(im_file, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE)
         if len(im_in.shape) == 2:
             im_in = im_in[:, :, np.newaxis]
             im_in = np.concatenate((im_in, im_in, im_in), axis=2)
-        # rgb -> bgr
-        im = im_in[:, :, ::-1]
+        im = im_in
 
         blobs, im_scales = _get_image_blob(im)
         assert len(im_scales) == 1, "Only single-image batch implemented"
@@ -306,39 +311,8 @@ if __name__ == '__main__':
         # print("pooled_Feats: {}".format(pooled_feats))
 
         scores = cls_prob.data
-        boxes = rois.data[:, :, 1:5]
-
-        if cfg.TEST.BBOX_REG:
-            # Apply bounding-box regression deltas
-            box_deltas = bbox_pred.data
-            if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
-                # Optionally normalize targets by a precomputed mean and stdev
-                if args.class_agnostic:
-                    if args.cuda > 0:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    else:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS) \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
-
-                    box_deltas = box_deltas.view(1, -1, 4)
-                else:
-                    if args.cuda > 0:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    else:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS) \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
-                    box_deltas = box_deltas.view(1, -1, 4 * len(classes))
-
-            pred_boxes = bbox_transform_inv(boxes, box_deltas, 1)
-            pred_boxes = clip_boxes(pred_boxes, im_info.data, 1)
-        else:
-            # Simply repeat the boxes, once for each class
-            pred_boxes = np.tile(boxes, (1, scores.shape[1]))
-
-        pred_boxes /= im_scales[0]
-
+        pred_boxes = decode_boxes(rois.data, bbox_pred.data, im_info.data, im_scales, len(classes),
+                                  args.class_agnostic)
 
         scores = scores.squeeze()
         pred_boxes = pred_boxes.squeeze()
@@ -347,27 +321,11 @@ if __name__ == '__main__':
         misc_tic = time.time()
         if vis:
             im2show = np.copy(im)
-        for j in xrange(1, len(classes)):
-            inds = torch.nonzero(scores[:, j] > thresh).view(-1)
-            # if there is det
-            if inds.numel() > 0:
-                cls_scores = scores[:, j][inds]
-                _, order = torch.sort(cls_scores, 0, True)
-                if args.class_agnostic:
-                    cls_boxes = pred_boxes[inds, :]
-                else:
-                    cls_boxes = pred_boxes[inds][:, j * 4:(j + 1) * 4]
-
-                cls_dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)
-                # cls_dets = torch.cat((cls_boxes, cls_scores), 1)
-                cls_dets = cls_dets[order]
-                # keep = nms(cls_dets, cfg.TEST.NMS, force_cpu=not cfg.USE_GPU_NMS)
-                # cls_dets = cls_dets[keep.view(-1).long()]
-                # if not printed:
-                #     print("cls_dets: {}".format(cls_dets.shape))
-                #     print("cls_dets: {}".format(cls_dets))
-                if vis:
-                    im2show = vis_detections(im2show, classes[j], cls_dets.cpu().numpy(), 0.5)
+        dets, class_ixs = detect(scores, pred_boxes, thresh, max_per_image)
+        if vis:
+            for j, cls_dets in enumerate(dets_per_class(dets, class_ixs, len(classes))):
+                if len(cls_dets) > 0:
+                    im2show = vis_detections(im2show, classes[j], cls_dets, 0.5)
 
         misc_toc = time.time()
         nms_time = misc_toc - misc_tic
@@ -0,0 +1,132 @@
+"""Exports a trained detector as a TorchScript artifact and checks it against the eager model.
+
+The artifact (see lib/model/faster_rcnn/export.py) is loaded by demo.py and extract_features.py with
+--exported. Validation runs both models on --image_dir images (or synthetic images of several sizes, so
+that shapes baked into the trace would show up) and compares the proposals, class probabilities, box
+deltas and pooled features.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import sys
+import argparse
+import json
+import numpy as np
+import cv2
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg, cfg_from_file, cfg_from_list
+from model.utils.blob import prep_im_for_blob, im_list_to_blob
+from model.utils.device import inference_device, check_device_support, place_model
+from model.faster_rcnn.vgg16 import vgg16
+from model.faster_rcnn.resnet import resnet
+from model.faster_rcnn.export import export_detector, ExportedDetector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a Faster R-CNN checkpoint to TorchScript')
+    parser.add_argument('--net', default='res101', help='vgg16, res50, res101, res152')
+    parser.add_argument('--cfg', dest='cfg_file', default='cfgs/res101.yml')
+    parser.add_argument('--checkpoint', required=True, help='faster_rcnn_*.pth')
+    parser.add_argument('--classes', default=None,
+                        help='JSON file whose keys are the class names, e.g. objects_count.json')
+    parser.add_argument('--cag', dest='class_agnostic', action='store_true')
+    parser.add_argument('--out', required=True, help='artifact to write, e.g. faster_rcnn_res101.ptz')
+    parser.add_argument('--image_dir', default=None, help='validation images, synthetic ones without it')
+    parser.add_argument('--num_images', default=5, type=int)
+    parser.add_argument('--atol', default=1e-4, type=float, help='largest accepted absolute difference')
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def build_model(args, device):
+    checkpoint = torch.load(args.checkpoint, map_location=(lambda storage, loc: storage))
+    if args.classes is not None:
+        with open(args.classes) as f:
+            classes = list(json.load(f).keys())
+    else:
+        num_classes = checkpoint['model']['RCNN_cls_score.weight'].size(0)
+        classes = ['__background__'] + ['class{}'.format(i) for i in range(1, num_classes)]
+    if args.net == 'vgg16':
+        fasterRCNN = vgg16(classes, pretrained=False, class_agnostic=args.class_agnostic)
+    else:
+        fasterRCNN = resnet(classes, int(args.net[3:]), pretrained=False, class_agnostic=args.class_agnostic)
+    fasterRCNN.create_architecture()
+    fasterRCNN.load_state_dict(checkpoint['model'])
+    if 'pooling_mode' in checkpoint.keys():
+        cfg.POOLING_MODE = checkpoint['pooling_mode']
+    fasterRCNN = place_model(fasterRCNN, device)
+    check_device_support(device)
+    fasterRCNN.eval()
+    return fasterRCNN
+
+
+def validation_images(args):
+    if args.image_dir is not None:
+        names = sorted(os.listdir(args.image_dir))[:args.num_images]
+        return [cv2.imread(os.path.join(args.image_dir, name)) for name in names]
+    rng = np.random.RandomState(0)
+    sizes = [(320, 480), (480, 640), (600, 600), (375, 500), (427, 640)]
+    return [rng.randint(0, 256, sizes[i % len(sizes)] + (3,)).astype(np.uint8) for i in range(args.num_images)]
+
+
+def to_holders(im, holders):
+    im_data, im_info, gt_boxes, num_boxes = holders
+    blob, scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE)
+    blob = im_list_to_blob([blob])
+    im_data_pt = torch.from_numpy(blob).permute(0, 3, 1, 2)
+    im_data.data.resize_(im_data_pt.size()).copy_(im_data_pt)
+    im_info.data.resize_(1, 3).copy_(torch.FloatTensor([[blob.shape[1], blob.shape[2], scale]]))
+    gt_boxes.data.resize_(1, 1, 5).zero_()
+    num_boxes.data.resize_(1).zero_()
+
+
+def output_differences(eager, exported, holders):
+    """Max absolute difference of rois, cls_prob, bbox_pred and pooled_feat of both models."""
+    outputs = [model(*holders, return_feats=True) for model in (eager, exported)]
+    names = ('rois', 'cls_prob', 'bbox_pred', 'pooled_feat')
+    eager_outputs = [outputs[0][i] for i in (0, 1, 2, 8)]
+    exported_outputs = [outputs[1][i] for i in (0, 1, 2, 8)]
+    return dict((name, float((a.data - b.data).abs().max())) for name, a, b in
+                zip(names, eager_outputs, exported_outputs))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    device = inference_device(args.cuda)
+    fasterRCNN = build_model(args, device)
+    holders = [Variable(tensor.to(device), volatile=True) for tensor in
+               (torch.FloatTensor(1), torch.FloatTensor(1), torch.FloatTensor(1), torch.LongTensor(1))]
+    images = validation_images(args)
+
+    to_holders(images[0], holders)
+    meta = export_detector(fasterRCNN, holders[0], args.out)
+    print('Exported {} ({} classes, POOLING_MODE={}) to {}'.format(
+        args.net, len(meta['classes']), meta['pooling_mode'], args.out))
+
+    exported = ExportedDetector(args.out, device)
+    worst = {}
+    with torch.no_grad():
+        for ix, im in enumerate(images):
+            to_holders(im, holders)
+            diffs = output_differences(fasterRCNN, exported, holders)
+            print('image {} ({}x{}): {}'.format(ix, im.shape[1], im.shape[0], ', '.join(
+                '{} {:.2e}'.format(name, diff) for name, diff in sorted(diffs.items()))))
+            for name, diff in diffs.items():
+                worst[name] = max(worst.get(name, 0.), diff)
+
+    equivalent = all(diff <= args.atol for diff in worst.values())
+    print('max abs differences: {} -> {}'.format(
+        ', '.join('{} {:.2e}'.format(name, diff) for name, diff in sorted(worst.items())),
+        'equivalent' if equivalent else 'NOT equivalent (atol {})'.format(args.atol)))
+    sys.exit(0 if equivalent else 1)
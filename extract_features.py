@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import _init_paths
 import os
+import sys
 import numpy as np
 import argparse
 import pprint
@@ -19,19 +20,29 @@ from torch.autograd import Variable
 
 import torchvision.transforms as transforms
 import torchvision.datasets as dset
-from scipy.misc import imread
 from roi_data_layer.roidb import combined_roidb
 from roi_data_layer.roibatchLoader import roibatchLoader
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
-from model.rpn.bbox_transform import clip_boxes
-from model.nms.nms_wrapper import nms
-from model.rpn.bbox_transform import bbox_transform_inv
-from model.utils.blob import im_list_to_blob
+from model.utils.blob import im_list_to_blob, im_list_to_uint8_blob
+from model.utils.image_io import read_image
+from model.utils.postprocess import decode_boxes, best_class_boxes, nms_max_confidence, \
+    per_class_nms_max_confidence
+from model.utils.device import inference_device, configure_threads, check_device_support, place_model
+from model.utils.precision import PRECISIONS, PRECISION_STAGES, set_inference_precision
+from model.utils.pipeline import OrderedPrefetcher, AsyncWriter, pipeline_report
+from model.utils.telemetry import StageTimer, span
+from feature_store.journal import CompletionJournal, write_ids_map
+from feature_store.h5_writer import BufferedRowWriter, RaggedRowWriter, create_feature_dataset, \
+    create_ragged_dataset, create_ragged_index, DTYPES, COMPRESSIONS, RAGGED_OFFSETS, RAGGED_COUNTS
+from feature_store.shards import shard_name, shard_items
+from feature_store.base_feat_cache import BaseFeatCache, cache_namespace, file_hash
 from model.faster_rcnn.vgg16 import vgg16
 from model.faster_rcnn.resnet import resnet
+from model.faster_rcnn.export import ExportedDetector
 import pdb
 import json
 import h5py
+from collections import OrderedDict
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
@@ -99,6 +110,8 @@ def parse_args():
     parser.add_argument('--load_dir', dest='load_dir',
                         help='directory to load models',
                         default="/hdd/robik/FasterRCNN/models")
+    parser.add_argument('--exported', default=None,
+                        help='TorchScript artifact written by export_detector.py, used instead of the checkpoint')
     parser.add_argument('--cuda', dest='cuda',
                         help='whether use CUDA',
                         action='store_true')
@@ -120,9 +133,62 @@ def parse_args():
     parser.add_argument('--checkpoint', dest='checkpoint',
                         help='checkpoint to load network',
                         default=10021, type=int)
-    parser.add_argument('--bs', dest='batch_size',
-                        help='batch_size',
+    parser.add_argument('--bs', '--batch_size', dest='batch_size',
+                        help='number of same-sized images per forward pass',
                         default=1, type=int)
+    parser.add_argument('--compare_batch', default=None, type=int,
+                        help='extract this many images with batch size 1 and with --bs, check that the features '
+                             'are identical, report images/sec for both and exit')
+    parser.add_argument('--nw', dest='num_workers',
+                        help='number of threads decoding and resizing images, 0 decodes on the main thread',
+                        default=4, type=int)
+    parser.add_argument('--prefetch', default=32, type=int,
+                        help='maximum number of decoded images (and of results waiting to be written) in flight')
+    parser.add_argument('--resume', action='store_true',
+                        help='reopen an existing output file and skip the images recorded in its completion journal')
+    parser.add_argument('--commit_interval', default=100, type=int,
+                        help='flush the output file and commit the journal every this many images')
+    parser.add_argument('--ids_map_interval', default=0, type=int,
+                        help='also rewrite {split}_ids_map.json every this many images, 0 writes it only at the end')
+    parser.add_argument('--h5_dtype', default='float32', choices=sorted(DTYPES.keys()),
+                        help='storage type of the feature datasets')
+    parser.add_argument('--h5_compression', default='none', choices=COMPRESSIONS,
+                        help='compression filter of the feature datasets (implies a chunked layout)')
+    parser.add_argument('--h5_compression_level', default=4, type=int, help='gzip compression level')
+    parser.add_argument('--h5_chunk_rows', default=0, type=int,
+                        help='images per HDF5 chunk, 0 keeps a contiguous layout unless compression is enabled')
+    parser.add_argument('--write_buffer', default=32, type=int,
+                        help='number of images buffered by the writer before they are written as one slab')
+    parser.add_argument('--adaptive_boxes', action='store_true',
+                        help='keep between --min_boxes and --max_boxes boxes per image according to their '
+                             'confidence (all objects with --use_oracle_gt_boxes) and store them in the ragged '
+                             'layout, with image_offsets/image_num_boxes indexing flat feature datasets')
+    parser.add_argument('--min_boxes', default=1, type=int)
+    parser.add_argument('--max_boxes', default=num_fixed_boxes, type=int)
+    parser.add_argument('--conf_thresh', default=0.2, type=float,
+                        help='minimum class confidence (after per-class NMS) of the boxes kept by --adaptive_boxes')
+    parser.add_argument('--base_feat_cache', default=None,
+                        help='directory caching the backbone feature map of every image (as float16), so that '
+                             're-extraction with other ROIs, box counts or heads skips the backbone')
+    parser.add_argument('--base_feat_cache_gb', default=100., type=float,
+                        help='size cap of --base_feat_cache, least recently used feature maps are evicted')
+    parser.add_argument('--num_shards', default=1, type=int,
+                        help='split the image list into this many shards (see extract_features_sharded.py)')
+    parser.add_argument('--shard', default=0, type=int,
+                        help='extract only this shard, written to {split}.shard{K}-of-{N}.hdf5')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='number of CPU threads used by torch and OpenCV, 0 keeps their defaults')
+    parser.add_argument('--interop_threads', default=0, type=int,
+                        help='number of threads running independent torch ops in parallel, 0 keeps the default')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS,
+                        help='run --precision_stages in float16 (CUDA) or bfloat16; box decoding and NMS stay float32')
+    parser.add_argument('--precision_stages', default='base,head',
+                        help='comma separated stages run at --precision, of ' + ','.join(sorted(PRECISION_STAGES)))
+    parser.add_argument('--telemetry', default=None,
+                        help='time every stage and append p50/p95/p99 latencies as JSON lines to this file '
+                             '(- for stdout)')
+    parser.add_argument('--telemetry_interval', default=30., type=float,
+                        help='seconds between two --telemetry lines')
     parser.add_argument('--vis', dest='vis',
                         help='visualization mode',
                         action='store_true')
@@ -155,6 +221,8 @@ def parse_args():
             args.scenes = json.load(scenes_file)
     if args.load_subdir is None:
         args.load_subdir = args.dataset
+    # set up once the checkpoint is known
+    args.feat_cache = None
     return args
 
 
@@ -172,8 +240,12 @@ def _get_image_blob(im):
       im_scale_factors (list): list of image scales (relative to im) used
         in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
+    if cfg.INPUT_UINT8:
+        # the model subtracts the mean on the device
+        im_orig = im
+    else:
+        im_orig = im.astype(np.float32, copy=True)
+        im_orig -= cfg.PIXEL_MEANS
 
     im_shape = im_orig.shape
     im_size_min = np.min(im_shape[0:2])
@@ -187,13 +259,16 @@ def _get_image_blob(im):
         # Prevent the biggest axis from being more than MAX_SIZE
         if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
             im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-        im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
+        im = cv2.resize(np.ascontiguousarray(im_orig), None, None, fx=im_scale, fy=im_scale,
                         interpolation=cv2.INTER_LINEAR)
         im_scale_factors.append(im_scale)
         processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    if cfg.INPUT_UINT8:
+        blob = im_list_to_uint8_blob(processed_ims, cfg.PIXEL_MEANS)
+    else:
+        blob = im_list_to_blob(processed_ims)
 
     return blob, np.array(im_scale_factors)
 
@@ -234,22 +309,303 @@ def extract_imglist(fn_list, num_images=None):
     return image_ids, image_files
 
 
-def extract_gt_rois(objects):
+def extract_gt_rois(objects, width, height, max_boxes=num_fixed_boxes, pad=True):
+    """Returns the ground truth boxes of the first max_boxes objects as R x 5 ROIs.
+
+    With pad=True the ROIs are padded to max_boxes with the whole image as global context, otherwise the
+    whole image is only used for scenes without objects.
+    """
     rois = []
-    for ix in range(num_fixed_boxes):
-        if ix < len(objects):
-            obj = objects[ix]
-            #print("obj[xm,ax]: {}".format(obj['xmax']))
-            roi = [0, obj['xmin'], obj['ymin'], obj['xmax'], obj['ymax']]
-        else:
-            # pad with global context
-            roi = [0, 0, 0, 480, 320] # TODO: Do not use fixed dims for other datasets
-        rois.append(roi)
+    for obj in objects[:max_boxes]:
+        #print("obj[xm,ax]: {}".format(obj['xmax']))
+        rois.append([0, obj['xmin'], obj['ymin'], obj['xmax'], obj['ymax']])
+    num_padded = max_boxes - len(rois) if pad else max(1 - len(rois), 0)
+    for _ in range(num_padded):
+        # pad with global context
+        rois.append([0, 0, 0, width, height])
     rois = np.array(rois).astype(np.float32)
     return rois
 
+
+def load_image(im_file):
+    """Reads an image from disk in BGR order with cfg.IMAGE_DECODER, returns it with its scale relative to
+    the image file (below 1 when the decoder already shrank it towards the test scale)."""
+    return read_image(im_file, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE)
+
+
+def prepare_image(args, image_ix, image_id, image_file):
+    """Decodes and resizes one image, returning everything needed to batch it with other images."""
+    im_file = os.path.join(args.image_dir, image_file)
+    with span('decode'):
+        im, decoded_scale = load_image(im_file)
+    with span('resize'):
+        blob, im_scales = _get_image_blob(im)
+    assert len(im_scales) == 1, "Only a single test scale is supported"
+    # boxes and sizes are in the coordinates of the image file
+    height, width = int(round(im.shape[0] / decoded_scale)), int(round(im.shape[1] / decoded_scale))
+    entry = {'ix': image_ix, 'id': image_id, 'blob': blob, 'scale': im_scales[0] * decoded_scale,
+             'height': height, 'width': width}
+    if args.feat_cache is not None:
+        # looked up here so that cache reads overlap with the network like decoding does
+        entry['hash'] = file_hash(im_file)
+        entry['base_feat'] = args.feat_cache.get(entry['hash'])
+    if args.use_oracle_gt_boxes:
+        entry['rois'] = extract_gt_rois(args.scenes['annotations'][image_ix]['objects'], width, height,
+                                        max_boxes=args.max_boxes if args.adaptive_boxes else num_fixed_boxes,
+                                        pad=not args.adaptive_boxes)
+    if args.visualize_only:
+        entry['im'] = im if decoded_scale == 1 else cv2.resize(np.ascontiguousarray(im), (width, height))
+    return entry
+
+
+def batch_by_shape(entries, batch_size, max_pending=None):
+    """Groups prepared images into batches whose blobs have the same shape.
+
+    Images are buffered per blob shape and a group is emitted as soon as it holds batch_size images.
+    If more than max_pending images are buffered (datasets with many different image sizes), the
+    largest group is emitted early so that memory stays bounded.
+    """
+    if max_pending is None:
+        max_pending = 4 * batch_size
+    pending = OrderedDict()
+    num_pending = 0
+    for entry in entries:
+        shape = entry['blob'].shape
+        group = pending.setdefault(shape, [])
+        group.append(entry)
+        num_pending += 1
+        if len(group) == batch_size:
+            num_pending -= len(group)
+            yield pending.pop(shape)
+        elif num_pending > max_pending:
+            largest = max(pending, key=lambda s: len(pending[s]))
+            num_pending -= len(pending[largest])
+            yield pending.pop(largest)
+    for shape in list(pending.keys()):
+        yield pending.pop(shape)
+
+
+def cached_base_feat(fasterRCNN, im_data, batch, feat_cache):
+    """Returns the base feature map of a batch, from the cache if every image of the batch is cached."""
+    if all(entry['base_feat'] is not None for entry in batch):
+        base_feat = torch.from_numpy(np.concatenate([entry['base_feat'] for entry in batch]))
+        return Variable(base_feat.float().to(im_data.data.device), volatile=True)
+    base_feat = fasterRCNN.extract_base_feat(im_data)
+    for b, entry in enumerate(batch):
+        if entry['base_feat'] is None:
+            feat_cache.put(entry['hash'], base_feat.data[b:b + 1].cpu().numpy())
+    return base_feat
+
+
+def im_detect_batch(fasterRCNN, batch, holders, classes, args):
+    """Runs a single forward pass over a group of images that share the same blob shape.
+
+    Returns a list with one (pooled_feats, scores, pred_boxes) tuple per image of the batch, where
+    pred_boxes holds the regressed boxes of every class in original image coordinates.
+    """
+    im_data, im_info, gt_boxes, num_boxes = holders
+    batch_size = len(batch)
+
+    # all blobs of a group have the same shape, so stacking them needs no padding
+    im_blob = np.concatenate([entry['blob'] for entry in batch], axis=0)
+    im_info_np = np.array([[im_blob.shape[1], im_blob.shape[2], entry['scale']] for entry in batch],
+                          dtype=np.float32)
+
+    im_data_pt = torch.from_numpy(im_blob)
+    if not cfg.INPUT_UINT8:
+        im_data_pt = im_data_pt.permute(0, 3, 1, 2)
+    im_info_pt = torch.from_numpy(im_info_np)
+
+    with span('h2d'):
+        im_data.data.resize_(im_data_pt.size()).copy_(im_data_pt)
+        im_info.data.resize_(im_info_pt.size()).copy_(im_info_pt)
+        gt_boxes.data.resize_(batch_size, 1, 5).zero_()
+        num_boxes.data.resize_(batch_size).zero_()
+
+    if args.use_oracle_gt_boxes:
+        # images with fewer objects repeat their last ROI, the copies are dropped from the results
+        oracle_rois = np.zeros((batch_size, max(len(entry['rois']) for entry in batch), 5), dtype=np.float32)
+        for b, entry in enumerate(batch):
+            oracle_rois[b, :len(entry['rois'])] = entry['rois']
+            oracle_rois[b, len(entry['rois']):] = entry['rois'][-1]
+            oracle_rois[b, :, 0] = b
+            oracle_rois[b, :, 1:] *= entry['scale']
+
+    base_feat = None
+    if args.feat_cache is not None:
+        base_feat = cached_base_feat(fasterRCNN, im_data, batch, args.feat_cache)
+
+    if args.use_oracle_gt_boxes:
+        # the ROIs are given, so only the backbone, ROI pooling and the head run
+        if base_feat is None:
+            base_feat = fasterRCNN.extract_base_feat(im_data)
+        rois, cls_prob, bbox_pred, pooled_feats = fasterRCNN.extract_roi_feats(base_feat,
+                                                                               torch.from_numpy(oracle_rois))
+    else:
+        rois, cls_prob, bbox_pred, \
+        rpn_loss_cls, rpn_loss_box, \
+        RCNN_loss_cls, RCNN_loss_bbox, \
+        rois_label, pooled_feats = fasterRCNN(im_data, im_info, gt_boxes, num_boxes, return_feats=True,
+                                              base_feat=base_feat)
+
+    scores = cls_prob.data
+    with span('postprocess'):
+        pred_boxes = decode_boxes(rois.data, bbox_pred.data, im_info.data, [entry['scale'] for entry in batch],
+                                  len(classes), args.class_agnostic)
+
+    pooled_feats = pooled_feats.data.view(batch_size, rois.size(1), -1)
+    results = []
+    for b, entry in enumerate(batch):
+        num_rois = len(entry['rois']) if args.use_oracle_gt_boxes else rois.size(1)
+        results.append((pooled_feats[b][:num_rois], scores[b][:num_rois], pred_boxes[b][:num_rois]))
+    return results
+
+
+def select_best_class_boxes(scores, pred_boxes):
+    """Keeps, for every ROI, the box regressed for its highest scoring class."""
+    boxes, _, score_class_ixs = best_class_boxes(scores, pred_boxes)
+    return boxes.cpu().numpy(), score_class_ixs
+
+
+def select_adaptive_boxes(scores, boxes, min_boxes, max_boxes, conf_thresh):
+    """Indices of the boxes kept by generate_tsv.py: those whose best class confidence after per-class NMS
+    reaches conf_thresh, at least min_boxes and at most max_boxes of them."""
+    boxes_pt = torch.from_numpy(boxes.astype(np.float32)).type_as(scores)
+    # every class is suppressed over the same best-class boxes, so the boxes are class agnostic here. Only
+    # the detections that can reach conf_thresh go into the NMS call, instead of all R x (C - 1) of them
+    max_conf = nms_max_confidence(scores, boxes_pt, thresh=np.nextafter(np.float32(conf_thresh), np.float32(0)))
+
+    keep_boxes = np.where(max_conf >= conf_thresh)[0]
+    if len(keep_boxes) < min_boxes:
+        # the boxes below conf_thresh are ranked by their scores after NMS as well
+        max_conf = per_class_nms_max_confidence(scores, boxes_pt)
+        keep_boxes = np.argsort(max_conf)[::-1][:min_boxes]
+    elif len(keep_boxes) > max_boxes:
+        keep_boxes = np.argsort(max_conf)[::-1][:max_boxes]
+    return np.ascontiguousarray(keep_boxes)
+
+
+def get_spatial_features(pred_boxes, width, height):
+    """Returns (x1, y1, x2, y2, width, height) of every box, normalized by the image size."""
+    widths = pred_boxes[:, 2] - pred_boxes[:, 0]
+    heights = pred_boxes[:, 3] - pred_boxes[:, 1]
+    scaled_widths = widths / width
+    scaled_heights = heights / height
+    scaled_boxes = pred_boxes
+    scaled_boxes[:, 0] /= width
+    scaled_boxes[:, 2] /= width
+    scaled_boxes[:, 1] /= height
+    scaled_boxes[:, 3] /= height
+
+    scaled_widths = np.expand_dims(scaled_widths, axis=1)
+    scaled_heights = np.expand_dims(scaled_heights, axis=1)
+    return np.concatenate((scaled_boxes, scaled_widths, scaled_heights), axis=1)
+
+
+def run_extraction(fasterRCNN, entries, batch_size, holders, classes, args):
+    """Yields (entry, pooled_feats, scores, pred_boxes, score_class_ixs) for every prepared image.
+
+    Images are not necessarily yielded in input order when batch_size > 1, use entry['ix'] to place them.
+    """
+    for batch in batch_by_shape(entries, batch_size):
+        for entry, (pooled_feats, scores, pred_boxes) in zip(batch, im_detect_batch(fasterRCNN, batch, holders,
+                                                                                    classes, args)):
+            with span('postprocess'):
+                pred_boxes, score_class_ixs = select_best_class_boxes(scores, pred_boxes)
+                if args.adaptive_boxes and not args.use_oracle_gt_boxes:
+                    keep = select_adaptive_boxes(scores, pred_boxes, args.min_boxes, args.max_boxes,
+                                                 args.conf_thresh)
+                    keep_pt = torch.from_numpy(keep).type_as(score_class_ixs)
+                    pooled_feats, scores = pooled_feats[keep_pt], scores[keep_pt]
+                    pred_boxes, score_class_ixs = pred_boxes[keep], score_class_ixs[keep_pt]
+            yield entry, pooled_feats, scores, pred_boxes, score_class_ixs
+
+
+def check_resumed_dataset(h5_filename, dataset, shape, dtype):
+    if dataset.shape != shape:
+        raise ValueError('Cannot resume {}: dataset {} has shape {}, expected {}'.format(
+            h5_filename, dataset.name, dataset.shape, shape))
+    if dataset.dtype != DTYPES[dtype]:
+        raise ValueError('Cannot resume {}: dataset {} is stored as {}, expected {}'.format(
+            h5_filename, dataset.name, dataset.dtype, dtype))
+
+
+def open_h5_datasets(h5_filename, shapes, resume=False, dtype='float32', compression='none', compression_level=4,
+                     chunk_rows=0):
+    """Opens the output file and its feature datasets, reusing the existing ones when resuming.
+
+    New datasets are created with the given storage type, compression and chunking (see
+    feature_store.h5_writer); existing ones keep the layout they were created with.
+    """
+    if resume and os.path.exists(h5_filename):
+        h5_file = h5py.File(h5_filename, "a")
+    else:
+        h5_file = h5py.File(h5_filename, "w")
+    datasets = []
+    for name, shape in shapes:
+        if name in h5_file:
+            check_resumed_dataset(h5_filename, h5_file[name], shape, dtype)
+            datasets.append(h5_file[name])
+        else:
+            datasets.append(create_feature_dataset(h5_file, name, shape, dtype=dtype, compression=compression,
+                                                   compression_level=compression_level, chunk_rows=chunk_rows))
+    return h5_file, datasets
+
+
+def open_ragged_datasets(h5_filename, item_shapes, num_images, resume=False, dtype='float32', compression='none',
+                         compression_level=4):
+    """Like open_h5_datasets for the ragged layout, returns the file, its flat datasets, offsets and counts."""
+    if resume and os.path.exists(h5_filename):
+        h5_file = h5py.File(h5_filename, "a")
+    else:
+        h5_file = h5py.File(h5_filename, "w")
+    datasets = []
+    for name, item_shape in item_shapes:
+        if name in h5_file:
+            check_resumed_dataset(h5_filename, h5_file[name], (h5_file[name].shape[0],) + item_shape, dtype)
+            datasets.append(h5_file[name])
+        else:
+            datasets.append(create_ragged_dataset(h5_file, name, item_shape, dtype=dtype, compression=compression,
+                                                  compression_level=compression_level))
+    if RAGGED_OFFSETS in h5_file:
+        offsets, counts = h5_file[RAGGED_OFFSETS], h5_file[RAGGED_COUNTS]
+        if offsets.shape != (num_images,):
+            raise ValueError('Cannot resume {}: it indexes {} images, expected {}'.format(
+                h5_filename, offsets.shape[0], num_images))
+    else:
+        offsets, counts = create_ragged_index(h5_file, num_images)
+    return h5_file, datasets, offsets, counts
+
+
+def compare_batch_sizes(fasterRCNN, image_ids, image_files, holders, classes, args):
+    """Extracts the first args.compare_batch images with batch size 1 and with args.batch_size.
+
+    Checks that both paths produce bit-identical features and boxes and reports images/sec for each.
+    """
+    num_images = min(args.compare_batch, len(image_ids))
+    outputs = {}
+    for batch_size in (1, args.batch_size):
+        entries = (prepare_image(args, ix, image_ids[ix], image_files[ix]) for ix in range(num_images))
+        feats, boxes = {}, {}
+        tic = time.time()
+        for entry, pooled_feats, _, pred_boxes, _ in run_extraction(fasterRCNN, entries, batch_size, holders,
+                                                                    classes, args):
+            feats[entry['ix']] = pooled_feats.cpu().numpy()
+            boxes[entry['ix']] = pred_boxes
+        elapsed = time.time() - tic
+        print('batch size {}: {} images in {:.2f}s ({:.2f} images/sec)'.format(
+            batch_size, num_images, elapsed, num_images / elapsed))
+        outputs[batch_size] = (feats, boxes)
+
+    (single_feats, single_boxes), (batch_feats, batch_boxes) = outputs[1], outputs[args.batch_size]
+    identical = all(np.array_equal(single_feats[ix], batch_feats[ix]) and
+                    np.array_equal(single_boxes[ix], batch_boxes[ix]) for ix in range(num_images))
+    max_diff = max(np.abs(single_feats[ix] - batch_feats[ix]).max() for ix in range(num_images))
+    print('bit-identical: {}, max abs feature difference: {}'.format(identical, max_diff))
+    return identical
+
+
 if __name__ == '__main__':
-    printed = False
     args = parse_args()
 
     # print('Called with args:')
@@ -261,6 +617,16 @@ if __name__ == '__main__':
         cfg_from_list(args.set_cfgs)
 
     cfg.USE_GPU_NMS = args.cuda
+    device = inference_device(args.cuda)
+
+    if args.adaptive_boxes and not args.use_oracle_gt_boxes and args.max_boxes > cfg.TEST.RPN_POST_NMS_TOP_N:
+        print('Warning: the RPN only proposes {} boxes per image, raise TEST.RPN_POST_NMS_TOP_N with --set to '
+              'keep up to {} boxes'.format(cfg.TEST.RPN_POST_NMS_TOP_N, args.max_boxes))
+
+    intra_op_threads, inter_op_threads = configure_threads(args.num_threads, args.interop_threads)
+    if args.num_threads > 0:
+        cv2.setNumThreads(args.num_threads)
+    print('Running on {} with {} intra-op and {} inter-op threads'.format(device, intra_op_threads, inter_op_threads))
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -269,99 +635,104 @@ if __name__ == '__main__':
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
 
-    input_dir = args.load_dir + "/" + args.net + "/" + args.load_subdir.lower()
-
-    if not os.path.exists(input_dir):
-        raise Exception('There is no input directory for loading network from ' + input_dir)
-    load_name = os.path.join(input_dir,
-                             'faster_rcnn_{}_{}_{}.pth'.format(args.checksession, args.checkepoch, args.checkpoint))
-
-    with open('/hdd/robik/CLEVR/faster-rcnn/objects_count.json') as ovf:
-        classes = list(json.load(ovf).keys())
-        # print("classes: {}".format(classes))
-
-    # initialize the network here.
-    if args.net == 'vgg16':
-        fasterRCNN = vgg16(classes, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res101':
-        fasterRCNN = resnet(classes, 101, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res50':
-        fasterRCNN = resnet(classes, 50, pretrained=False, class_agnostic=args.class_agnostic)
-    elif args.net == 'res152':
-        fasterRCNN = resnet(classes, 152, pretrained=False, class_agnostic=args.class_agnostic)
+    if args.exported is not None:
+        # one TorchScript artifact replaces the model code and the checkpoint
+        fasterRCNN = ExportedDetector(args.exported, device)
+        classes = fasterRCNN.classes
+        load_name = args.exported
+        print('load exported model %s' % (args.exported))
     else:
-        print("network is not defined")
-        pdb.set_trace()
-
-    fasterRCNN.create_architecture()
-
-    print("load checkpoint %s" % (load_name))
-    if args.cuda > 0:
-        checkpoint = torch.load(load_name)
-    else:
-        checkpoint = torch.load(load_name, map_location=(lambda storage, loc: storage))
-    fasterRCNN.load_state_dict(checkpoint['model'])
-    if 'pooling_mode' in checkpoint.keys():
-        cfg.POOLING_MODE = checkpoint['pooling_mode']
+        input_dir = args.load_dir + "/" + args.net + "/" + args.load_subdir.lower()
+
+        if not os.path.exists(input_dir):
+            raise Exception('There is no input directory for loading network from ' + input_dir)
+        load_name = os.path.join(input_dir, 'faster_rcnn_{}_{}_{}.pth'.format(args.checksession, args.checkepoch,
+                                                                               args.checkpoint))
+
+        with open('/hdd/robik/CLEVR/faster-rcnn/objects_count.json') as ovf:
+            classes = list(json.load(ovf).keys())
+            # print("classes: {}".format(classes))
+
+        # initialize the network here.
+        if args.net == 'vgg16':
+            fasterRCNN = vgg16(classes, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res101':
+            fasterRCNN = resnet(classes, 101, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res50':
+            fasterRCNN = resnet(classes, 50, pretrained=False, class_agnostic=args.class_agnostic)
+        elif args.net == 'res152':
+            fasterRCNN = resnet(classes, 152, pretrained=False, class_agnostic=args.class_agnostic)
+        else:
+            print("network is not defined")
+            pdb.set_trace()
 
-    print('load model successfully!')
+        fasterRCNN.create_architecture()
 
-    # pdb.set_trace()
+        print("load checkpoint %s" % (load_name))
+        if args.cuda > 0:
+            checkpoint = torch.load(load_name)
+        else:
+            checkpoint = torch.load(load_name, map_location=(lambda storage, loc: storage))
+        fasterRCNN.load_state_dict(checkpoint['model'])
+        if 'pooling_mode' in checkpoint.keys():
+            cfg.POOLING_MODE = checkpoint['pooling_mode']
 
-    print("load checkpoint %s" % (load_name))
+        print('load model successfully!')
 
     # initilize the tensor holder here.
-    im_data = torch.FloatTensor(1)
+    im_data = torch.ByteTensor(1) if cfg.INPUT_UINT8 else torch.FloatTensor(1)
     im_info = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
 
-    # ship to cuda
-    if args.cuda > 0:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the inference device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data, volatile=True)
     im_info = Variable(im_info, volatile=True)
     num_boxes = Variable(num_boxes, volatile=True)
     gt_boxes = Variable(gt_boxes, volatile=True)
+    holders = (im_data, im_info, gt_boxes, num_boxes)
 
-    if args.cuda > 0:
-        cfg.CUDA = True
-
-    if args.cuda > 0:
-        fasterRCNN.cuda()
+    fasterRCNN = place_model(fasterRCNN, device)
+    check_device_support(device, args.batch_size)
+    fasterRCNN = set_inference_precision(fasterRCNN, args.precision, device, args.precision_stages.split(','))
 
     fasterRCNN.eval()
 
-    start = time.time()
-    max_per_image = 100
-    vis = True
-
-    webcam_num = args.webcam_num
-    print("vis: {} webcam_num: {}".format(vis, webcam_num))
-    # Set up webcam or get image directories
-    if webcam_num >= 0:
-        cap = cv2.VideoCapture(webcam_num)
-        num_images = 0
-    else:
-        imglist = sorted(os.listdir(args.image_dir))
-        num_images = len(imglist)
-
+    imglist = sorted(os.listdir(args.image_dir))
     if args.image_limit is not None:
         imglist = imglist[0:args.image_limit]
-        num_images = len(imglist)
-        print("num_images {}".format(num_images))
+        print("num_images {}".format(len(imglist)))
 
     #image_ids, image_files = extract_imglist(args.scenes, num_images)
     image_ids, image_files = extract_imglist(imglist, args.num_images)
+    if args.num_shards > 1:
+        image_ids = shard_items(image_ids, args.shard, args.num_shards)
+        image_files = shard_items(image_files, args.shard, args.num_shards)
+        if hasattr(args, 'scenes'):
+            args.scenes['annotations'] = shard_items(args.scenes['annotations'], args.shard, args.num_shards)
+        print('Shard {} of {}'.format(args.shard, args.num_shards))
     num_images = len(image_ids)
 
     print('Loaded Photo: {} images.'.format(num_images))
 
+    if args.compare_batch is not None:
+        # batch size selection may change cudnn algorithms, make them deterministic for the comparison
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+        compare_batch_sizes(fasterRCNN, image_ids, image_files, holders, classes, args)
+        sys.exit(0)
+
+    if args.base_feat_cache is not None:
+        base_precision = args.precision if 'base' in args.precision_stages.split(',') else 'float32'
+        args.feat_cache = BaseFeatCache(args.base_feat_cache, cache_namespace(load_name, cfg, base_precision),
+                                        int(args.base_feat_cache_gb * 2 ** 30))
+
     ### Init h5 file
     if not args.visualize_only:
         if args.use_oracle_gt_boxes:
@@ -369,183 +740,105 @@ if __name__ == '__main__':
         else:
             feat_dir = 'faster-rcnn'
 
-        h5_filename = args.dataroot + '/{}/{}.hdf5'.format(feat_dir, args.split)
-        h5_file = h5py.File(h5_filename, "w")
-        h5_img_features = h5_file.create_dataset(
-            'image_features', (num_images, num_fixed_boxes, feature_length), 'f')
-        h5_spatial_img_features = h5_file.create_dataset(
-            'spatial_features', (num_images, num_fixed_boxes, 6), 'f')
-        indices = {'image_id_to_ix': {}, 'image_ix_to_id': {}}
-
-
-    counter = 0
-    print("num_images: {}".format(num_images))
-
-    for image_ix in tqdm(iter(range(num_images))):
-        total_tic = time.time()
-
-        im_file = os.path.join(args.image_dir, image_files[image_ix])
-        img_id = image_ids[image_ix]
-        if not printed:
-            print("im_id: {}".format(img_id))
-        # im = cv2.imread(im_file)
-        im_in = np.array(imread(im_file, mode='RGB'))
-        height, width = im_in.shape[0], im_in.shape[1]
-        if len(im_in.shape) == 2:
-            im_in = im_in[:, :, np.newaxis]
-            im_in = np.concatenate((im_in, im_in, im_in), axis=2)
-        # rgb -> bgr
-        im = im_in[:, :, ::-1]
-
-        blobs, im_scales = _get_image_blob(im)
-        if not printed:
-            print("im_scales {}".format(im_scales))
-        assert len(im_scales) == 1, "Only single-image batch implemented"
-        im_blob = blobs
-
-        im_info_np = np.array([[im_blob.shape[1], im_blob.shape[2], im_scales[0]]], dtype=np.float32)
-
-        im_data_pt = torch.from_numpy(im_blob)
-        im_data_pt = im_data_pt.permute(0, 3, 1, 2)
-        im_info_pt = torch.from_numpy(im_info_np)
-
-        im_data.data.resize_(im_data_pt.size()).copy_(im_data_pt)
-        im_info.data.resize_(im_info_pt.size()).copy_(im_info_pt)
-        gt_boxes.data.resize_(1, 1, 5).zero_()
-        num_boxes.data.resize_(1).zero_()
-
-        # pdb.set_trace()
-        det_tic = time.time()
-        if args.use_oracle_gt_boxes:
-            oracle_rois = extract_gt_rois(args.scenes['annotations'][image_ix]['objects']) * im_scales[0]
-            if not printed:
-                print("oracle_rois.shape: {}".format(oracle_rois.shape))
+        output_name = shard_name(args.split, args.shard, args.num_shards)
+        h5_filename = args.dataroot + '/{}/{}.hdf5'.format(feat_dir, output_name)
+        journal_filename = h5_filename + '.journal'
+        # the journal only describes rows of the file it was written with, a new file starts from scratch
+        resume_journal = args.resume and os.path.exists(h5_filename)
+        if args.resume and not resume_journal and os.path.exists(journal_filename):
+            print('{} does not exist, ignoring the journal {}'.format(h5_filename, journal_filename))
+        if args.adaptive_boxes:
+            h5_file, datasets, offsets, counts = open_ragged_datasets(
+                h5_filename, [('image_features', (feature_length,)), ('spatial_features', (6,))], num_images,
+                resume=args.resume, dtype=args.h5_dtype, compression=args.h5_compression,
+                compression_level=args.h5_compression_level)
+            row_writer = RaggedRowWriter(datasets, offsets, counts, buffer_rows=args.write_buffer)
         else:
-            oracle_rois = None
-        rois, cls_prob, bbox_pred, \
-        rpn_loss_cls, rpn_loss_box, \
-        RCNN_loss_cls, RCNN_loss_bbox, \
-        rois_label, pooled_feats = fasterRCNN(im_data, im_info, gt_boxes, num_boxes, return_feats=True,
-                                              oracle_rois=oracle_rois)
-
-        if not printed:
-            print("rois: {}".format(rois.shape))  # 1 X num objects X 5
-            print("rois: {}".format(rois))
-            print("bbox_pred: {}".format(bbox_pred.shape))  # 1 X num objects X 384
-            print("pooled_Feats: {}".format(pooled_feats.shape))  # num objects  x 2048
-
-        scores = cls_prob.data
-        boxes = rois.data[:, :, 1:5]
-
-        if cfg.TEST.BBOX_REG:
-            # Apply bounding-box regression deltas
-            box_deltas = bbox_pred.data
-            if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
-                # Optionally normalize targets by a precomputed mean and stdev
-                if args.class_agnostic:
-                    if args.cuda > 0:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    else:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS) \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
-
-                    box_deltas = box_deltas.view(1, -1, 4)
-                else:
-                    if args.cuda > 0:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    else:
-                        box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS) \
-                                     + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
-                    box_deltas = box_deltas.view(1, -1, 4 * len(classes))
-
-            pred_boxes = bbox_transform_inv(boxes, box_deltas, 1)
-            pred_boxes = clip_boxes(pred_boxes, im_info.data, 1)
-        else:
-            # Simply repeat the boxes, once for each class
-            pred_boxes = np.tile(boxes, (1, scores.shape[1]))
-
-        pred_boxes /= im_scales[0]
-
-        scores = scores.squeeze()
-        pred_boxes = pred_boxes.squeeze()
-        if not printed:
-            print("scores.shape: {}".format(scores.shape))
-            print("pred_boxes.shape: {}".format(pred_boxes.shape))
-
-        max_scores, score_class_ixs = torch.max(scores, dim=1)
-        if not printed:
-            print("score_ixs: {}".format(score_class_ixs.shape)) # 15
-        if not printed:
-            print("max scores: {}".format(max_scores.shape)) # 15
-
-        pred_boxes = pred_boxes.view(pred_boxes.shape[0], -1, 4)
-        if not printed:
-            print("pred_boxes.shape: {}".format(pred_boxes.shape)) # 15 X 96 X 4
-
-        filtered_pred_boxes = []
-        for pred_box_ix, pred_box in enumerate(pred_boxes):
-            filtered_pred_boxes.append(pred_box[score_class_ixs[pred_box_ix]].cpu().numpy().tolist())
+            h5_file, datasets = open_h5_datasets(
+                h5_filename, [('image_features', (num_images, num_fixed_boxes, feature_length)),
+                              ('spatial_features', (num_images, num_fixed_boxes, 6))], resume=args.resume,
+                dtype=args.h5_dtype, compression=args.h5_compression, compression_level=args.h5_compression_level,
+                chunk_rows=args.h5_chunk_rows)
+            row_writer = BufferedRowWriter(datasets, buffer_rows=args.write_buffer)
+        ids_map_filename = os.path.join(args.dataroot, feat_dir, '{}_ids_map.json'.format(output_name))
+
+        journal = CompletionJournal(journal_filename, resume=resume_journal)
+        for row, image_id in journal.completed.items():
+            if row >= num_images or image_ids[row] != image_id:
+                raise ValueError('The journal of {} does not match the current image list (row {} is image {}), '
+                                 'run without --resume to start over'.format(h5_filename, row, image_id))
+        todo = [image_ix for image_ix in range(num_images) if image_ix not in journal]
+        print('Resuming: {} images already extracted, {} to go'.format(len(journal), len(todo)))
+    else:
+        todo = list(range(num_images))
+
+    print("num_images: {}, batch size: {}".format(num_images, args.batch_size))
+
+    num_written = [0]
+
+    def record_rows(rows):
+        # rows only become durable in the journal after the features themselves are flushed
+        for row in rows:
+            journal.record(row, image_ids[row])
+            num_written[0] += 1
+            if num_written[0] % args.commit_interval == 0:
+                h5_file.flush()
+                journal.commit()
+            if args.ids_map_interval > 0 and num_written[0] % args.ids_map_interval == 0:
+                write_ids_map(journal.indices(), ids_map_filename)
+
+    def write_image(row, img_id, feats, spatial_features):
+        # rows are buffered and reach the file in slabs of args.write_buffer images
+        with span('hdf5_write'):
+            rows = row_writer.write(row, feats, spatial_features)
+        record_rows(rows)
+
+    # decode/resize on a pool of threads, run the network on this thread and write on another one
+    prefetcher = OrderedPrefetcher(lambda image_ix: prepare_image(args, image_ix, image_ids[image_ix],
+                                                                  image_files[image_ix]),
+                                   todo, num_workers=args.num_workers, max_pending=args.prefetch)
+    writer = None if args.visualize_only else AsyncWriter(write_image, max_pending=args.prefetch)
+
+    timer = None
+    if args.telemetry is not None:
+        timer = StageTimer(None if args.telemetry == '-' else args.telemetry, args.telemetry_interval,
+                           sync_cuda=device.type == 'cuda').install()
 
-        # pred_boxes = pred_boxes[:, score_class_ixs] # Get bb preds for classes with max scores
-        pred_boxes = np.array(filtered_pred_boxes)
-        if not printed:
-            print("pred_boxes.shape: {}".format(pred_boxes.shape)) # 15 X 4
-            print('returned pooled_feats.shape: {}'.format(pooled_feats.data.cpu().numpy().shape)) # 15 X 2048
+    start = time.time()
+    extraction = run_extraction(fasterRCNN, prefetcher, args.batch_size, holders, classes, args)
+    pbar = tqdm(extraction, total=len(todo))
+    for entry, pooled_feats, scores, pred_boxes, score_class_ixs in pbar:
+        # rows follow the sorted image list, whatever order the shape groups are processed in
+        row = entry['ix']
+        img_id = entry['id']
 
         if not args.visualize_only:
-            h5_img_features[counter, :, :] = pooled_feats.data.cpu().numpy().astype(np.float32)
-
-            widths = pred_boxes[:, 2] - pred_boxes[:, 0]
-            heights = pred_boxes[:, 3] - pred_boxes[:, 1]
-            scaled_widths = widths / width
-            scaled_heights = heights / height
-            scaled_boxes = pred_boxes
-            scaled_boxes[:, 0] /= width
-            scaled_boxes[:, 2] /= width
-            scaled_boxes[:, 1] /= height
-            scaled_boxes[:, 3] /= height
-
-            scaled_widths = np.expand_dims(scaled_widths, axis=1)
-            scaled_heights = np.expand_dims(scaled_heights, axis=1)
-            if not printed:
-                print("scaled_widths.shape: {}".format(scaled_widths.shape))
-                print("scaled_heights.shape: {}".format(scaled_heights.shape))
-                print("scaled_boxes.shape: {}".format(scaled_boxes.shape))
-
-            spatial_features = np.concatenate((scaled_boxes, scaled_widths, scaled_heights), axis=1)
-
-            if not printed:
-                print("scaled_widths.shape: {}".format(scaled_widths.shape))
-                print("scaled_heights.shape: {}".format(scaled_heights.shape))
-                print("scaled_boxes.shape: {}".format(scaled_boxes.shape))
-                print("spatial_features.shape: {}".format(spatial_features.shape))
-
-            if not printed:
-                print("spatial_features.shape: {}".format(spatial_features.shape))
-            h5_spatial_img_features[counter, :, :] = spatial_features
-
-            indices['image_id_to_ix'][img_id] = counter
-            indices['image_ix_to_id'][counter] = img_id
-
-            with open(os.path.join(args.dataroot, feat_dir, '{}_ids_map.json'.format(args.split)), 'w') as f:
-                json.dump(indices, f)
+            writer.put(row, img_id, pooled_feats.cpu().numpy().astype(np.float32),
+                       get_spatial_features(pred_boxes, entry['width'], entry['height']))
+            if row % 100 == 0:
+                pbar.set_postfix(decode_q=prefetcher.depth, write_q=writer.depth)
         else:
-            if not printed:
-                print("filtered_pred_boxes {}".format(np.array(filtered_pred_boxes).shape))
-                print("score_class_ixs {}".format(np.array(score_class_ixs).shape))
-
-            im2show = np.copy(im)
-            im2show = draw_preds(im2show, filtered_pred_boxes, classes, score_class_ixs, scores)
+            im2show = np.copy(entry['im'])
+            im2show = draw_preds(im2show, pred_boxes, classes, score_class_ixs, scores)
             #plt.imshow(im2show)
             plt.imsave(args.visualize_dir + '/' + 'VIS_'+str(img_id)+'.png', im2show)
             plt.close()
-            # filtered_pred_boxes.append(pred_box[score_class_ixs[pred_box_ix]].cpu().numpy().tolist())
-            #plt.show()
-
-
-        counter += 1
-        printed = True
+        if timer is not None:
+            timer.tick()
+
+    if writer is not None:
+        writer.close()
+    elapsed = time.time() - start
+    print('Extracted {} images in {:.1f}s ({:.2f} images/sec)'.format(len(todo), elapsed, len(todo) / elapsed))
+    print(pipeline_report(prefetcher, writer, elapsed))
+    if timer is not None:
+        timer.close()
+        print(timer.summary())
+    if args.feat_cache is not None:
+        print(args.feat_cache.summary())
     if not args.visualize_only:
+        record_rows(row_writer.flush())
+        h5_file.flush()
+        journal.close()
+        write_ids_map(journal.indices(), ids_map_filename)
         h5_file.close()
@@ -0,0 +1,102 @@
+"""Runs extract_features.py as several worker processes and merges their outputs.
+
+The sorted image list is split into --num_shards shards (shard k holds images k, k + N, ...). Every shard
+is extracted by its own process into {split}.shard{k}-of-{N}.hdf5, with the CPU threads divided between
+the processes and the shards assigned round-robin to --gpus. Once all shards are complete they are merged
+into {split}.hdf5 and {split}_ids_map.json, identical to the output of a single extract_features.py run.
+
+All arguments that are not listed below are passed on to extract_features.py, e.g.
+  python extract_features_sharded.py --num_shards 4 --gpus 0,1 --dataset CLEVR --root /hdd/robik \
+      --split val --net res101 --checksession 1 --checkepoch 11 --checkpoint 34999 --cuda
+A failed shard can be re-run alone with --shards K (add --resume to keep its completed images).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import sys
+import argparse
+import multiprocessing
+import subprocess
+import time
+
+from feature_store.shards import shard_name, merge_shards
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Sharded multi-process feature extraction')
+    parser.add_argument('--num_shards', required=True, type=int)
+    parser.add_argument('--shards', default=None,
+                        help='comma separated shards to run, all of them by default')
+    parser.add_argument('--gpus', default=None,
+                        help='comma separated GPU ids assigned round-robin to the shards')
+    parser.add_argument('--threads_per_shard', default=None, type=int,
+                        help='CPU threads of every worker, by default the CPUs are divided between the workers')
+    parser.add_argument('--no_merge', action='store_true', help='only extract the shards')
+    parser.add_argument('--merge_only', action='store_true', help='only merge already extracted shards')
+    args, extract_args = parser.parse_known_args()
+
+    # the output location is derived from these extract_features.py arguments
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument('--root', required=True)
+    output_parser.add_argument('--dataset', default='pascal_voc')
+    output_parser.add_argument('--split', required=True)
+    output_parser.add_argument('--use_oracle_gt_boxes', action='store_true')
+    output_args, _ = output_parser.parse_known_args(extract_args)
+
+    args.extract_args = extract_args
+    args.split = output_args.split
+    feat_dir = 'oracle-faster-rcnn' if output_args.use_oracle_gt_boxes else 'faster-rcnn'
+    args.feat_dir = os.path.join(output_args.root, output_args.dataset, feat_dir)
+    if args.shards is None:
+        args.shards = list(range(args.num_shards))
+    else:
+        args.shards = [int(shard) for shard in args.shards.split(',')]
+    if args.threads_per_shard is None:
+        args.threads_per_shard = max(multiprocessing.cpu_count() // len(args.shards), 1)
+    return args
+
+
+def launch_shard(shard, args):
+    command = [sys.executable, '-u', 'extract_features.py'] + args.extract_args + [
+        '--num_shards', str(args.num_shards), '--shard', str(shard), '--num_threads', str(args.threads_per_shard)]
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(args.threads_per_shard)
+    env['MKL_NUM_THREADS'] = str(args.threads_per_shard)
+    if args.gpus is not None:
+        gpus = args.gpus.split(',')
+        env['CUDA_VISIBLE_DEVICES'] = gpus[shard % len(gpus)]
+    log_filename = os.path.join(args.feat_dir, shard_name(args.split, shard, args.num_shards) + '.log')
+    print('Shard {}: {} (log: {})'.format(shard, ' '.join(command), log_filename))
+    with open(log_filename, 'w') as log_file:
+        return subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not os.path.exists(args.feat_dir):
+        os.makedirs(args.feat_dir)
+
+    if not args.merge_only:
+        start = time.time()
+        procs = [(shard, launch_shard(shard, args)) for shard in args.shards]
+        failed = [shard for shard, proc in procs if proc.wait() != 0]
+        print('Extracted {} shards in {:.1f}s'.format(len(procs), time.time() - start))
+        if failed:
+            print('Shards {} failed, see their logs and re-run them with --shards {} --resume'.format(
+                failed, ','.join(str(shard) for shard in failed)))
+            sys.exit(1)
+
+    if not args.no_merge:
+        shard_files = []
+        for shard in range(args.num_shards):
+            name = shard_name(args.split, shard, args.num_shards)
+            shard_files.append((os.path.join(args.feat_dir, name + '.hdf5'),
+                                os.path.join(args.feat_dir, name + '_ids_map.json')))
+        start = time.time()
+        num_images = merge_shards(shard_files, os.path.join(args.feat_dir, args.split + '.hdf5'),
+                                  os.path.join(args.feat_dir, args.split + '_ids_map.json'))
+        print('Merged {} shards ({} images) in {:.1f}s'.format(args.num_shards, num_images, time.time() - start))
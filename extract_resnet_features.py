@@ -19,7 +19,6 @@ from torch.autograd import Variable
 
 import torchvision.transforms as transforms
 import torchvision.datasets as dset
-from scipy.misc import imread
 from lib.roi_data_layer.roidb import combined_roidb
 from lib.roi_data_layer.roibatchLoader import roibatchLoader
 from lib.model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
@@ -27,6 +26,10 @@ from lib.model.rpn.bbox_transform import clip_boxes
 from lib.model.nms.nms_wrapper import nms
 from lib.model.rpn.bbox_transform import bbox_transform_inv
 from lib.model.utils.blob import im_list_to_blob
+from lib.model.utils.image_io import read_image
+from lib.model.utils.device import inference_device, place_model
+from lib.model.utils.pipeline import OrderedPrefetcher, pipeline_report
+from lib.feature_store.base_feat_cache import BaseFeatCache, cache_namespace, file_hash
 from lib.model.faster_rcnn.vgg16 import vgg16
 from lib.model.faster_rcnn.resnet import resnet
 import pdb
@@ -139,6 +142,16 @@ def parse_args():
     parser.add_argument('--num_images', default=None, type=int)
     parser.add_argument('--visualize_subdir', default='visualize_faster_rcnn')
     parser.add_argument('--load_subdir', required=False)
+    parser.add_argument('--nw', dest='num_workers',
+                        help='number of threads decoding and resizing images, 0 decodes on the main thread',
+                        default=4, type=int)
+    parser.add_argument('--prefetch', default=32, type=int,
+                        help='maximum number of decoded images in flight')
+    parser.add_argument('--base_feat_cache', default=None,
+                        help='directory caching the feature map of every image (as float16), shared with '
+                             'extract_features.py --base_feat_cache')
+    parser.add_argument('--base_feat_cache_gb', default=100., type=float,
+                        help='size cap of --base_feat_cache, least recently used feature maps are evicted')
 
     args = parser.parse_args()
     args.dataroot = args.root + '/' + args.dataset
@@ -198,6 +211,12 @@ def _get_image_blob(im):
     return blob, np.array(im_scale_factors)
 
 
+def load_image(im_file):
+    """Reads an image from disk and returns it in BGR order, possibly shrunk towards the test scale."""
+    # the backend is passed explicitly, lib.model.utils.image_io sees the cfg of model.utils.config
+    return read_image(im_file, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE, backend=cfg.IMAGE_DECODER)[0]
+
+
 def draw_preds(im2show, boxes, classes, score_class_ixs, scores):
     for ix, class_ix in enumerate(score_class_ixs):
         curr_box = boxes[ix]
@@ -252,7 +271,6 @@ def extract_gt_rois(objects):
 
 
 if __name__ == '__main__':
-    printed = False
     args = parse_args()
 
     if args.cfg_file is not None:
@@ -261,6 +279,7 @@ if __name__ == '__main__':
         cfg_from_list(args.set_cfgs)
 
     cfg.USE_GPU_NMS = args.cuda
+    device = inference_device(args.cuda)
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -309,12 +328,11 @@ if __name__ == '__main__':
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
 
-    # ship to cuda
-    if args.cuda > 0:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the inference device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data, volatile=True)
@@ -322,11 +340,7 @@ if __name__ == '__main__':
     num_boxes = Variable(num_boxes, volatile=True)
     gt_boxes = Variable(gt_boxes, volatile=True)
 
-    if args.cuda > 0:
-        cfg.CUDA = True
-
-    if args.cuda > 0:
-        fasterRCNN.cuda()
+    fasterRCNN = place_model(fasterRCNN, device)
 
     fasterRCNN.eval()
 
@@ -362,29 +376,41 @@ if __name__ == '__main__':
             'spatial_features', (num_images, num_fixed_boxes, 6), 'f')
         indices = {'image_id_to_ix': {}, 'image_ix_to_id': {}}
 
-    counter = 0
     print("num_images: {}".format(num_images))
 
-    for image_ix in tqdm(iter(range(num_images))):
-        total_tic = time.time()
+    feat_cache = None
+    if args.base_feat_cache is not None:
+        feat_cache = BaseFeatCache(args.base_feat_cache, cache_namespace(load_name, cfg),
+                                   int(args.base_feat_cache_gb * 2 ** 30))
 
+    def prepare_image(image_ix):
         im_file = os.path.join(args.image_dir, image_files[image_ix])
-        img_id = image_ids[image_ix]
-        if not printed:
-            print("im_id: {}".format(img_id))
-
-        im_in = np.array(imread(im_file, mode='RGB'))
-        height, width = im_in.shape[0], im_in.shape[1]
-        if len(im_in.shape) == 2:
-            im_in = im_in[:, :, np.newaxis]
-            im_in = np.concatenate((im_in, im_in, im_in), axis=2)
-        # rgb -> bgr
-        im = im_in[:, :, ::-1]
-
+        im = load_image(im_file)
         blobs, im_scales = _get_image_blob(im)
-        im_blob = blobs
+        if feat_cache is None:
+            return image_ix, blobs, None, None
+        image_hash = file_hash(im_file)
+        return image_ix, blobs, image_hash, feat_cache.get(image_hash)
+
+    # decode/resize on a pool of threads and run the backbone on this thread
+    prefetcher = OrderedPrefetcher(prepare_image, range(num_images), num_workers=args.num_workers,
+                                   max_pending=args.prefetch)
+
+    for image_ix, im_blob, image_hash, cached_feats in tqdm(prefetcher, total=num_images):
+        if cached_feats is not None:
+            continue
         im_data_pt = torch.from_numpy(im_blob)
+        im_data_pt = im_data_pt.permute(0, 3, 1, 2)
         im_data.data.resize_(im_data_pt.size()).copy_(im_data_pt)
-        det_tic = time.time()
-        im_data = im_data.permute(0, 3, 1, 2)
         feats = fasterRCNN.extract_base_feat(im_data)
+        if feat_cache is not None:
+            feat_cache.put(image_hash, feats.data.cpu().numpy())
+
+    elapsed = time.time() - start
+    print('Extracted {} images in {:.1f}s ({:.2f} images/sec)'.format(num_images, elapsed, num_images / elapsed))
+    print(pipeline_report(prefetcher, None, elapsed))
+    if feat_cache is not None:
+        print(feat_cache.summary())
+
+    if not args.visualize_only:
+        h5_file.close()
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 
-"""Generate bottom-up attention features as a tsv file. Can use multiple gpus, each produces a 
-   separate tsv file that can be merged later (e.g. by using merge_tsv function). 
-   Modify the load_image_ids script as necessary for your data location. """
+"""Generate bottom-up attention features as a binary record file (or a tsv file with --format tsv).
+   Can use multiple gpus, each produces a separate file that can be merged later (e.g. by using
+   merge_tsvs function or --merge). Modify the load_image_ids script as necessary for your data location. """
 
 # Example:
 # ./tools/generate_tsv.py --gpu 0,1,2,3,4,5,6,7 --cfg experiments/cfgs/faster_rcnn_end2end_resnet.yml --def models/vg/ResNet-101/faster_rcnn_end2end/test.prototxt --out test2014_resnet101_faster_rcnn_genome.tsv --net data/faster_rcnn_models/resnet101_faster_rcnn_final.caffemodel --split coco_test2014
@@ -14,6 +14,7 @@ from fast_rcnn.config import cfg, cfg_from_file
 from fast_rcnn.test import im_detect, _get_blobs
 from fast_rcnn.nms_wrapper import nms
 from utils.timer import Timer
+from feature_store.region_records import RegionRecordWriter, merge_records
 
 import caffe
 import argparse
@@ -145,11 +146,18 @@ def get_detections_from_im(net, im_file, image_id, conf_thresh=0.2):
         'image_h': np.size(im, 0),
         'image_w': np.size(im, 1),
         'num_boxes': len(keep_boxes),
-        'boxes': base64.b64encode(cls_boxes[keep_boxes]),
-        'features': base64.b64encode(pool5[keep_boxes])
+        'boxes': cls_boxes[keep_boxes],
+        'features': pool5[keep_boxes]
     }
 
 
+def encode_tsv_row(item):
+    item = dict(item)
+    item['boxes'] = base64.b64encode(item['boxes'])
+    item['features'] = base64.b64encode(item['features'])
+    return item
+
+
 def parse_args():
     """
     Parse input arguments
@@ -179,6 +187,10 @@ def parse_args():
                         help='Directory containing the data', default=None)
     parser.add_argument('--min_boxes', help='Minimum # of boxes to extract features', type=int)
     parser.add_argument('--max_boxes', help='Maximum # of boxes to extract features', type=int)
+    parser.add_argument('--format', choices=['records', 'tsv'], default='records',
+                        help='binary region records (see lib/feature_store/region_records.py) or base64 tsv')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge the per-gpu files into --out once all of them are done')
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -188,11 +200,14 @@ def parse_args():
     return args
 
 
-def generate_tsv(gpu_id, prototxt, weights, image_ids, outfile):
+def generate_tsv(gpu_id, prototxt, weights, image_ids, outfile, format='records'):
     # First check if file exists, and if it is complete
     wanted_ids = set([int(image_id[1]) for image_id in image_ids])
     found_ids = set()
-    if os.path.exists(outfile):
+    if format == 'records':
+        writer = RegionRecordWriter(outfile, mode='a')
+        found_ids = set(writer.image_ids)
+    elif os.path.exists(outfile):
         with open(outfile) as tsvfile:
             reader = csv.DictReader(tsvfile, delimiter='\t', fieldnames=FIELDNAMES)
             for item in reader:
@@ -206,28 +221,43 @@ def generate_tsv(gpu_id, prototxt, weights, image_ids, outfile):
         caffe.set_mode_gpu()
         caffe.set_device(gpu_id)
         net = caffe.Net(prototxt, caffe.TEST, weights=weights)
-        with open(outfile, 'a') as tsvfile:
-            writer = csv.DictWriter(tsvfile, delimiter='\t', fieldnames=FIELDNAMES)
-            _t = {'misc': Timer()}
-            count = 0
-            for im_file, image_id in image_ids:
-                if int(image_id) in missing:
-                    _t['misc'].tic()
-                    writer.writerow(get_detections_from_im(net, im_file, image_id))
-                    _t['misc'].toc()
-                    if (count % 100) == 0:
-                        print ('GPU {:d}: {:d}/{:d} {:.3f}s (projected finish: {:.2f} hours)'.format(gpu_id, count + 1, len(missing), _t['misc'].average_time,_t['misc'].average_time * (len(missing) - count) / 3600))
-                    count += 1
-
-
-def merge_tsvs():
-    test = ['/work/data/tsv/test2015/resnet101_faster_rcnn_final_test.tsv.%d' % i for i in range(8)]
-
-    outfile = '/work/data/tsv/merged.tsv'
+        tsvfile = None
+        if format == 'tsv':
+            tsvfile = open(outfile, 'a')
+            tsv_writer = csv.DictWriter(tsvfile, delimiter='\t', fieldnames=FIELDNAMES)
+        _t = {'misc': Timer()}
+        count = 0
+        for im_file, image_id in image_ids:
+            if int(image_id) in missing:
+                _t['misc'].tic()
+                item = get_detections_from_im(net, im_file, image_id)
+                if format == 'records':
+                    writer.write(item['image_id'], item['image_w'], item['image_h'], item['boxes'], item['features'])
+                else:
+                    tsv_writer.writerow(encode_tsv_row(item))
+                _t['misc'].toc()
+                if (count % 100) == 0:
+                    if format == 'records':
+                        writer.flush()
+                    print ('GPU {:d}: {:d}/{:d} {:.3f}s (projected finish: {:.2f} hours)'.format(gpu_id, count + 1, len(missing), _t['misc'].average_time,_t['misc'].average_time * (len(missing) - count) / 3600))
+                count += 1
+        if tsvfile is not None:
+            tsvfile.close()
+    if format == 'records':
+        writer.close()
+
+
+def merge_tsvs(infiles, outfile, format='records'):
+    """Merges the per-gpu files. Record files are merged by concatenating their data and offset indexes,
+    without decoding any row; tsv files are still re-parsed row by row."""
+    if format == 'records':
+        merge_records(infiles, outfile)
+        return
+
     with open(outfile, 'a') as tsvfile:
         writer = csv.DictWriter(tsvfile, delimiter='\t', fieldnames=FIELDNAMES)
 
-        for infile in test:
+        for infile in infiles:
             with open(infile) as tsv_in_file:
                 reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames=FIELDNAMES)
                 for item in reader:
@@ -267,12 +297,15 @@ if __name__ == '__main__':
     caffe.log('Using devices %s' % str(gpus))
     procs = []
 
+    outfiles = ['%s.%d' % (args.outfile, gpu_id) for gpu_id in gpus]
     for i, gpu_id in enumerate(gpus):
-        outfile = '%s.%d' % (args.outfile, gpu_id)
         p = Process(target=generate_tsv,
-                    args=(gpu_id, args.prototxt, args.caffemodel, image_ids[i], outfile))
+                    args=(gpu_id, args.prototxt, args.caffemodel, image_ids[i], outfiles[i], args.format))
         p.daemon = True
         p.start()
         procs.append(p)
     for p in procs:
         p.join()
+
+    if args.merge:
+        merge_tsvs(outfiles, args.outfile, args.format)
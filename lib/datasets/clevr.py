@@ -20,6 +20,7 @@ from .vg_eval import vg_eval
 from model.utils.config import cfg
 import pickle
 import pdb
+import time
 
 try:
     xrange  # Python 2
@@ -30,6 +31,9 @@ ROOT = '/hdd/robik'
 DATASET = 'CLEVR'
 DATA_ROOT = os.path.join(ROOT, DATASET)
 FASTER_RCNN_ROOT = os.path.join(DATA_ROOT, 'faster-rcnn')
+# the size every CLEVR image is rendered at
+CLEVR_WIDTH = 480
+CLEVR_HEIGHT = 320
 
 
 class clevr(imdb):
@@ -85,85 +89,54 @@ class clevr(imdb):
             os.makedirs(cache_path)
         return cache_path
 
-    def gt_roidb(self):
+    def image_sizes(self):
         """
-        Return the database of ground-truth regions of interest.
-
-        This function loads/saves from/to a cache file to speed up future calls.
+        Every CLEVR image is rendered at 480x320, the files are not opened.
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            fid = gzip.open(cache_file, 'rb')
-            roidb = pickle.load(fid)
-            fid.close()
-            print('{} gt roidb loaded from {}'.format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_clevr_annotation(index)
-                    for index in self.image_index]
-        fid = gzip.open(cache_file, 'wb')
-        pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        fid.close()
-        print('wrote gt roidb to {}'.format(cache_file))
-        return gt_roidb
-
-    def _get_size(self, index):
-        return PIL.Image.open(self.image_path_from_index(index)).size
-
-    def _annotation_path(self, index):
-        return os.path.join(self._data_path, 'xml', self._image_set,
-                            self.clevr_index_to_filename(index, self._image_set, '.xml'))
+        return [(CLEVR_WIDTH, CLEVR_HEIGHT)] * self.num_images
 
-    def _load_clevr_annotation(self, index):
-        """
-        Load image and bounding boxes info from XML file in the PASCAL VOC
-        format.
+    def gt_roidb(self):
         """
-        width, height = self._get_size(index)
-        filename = self._annotation_path(index)
-        tree = ET.parse(filename)
-        objs = tree.findall('object')
-        num_objs = len(objs)
+        Return the database of ground-truth regions of interest.
 
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
+        The roidb is built from the boxes of {split}_scenes_with_bb.json loaded by __init__, for all
+        images at once: the objects of every image are concatenated into single arrays, which are split
+        back into per-image views. This takes a few seconds for the train split, less than reading a
+        pickled roidb, so nothing is cached.
+        """
+        tic = time.time()
+        counts = np.array([len(ann['objects']) for ann in self.annotations], dtype=np.int64)
+        objects = [obj for ann in self.annotations for obj in ann['objects']]
+        num_objs = len(objects)
+
+        coords = np.array([(obj['xmin'], obj['ymin'], obj['xmax'], obj['ymax']) for obj in objects],
+                          dtype=np.float32).reshape(num_objs, 4)
+        labels = np.array([obj['label_id'] for obj in objects], dtype=np.int32)
+        boxes = coords.astype(np.uint16)
         # "Seg" area for pascal is just the box area
-        seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-        # Load object bounding boxes into a data frame.
-        obj_dict = {}
-        ix = 0
-        for obj in objs:
-            obj_name = obj.find('name').text.lower().strip()
-            bbox = obj.find('bndbox')
-            x1 = float(bbox.find('xmin').text)
-            y1 = float(bbox.find('ymin').text)
-            x2 = float(bbox.find('xmax').text)
-            y2 = float(bbox.find('ymax').text)
-            cls = self._class_to_ind[obj_name]
-            obj_dict[obj.find('object_id').text] = ix
-            boxes[ix, :] = [x1, y1, x2, y2]
-            gt_classes[ix] = cls
-            overlaps[ix, cls] = 1.0
-            seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
-            ix += 1
-        # clip gt_classes and gt_relations
-        #gt_classes = gt_classes[:ix] # WTF?
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-
-        # gt_relations, gt_attributes
-        return {'boxes': boxes,
-                'gt_classes': gt_classes,
-                'gt_overlaps': overlaps,
-                'width': width,
-                'height': height,
-                'flipped': False,
-                'seg_areas': seg_areas}
+        seg_areas = (coords[:, 2] - coords[:, 0] + 1) * (coords[:, 3] - coords[:, 1] + 1)
+        # one row per object with a 1 in the column of its class
+        overlaps = scipy.sparse.csr_matrix((np.ones(num_objs, dtype=np.float32), labels,
+                                            np.arange(num_objs + 1)), shape=(num_objs, self.num_classes))
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        gt_roidb = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            gt_roidb.append({'boxes': boxes[start:end],
+                             'gt_classes': labels[start:end],
+                             'gt_overlaps': overlaps[start:end],
+                             'width': CLEVR_WIDTH,
+                             'height': CLEVR_HEIGHT,
+                             'flipped': False,
+                             'seg_areas': seg_areas[start:end]})
+        print('{} gt roidb: {} images, {} objects in {:.1f}s'.format(self.name, len(gt_roidb), num_objs,
+                                                                    time.time() - tic))
+        return gt_roidb
 
     def evaluate_detections(self, all_boxes, output_dir):
         self._write_voc_results_file(self.classes, all_boxes, output_dir)
-        self._do_python_eval(output_dir)
+        return self._do_python_eval(output_dir)
 
     def _get_vg_results_file_template(self, output_dir):
         filename = 'detections_' + self._image_set + '_{:s}.txt'
@@ -251,6 +224,7 @@ class clevr(imdb):
         print('--------------------------------------------------------------')
         print('Results computed with the **unofficial** PASCAL VOC Python eval code.')
         print('--------------------------------------------------------------')
+        return np.mean(aps)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Image sizes read from the file headers on a thread pool, with a persistent index per dataset.
+
+prepare_roidb(), append_flipped_images() and the gt roidb loaders of CLEVR and VG need the width and
+height of every image. PIL.Image.open() only parses the header, so the time goes into opening the
+files, which on a network filesystem is mostly latency: the files are stat'ed and probed on
+num_workers threads. ImageSizeIndex keeps the sizes in a pickle next to the other caches of the
+dataset, keyed by path and modification time, so later runs only stat the files and probe the ones
+that are new or changed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+import time
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+
+NUM_WORKERS = 16
+
+
+def probe_size(path):
+    """(width, height) of the image at path, from its header."""
+    with open(path, 'rb') as f:
+        return Image.open(f).size
+
+
+class ImageSizeIndex(object):
+    """The sizes of the images of a dataset, persisted in cache_file as {path: (mtime, width, height)}."""
+
+    def __init__(self, cache_file, num_workers=NUM_WORKERS):
+        self.cache_file = cache_file
+        self.num_workers = num_workers
+        self._sizes = {}
+        # paths already checked against their mtime by this process
+        self._checked = set()
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                self._sizes = pickle.load(f)
+
+    def _lookup(self, path):
+        mtime = os.stat(path).st_mtime
+        cached = self._sizes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached, False
+        width, height = probe_size(path)
+        return (mtime, width, height), True
+
+    def save(self):
+        # written to a temporary file first, a run killed while saving leaves the previous index intact
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self._sizes, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.cache_file)
+
+    def sizes(self, paths):
+        """(width, height) of every image of paths; saves the index if any image had to be probed."""
+        tic = time.time()
+        unique = sorted(set(paths) - self._checked)
+        if self.num_workers > 1 and len(unique) > 1:
+            pool = ThreadPool(self.num_workers)
+            try:
+                results = pool.map(self._lookup, unique, chunksize=64)
+            finally:
+                pool.close()
+        else:
+            results = [self._lookup(path) for path in unique]
+
+        num_probed = 0
+        for path, (entry, probed) in zip(unique, results):
+            self._sizes[path] = entry
+            num_probed += probed
+        self._checked.update(unique)
+        if num_probed > 0:
+            self.save()
+        if unique:
+            print('image sizes of {} files: {} probed, {} from {} in {:.1f}s'.format(
+                len(unique), num_probed, len(unique) - num_probed, self.cache_file, time.time() - tic))
+        return [self._sizes[path][1:] for path in paths]
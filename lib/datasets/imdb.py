@@ -12,6 +12,7 @@ import os
 import os.path as osp
 import PIL
 from model.utils.cython_bbox import bbox_overlaps
+from datasets.image_sizes import ImageSizeIndex
 import numpy as np
 import scipy.sparse
 from lib.model.utils.config import cfg
@@ -33,6 +34,8 @@ class imdb(object):
     self._obj_proposer = 'gt'
     self._roidb = None
     self._roidb_handler = self.default_roidb
+    self._size_index = None
+    self._image_sizes = None
     # Use this dict for storing dataset specific config options
     self.config = {}
 
@@ -107,9 +110,20 @@ class imdb(object):
     """
     raise NotImplementedError
 
+  def probe_image_sizes(self, paths):
+    """(width, height) of every image of paths, from the size index of this dataset."""
+    if self._size_index is None:
+      self._size_index = ImageSizeIndex(osp.join(self.cache_path, self.name + '_image_sizes.pkl'))
+    return self._size_index.sizes(paths)
+
+  def image_sizes(self):
+    """(width, height) of image_path_at(i) for every image, probed once per imdb."""
+    if self._image_sizes is None or len(self._image_sizes) != self.num_images:
+      self._image_sizes = self.probe_image_sizes([self.image_path_at(i) for i in range(self.num_images)])
+    return self._image_sizes
+
   def _get_widths(self):
-    return [PIL.Image.open(self.image_path_at(i)).size[0]
-            for i in range(self.num_images)]
+    return [size[0] for size in self.image_sizes()]
 
   def append_flipped_images(self):
     num_images = self.num_images
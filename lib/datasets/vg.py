@@ -187,6 +187,8 @@ class vg(imdb):
             print('{} gt roidb loaded from {}'.format(self.name, cache_file))
             return roidb
 
+        sizes = self.probe_image_sizes([self.image_path_from_index(index) for index in self.image_index])
+        self._index_sizes = dict(zip(self.image_index, sizes))
         gt_roidb = [self._load_vg_annotation(index)
                     for index in self.image_index]
         fid = gzip.open(cache_file,'wb')
@@ -196,7 +198,8 @@ class vg(imdb):
         return gt_roidb
 
     def _get_size(self, index):
-      return PIL.Image.open(self.image_path_from_index(index)).size
+      # probed for all images by gt_roidb()
+      return self._index_sizes[index]
 
     def _annotation_path(self, index):
         return os.path.join(self._data_path, 'xml', str(index) + '.xml')
@@ -291,13 +294,14 @@ class vg(imdb):
 
     def evaluate_detections(self, all_boxes, output_dir):
         self._write_voc_results_file(self.classes, all_boxes, output_dir)
-        self._do_python_eval(output_dir)
+        mean_ap = self._do_python_eval(output_dir)
         if self.config['cleanup']:
             for cls in self._classes:
                 if cls == '__background__':
                     continue
                 filename = self._get_vg_results_file_template(output_dir).format(cls)
                 os.remove(filename)
+        return mean_ap
 
     def evaluate_attributes(self, all_boxes, output_dir):
         self._write_voc_results_file(self.attributes, all_boxes, output_dir)
@@ -399,6 +403,7 @@ class vg(imdb):
         print('--------------------------------------------------------------')
         print('Results computed with the **unofficial** PASCAL VOC Python eval code.')
         print('--------------------------------------------------------------')
+        return np.mean(aps)
 
 
 if __name__ == '__main__':
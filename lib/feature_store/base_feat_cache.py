@@ -0,0 +1,134 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""On-disk cache of backbone (RCNN_base) feature maps.
+
+An entry is keyed by the hash of the image file together with a namespace derived from the checkpoint,
+the preprocessing settings (test scales, max size and pixel means) and the precision of the backbone, so
+re-extracting the same images with other ROIs, box counts or heads can skip the backbone while any change
+of weights, input preprocessing or backbone precision misses the cache. Feature maps are stored as
+float16 .npy files. The total size is capped: when it is exceeded the least recently used entries (by
+file modification time, refreshed on every hit) are evicted.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+def file_hash(filename, block_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_namespace(checkpoint_file, cfg, precision='float32'):
+    """Identifies the checkpoint, preprocessing and backbone precision that the cached feature maps
+    depend on."""
+    sha1 = hashlib.sha1(file_hash(checkpoint_file).encode('utf-8'))
+    sha1.update(repr((list(cfg.TEST.SCALES), cfg.TEST.MAX_SIZE,
+                      np.asarray(cfg.PIXEL_MEANS).ravel().tolist())).encode('utf-8'))
+    if cfg.IMAGE_DECODER != 'scipy':
+        # other decoders can give slightly different pixels, the namespaces of older caches are kept
+        sha1.update(cfg.IMAGE_DECODER.encode('utf-8'))
+    if cfg.INPUT_UINT8:
+        # resizing in uint8 rounds the pixels
+        sha1.update(b'uint8')
+    if precision != 'float32':
+        # a reduced precision backbone computes different maps, float32 keeps the namespaces of older caches
+        sha1.update(precision.encode('utf-8'))
+    return sha1.hexdigest()[:16]
+
+
+class BaseFeatCache(object):
+    """Stores one feature map per image hash under cache_dir/namespace, at most max_bytes in total.
+
+    get() may be called from several threads (e.g. the decode workers); put() from one.
+    """
+
+    def __init__(self, cache_dir, namespace, max_bytes, dtype=np.float16):
+        self.dir = os.path.join(cache_dir, namespace)
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        # the cap applies to every namespace together, so account for the whole cache directory
+        self.cache_dir = cache_dir
+        self._bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, image_hash):
+        return os.path.join(self.dir, image_hash + '.npy')
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # evicted by another process
+                    entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def get(self, image_hash):
+        """Returns the cached float32 feature map of an image, or None."""
+        path = self._path(image_hash)
+        try:
+            feat = np.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            feat = None
+        with self._lock:
+            if feat is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if feat is None else feat.astype(np.float32)
+
+    def put(self, image_hash, feat):
+        path = self._path(image_hash)
+        # unique per writer, two processes (or threads) caching the same image must not share a temporary file
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(feat, dtype=self.dtype))
+        os.rename(tmp_path, path)
+        with self._lock:
+            self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # evict down to 90% of the cap, so that the directory scan is amortized over many puts
+        entries = sorted(self._entries())
+        self._bytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._bytes -= size
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def summary(self):
+        return 'base_feat cache: {} hits, {} misses ({:.1%} hit rate), {:.1f} of {:.1f} GB used'.format(
+            self.hits, self.misses, self.hit_rate(), self._bytes / 2 ** 30, self.max_bytes / 2 ** 30)
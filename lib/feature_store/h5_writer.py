@@ -0,0 +1,170 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""HDF5 layout options and a buffered row writer for per-image feature datasets.
+
+Feature datasets are indexed by image row along the first axis. They can be stored contiguously
+(the historical layout) or in chunks of a few rows, optionally compressed with gzip/lzf and/or
+stored as float16. BufferedRowWriter collects the rows of several images and writes each run of
+consecutive rows with a single slab assignment instead of one small write per image.
+
+With a variable number of boxes per image the ragged layout is used instead: the boxes of all images are
+appended to flat (num_boxes, ...) datasets and image_offsets/image_num_boxes give the first box and the
+box count of every image row. RaggedRowWriter appends the boxes of several images with one write.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+DTYPES = {'float32': np.float32, 'float16': np.float16}
+COMPRESSIONS = ['none', 'gzip', 'lzf']
+
+# per-image index datasets of the ragged layout
+RAGGED_OFFSETS = 'image_offsets'
+RAGGED_COUNTS = 'image_num_boxes'
+RAGGED_CHUNK_BOXES = 256
+
+
+def dataset_options(dtype='float32', compression='none', compression_level=4, chunk_rows=0):
+    """Returns the keyword arguments of h5py create_dataset() for a feature layout.
+
+    chunk_rows=0 keeps a contiguous dataset, which h5py only allows without compression; compressed
+    layouts default to chunks of 32 rows.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {}, expected one of {}'.format(compression, COMPRESSIONS))
+    options = {'dtype': DTYPES[dtype]}
+    if compression != 'none':
+        options['compression'] = compression
+        if compression == 'gzip':
+            options['compression_opts'] = compression_level
+        if chunk_rows <= 0:
+            chunk_rows = 32
+    if chunk_rows > 0:
+        options['chunk_rows'] = chunk_rows
+    return options
+
+
+def create_feature_dataset(h5_file, name, shape, dtype='float32', compression='none', compression_level=4,
+                           chunk_rows=0):
+    """Creates a dataset of per-image rows with chunks of chunk_rows full rows."""
+    options = dataset_options(dtype, compression, compression_level, chunk_rows)
+    chunk_rows = options.pop('chunk_rows', 0)
+    if chunk_rows > 0:
+        options['chunks'] = (max(min(chunk_rows, shape[0]), 1),) + tuple(shape[1:])
+    return h5_file.create_dataset(name, shape, **options)
+
+
+def create_ragged_dataset(h5_file, name, item_shape, dtype='float32', compression='none', compression_level=4,
+                          chunk_boxes=RAGGED_CHUNK_BOXES):
+    """Creates an empty, growable (num_boxes,) + item_shape dataset of the ragged layout."""
+    options = dataset_options(dtype, compression, compression_level)
+    options.pop('chunk_rows', None)
+    return h5_file.create_dataset(name, (0,) + tuple(item_shape), maxshape=(None,) + tuple(item_shape),
+                                  chunks=(chunk_boxes,) + tuple(item_shape), **options)
+
+
+def create_ragged_index(h5_file, num_images):
+    """Creates the offset and box count datasets of the ragged layout, -1 marks rows not written yet."""
+    offsets = h5_file.create_dataset(RAGGED_OFFSETS, (num_images,), dtype=np.int64, fillvalue=-1)
+    counts = h5_file.create_dataset(RAGGED_COUNTS, (num_images,), dtype=np.int32, fillvalue=0)
+    return offsets, counts
+
+
+def consecutive_runs(rows):
+    """Splits sorted row numbers into (start, end) runs of consecutive rows."""
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] == row:
+            runs[-1][1] = row + 1
+        else:
+            runs.append([row, row + 1])
+    return [tuple(run) for run in runs]
+
+
+class BufferedRowWriter(object):
+    """Buffers the rows of several datasets and writes them in slabs.
+
+    write() takes one value per dataset for a row. Once buffer_rows rows are buffered they are sorted
+    and every run of consecutive rows is written with one assignment per dataset. write() and flush()
+    return the rows that reached the datasets, so callers can journal them.
+    """
+
+    def __init__(self, datasets, buffer_rows=32):
+        self.datasets = datasets
+        self.buffer_rows = max(buffer_rows, 1)
+        self._buffer = {}
+        self.num_slab_writes = 0
+
+    def write(self, row, *values):
+        assert len(values) == len(self.datasets), 'One value per dataset is required'
+        self._buffer[row] = values
+        if len(self._buffer) >= self.buffer_rows:
+            return self.flush()
+        return []
+
+    def flush(self):
+        rows = sorted(self._buffer)
+        for start, end in consecutive_runs(rows):
+            for i, dataset in enumerate(self.datasets):
+                slab = np.stack([self._buffer[row][i] for row in range(start, end)])
+                dataset[start:end] = slab.astype(dataset.dtype, copy=False)
+            self.num_slab_writes += 1
+        self._buffer = {}
+        return rows
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+class RaggedRowWriter(object):
+    """Buffers the boxes of several images and appends them to the flat datasets of the ragged layout.
+
+    write() takes one (num_boxes, ...) value per flat dataset for a row. Like BufferedRowWriter, write()
+    and flush() return the rows that reached the datasets. Boxes are appended after everything already
+    in the datasets, so resuming a partially written file only leaves unreferenced boxes behind.
+    """
+
+    def __init__(self, datasets, offsets, counts, buffer_rows=32):
+        self.datasets = datasets
+        self.offsets = offsets
+        self.counts = counts
+        self.buffer_rows = max(buffer_rows, 1)
+        self._buffer = []
+        self.num_slab_writes = 0
+
+    def write(self, row, *values):
+        assert len(values) == len(self.datasets), 'One value per dataset is required'
+        self._buffer.append((row, values))
+        if len(self._buffer) >= self.buffer_rows:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self._buffer:
+            return []
+        num_boxes = np.array([len(values[0]) for _, values in self._buffer], dtype=np.int64)
+        start = self.datasets[0].shape[0]
+        end = start + int(num_boxes.sum())
+        for i, dataset in enumerate(self.datasets):
+            dataset.resize(end, axis=0)
+            slab = np.concatenate([values[i] for _, values in self._buffer])
+            dataset[start:end] = slab.astype(dataset.dtype, copy=False)
+        self.num_slab_writes += 1
+
+        rows = np.array([row for row, _ in self._buffer], dtype=np.int64)
+        offsets = start + np.cumsum(num_boxes) - num_boxes
+        # h5py point selections must be increasing
+        order = np.argsort(rows)
+        self.offsets[rows[order].tolist()] = offsets[order]
+        self.counts[rows[order].tolist()] = num_boxes[order]
+        self._buffer = []
+        return sorted(rows.tolist())
+
+    def __len__(self):
+        return len(self._buffer)
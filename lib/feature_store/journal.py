@@ -0,0 +1,92 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Append-only completion journal for resumable feature extraction.
+
+Every line of the journal records one output row that has been completely written, as a JSON list
+[row, image_id]. Rows are first written to the feature file, the feature file is flushed and only then
+are the rows appended to the journal and fsync'ed, so after a crash the journal never lists a row
+whose features are missing. A line torn by a crash is dropped when the journal is reopened.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+from collections import OrderedDict
+
+
+class CompletionJournal(object):
+    def __init__(self, path, resume=False):
+        self.path = path
+        # row -> image id of every committed row
+        self.completed = OrderedDict()
+        self._pending = []
+        if resume and os.path.exists(path):
+            self._load()
+            mode = 'a'
+        else:
+            mode = 'w'
+        self._file = open(path, mode)
+
+    def _load(self):
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    row, image_id = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self.completed[row] = image_id
+                valid_bytes += len(line)
+        if valid_bytes != os.path.getsize(self.path):
+            print('Dropping a torn record at the end of {}'.format(self.path))
+            with open(self.path, 'ab') as f:
+                f.truncate(valid_bytes)
+
+    def __contains__(self, row):
+        return row in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def record(self, row, image_id):
+        """Marks a row as written; it becomes durable at the next commit()."""
+        self._pending.append((row, image_id))
+
+    def commit(self):
+        """Durably appends the recorded rows. Flush the feature file before calling this."""
+        if not self._pending:
+            return
+        self._file.write(''.join(json.dumps([row, image_id]) + '\n' for row, image_id in self._pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for row, image_id in self._pending:
+            self.completed[row] = image_id
+        self._pending = []
+
+    def indices(self):
+        """Builds the image_id_to_ix / image_ix_to_id maps of all committed rows."""
+        indices = {'image_id_to_ix': {}, 'image_ix_to_id': {}}
+        for row, image_id in self.completed.items():
+            indices['image_id_to_ix'][image_id] = row
+            indices['image_ix_to_id'][row] = image_id
+        return indices
+
+    def close(self):
+        self.commit()
+        self._file.close()
+
+
+def write_ids_map(indices, filename):
+    """Writes the id map through a temporary file so that a crash never leaves a truncated map."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(indices, f)
+    os.rename(tmp_filename, filename)
@@ -0,0 +1,232 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Random-access reader for the feature files written by extract_features.py.
+
+FeatureStore translates image ids to rows with a sorted array instead of the JSON dict of
+{split}_ids_map.json and reads the rows of a whole batch at once:
+
+  - contiguous uncompressed datasets are memory-mapped, so reads go straight to the page cache of the OS;
+  - chunked (e.g. compressed) datasets are read a chunk at a time through an LRU cache of decoded chunks.
+
+Files in the ragged layout (extract_features.py --adaptive_boxes) are read with get_ragged(), which
+returns the boxes of a batch padded to its largest box count together with the counts.
+
+The file is opened lazily and reopened after a fork, so a store created before a DataLoader starts its
+workers opens the file once per worker process instead of once per item.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from feature_store.h5_writer import RAGGED_OFFSETS, RAGGED_COUNTS
+
+
+def default_ids_map_filename(h5_filename):
+    """{dir}/{split}.hdf5 -> {dir}/{split}_ids_map.json"""
+    return os.path.splitext(h5_filename)[0] + '_ids_map.json'
+
+
+class IdIndex(object):
+    """Maps image ids to rows with a binary search over the sorted ids."""
+
+    def __init__(self, image_id_to_ix):
+        keys = list(image_id_to_ix.keys())
+        # JSON turns the integer ids of COCO/CLEVR into strings
+        try:
+            ids = np.array([int(key) for key in keys], dtype=np.int64)
+        except ValueError:
+            # object arrays, a fixed width unicode dtype would truncate longer ids looked up later
+            ids = np.array(keys, dtype=object)
+        rows = np.array([image_id_to_ix[key] for key in keys], dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        self.rows = rows[order]
+
+    @classmethod
+    def from_file(cls, ids_map_filename):
+        with open(ids_map_filename) as f:
+            return cls(json.load(f)['image_id_to_ix'])
+
+    def lookup(self, image_ids):
+        """Returns the rows of a sequence of image ids, raising KeyError for unknown ids."""
+        if self.ids.dtype == object:
+            image_ids = np.array([str(image_id) for image_id in image_ids], dtype=object)
+        else:
+            image_ids = np.asarray(image_ids, dtype=self.ids.dtype)
+        if len(self.ids) == 0:
+            if len(image_ids):
+                raise KeyError('Unknown image ids: {}'.format(image_ids[:10].tolist()))
+            return np.zeros(0, dtype=np.int64)
+        pos = np.searchsorted(self.ids, image_ids)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        found = self.ids[pos] == image_ids
+        if not found.all():
+            raise KeyError('Unknown image ids: {}'.format(image_ids[~found][:10].tolist()))
+        return self.rows[pos]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ChunkCache(object):
+    """LRU cache of decoded dataset chunks, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._chunks = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        chunk = self._chunks.pop(key, None)
+        if chunk is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            chunk = load()
+            self._bytes += chunk.nbytes
+        self._chunks[key] = chunk
+        while self._bytes > self.max_bytes and len(self._chunks) > 1:
+            _, evicted = self._chunks.popitem(last=False)
+            self._bytes -= evicted.nbytes
+        return chunk
+
+    def clear(self):
+        self._chunks = OrderedDict()
+        self._bytes = 0
+
+
+class FeatureStore(object):
+    """Batched lookup of per-image features by image id.
+
+    get(image_ids) returns one array per dataset name, with the rows of the given ids in the given
+    order. dtype optionally converts the stored values (e.g. float16 files to float32).
+    """
+
+    def __init__(self, h5_filename, ids_map_filename=None, names=('image_features', 'spatial_features'),
+                 cache_bytes=256 * 2 ** 20, use_mmap=True, dtype=None):
+        self.h5_filename = h5_filename
+        self.names = tuple(names)
+        self.use_mmap = use_mmap
+        self.dtype = dtype
+        self.index = IdIndex.from_file(ids_map_filename or default_ids_map_filename(h5_filename))
+        self.cache = ChunkCache(cache_bytes)
+        self._pid = None
+        self._file = None
+        self._readers = {}
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        # a handle inherited through fork() cannot be shared with the parent, open our own
+        self._file = h5py.File(self.h5_filename, 'r')
+        self._readers = {}
+        self.cache.clear()
+        self.ragged = RAGGED_OFFSETS in self._file
+        if self.ragged:
+            self._offsets = self._file[RAGGED_OFFSETS][:]
+            self._counts = self._file[RAGGED_COUNTS][:]
+        for name in self.names:
+            self._readers[name] = self._make_reader(self._file[name])
+        self._pid = os.getpid()
+
+    def _make_reader(self, dataset):
+        if dataset.chunks is None:
+            offset = dataset.id.get_offset()
+            # the offset is None for datasets that were never written
+            if self.use_mmap and dataset.compression is None and offset is not None:
+                mmap = np.memmap(self.h5_filename, dtype=dataset.dtype, mode='r', offset=offset,
+                                 shape=dataset.shape)
+                return lambda rows: mmap[rows]
+            return lambda rows: self._read_direct(dataset, rows)
+        return lambda rows: self._read_chunked(dataset, rows)
+
+    @staticmethod
+    def _read_direct(dataset, rows):
+        if len(rows) == 0:
+            # e.g. the boxes of a ragged batch whose images have none
+            return np.zeros((0,) + dataset.shape[1:], dtype=dataset.dtype)
+        # h5py only accepts increasing, unique indices
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return dataset[unique_rows.tolist()][inverse]
+
+    def _read_chunked(self, dataset, rows):
+        chunk_rows = dataset.chunks[0]
+        out = np.empty((len(rows),) + dataset.shape[1:], dtype=dataset.dtype)
+        chunk_ixs = rows // chunk_rows
+        for chunk_ix in np.unique(chunk_ixs):
+            start = chunk_ix * chunk_rows
+            chunk = self.cache.get((dataset.name, chunk_ix),
+                                   lambda: dataset[start:min(start + chunk_rows, dataset.shape[0])])
+            selected = chunk_ixs == chunk_ix
+            out[selected] = chunk[rows[selected] - start]
+        return out
+
+    def rows(self, image_ids):
+        return self.index.lookup(image_ids)
+
+    def read_rows(self, rows, names=None):
+        self._open()
+        rows = np.asarray(rows, dtype=np.int64)
+        arrays = []
+        for name in names or self.names:
+            array = self._readers[name](rows)
+            if self.dtype is not None:
+                array = array.astype(self.dtype, copy=False)
+            arrays.append(array)
+        return arrays
+
+    def get(self, image_ids, names=None):
+        self._open()
+        if self.ragged:
+            raise ValueError('{} uses the ragged layout, read it with get_ragged()'.format(self.h5_filename))
+        return self.read_rows(self.rows(image_ids), names)
+
+    def get_ragged(self, image_ids, names=None, pad=True):
+        """Returns (arrays, counts) for a file in the ragged layout.
+
+        With pad=True every array is batch x max count x ..., zero padded after the boxes of each image,
+        otherwise it holds the boxes of all images one after the other.
+        """
+        self._open()
+        if not self.ragged:
+            raise ValueError('{} does not use the ragged layout, read it with get()'.format(self.h5_filename))
+        rows = self.rows(image_ids)
+        starts, counts = self._offsets[rows], self._counts[rows]
+        if len(rows) == 0:
+            empty = (0, 0) if pad else (0,)
+            return [np.zeros(empty + self._file[name].shape[1:], dtype=self.dtype or self._file[name].dtype)
+                    for name in names or self.names], counts
+        box_rows = np.concatenate([np.arange(start, start + count, dtype=np.int64)
+                                   for start, count in zip(starts, counts)])
+        arrays = self.read_rows(box_rows, names)
+        if pad:
+            # boxes are concatenated in row-major order of the padded batch
+            valid = np.arange(counts.max()) < counts[:, None]
+            for i, flat in enumerate(arrays):
+                padded = np.zeros(valid.shape + flat.shape[1:], dtype=flat.dtype)
+                padded[valid] = flat
+                arrays[i] = padded
+        return arrays, counts
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._readers = {}
+        self._pid = None
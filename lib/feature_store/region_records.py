@@ -0,0 +1,270 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Binary record files of per-image region features, replacing the base64 TSV of generate_tsv.py.
+
+A record file {name}.rec is a sequence of records, one per image:
+
+  header   RECORD_HEADER: magic, image_id (int64), image_w, image_h, num_boxes, feature_dim (int32)
+  boxes    num_boxes x 4 little-endian float32
+  features num_boxes x feature_dim little-endian float32
+
+The sidecar {name}.rec.idx holds one (image_id, byte offset) pair per record as little-endian int64, in
+the order the records were written. Both files are append-only, so a writer can stream records and an
+interrupted run can be resumed: records without an index entry, or index entries past the end of the
+data, are dropped when the file is reopened.
+
+RegionRecordReader memory-maps the data file and seeks to a record through the index, so reading an
+image neither scans the file nor decodes base64 and CSV. merge_records() concatenates the data files
+byte for byte and the indexes with shifted offsets, without parsing any record.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import csv
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+RECORD_MAGIC = b'RGN1'
+RECORD_HEADER = struct.Struct('<4sqiiii')
+INDEX_DTYPE = np.dtype([('image_id', '<i8'), ('offset', '<i8')])
+FLOAT_DTYPE = np.dtype('<f4')
+
+TSV_FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def record_size(num_boxes, feature_dim):
+    return RECORD_HEADER.size + FLOAT_DTYPE.itemsize * num_boxes * (4 + feature_dim)
+
+
+def _read_header(buf, offset):
+    magic, image_id, image_w, image_h, num_boxes, feature_dim = RECORD_HEADER.unpack_from(buf, offset)
+    if magic != RECORD_MAGIC:
+        raise IOError('No region record at offset {}'.format(offset))
+    return image_id, image_w, image_h, num_boxes, feature_dim
+
+
+def _load_index(filename):
+    """Reads the valid index entries of a record file, dropping the ones past the end of the data."""
+    idx_filename = index_filename(filename)
+    if not os.path.exists(idx_filename):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    with open(idx_filename, 'rb') as f:
+        raw = f.read()
+    # a partially written last entry is ignored
+    entries = np.frombuffer(raw[:len(raw) - len(raw) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+    data_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if data_size == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    num_valid = len(entries)
+    with open(filename, 'rb') as f:
+        while num_valid > 0:
+            offset = int(entries['offset'][num_valid - 1])
+            f.seek(offset)
+            header = f.read(RECORD_HEADER.size)
+            if len(header) == RECORD_HEADER.size:
+                num_boxes, feature_dim = _read_header(header, 0)[3:]
+                if offset + record_size(num_boxes, feature_dim) <= data_size:
+                    break
+            num_valid -= 1
+    return entries[:num_valid].copy()
+
+
+class RegionRecordWriter(object):
+    """Streams region records to a file. mode='a' resumes a file, keeping the records it already holds."""
+
+    def __init__(self, filename, mode='w'):
+        if mode not in ('w', 'a'):
+            raise ValueError("mode must be 'w' or 'a', got {!r}".format(mode))
+        self.filename = filename
+        entries = np.zeros(0, dtype=INDEX_DTYPE)
+        end = 0
+        if mode == 'a' and os.path.exists(filename):
+            entries = _load_index(filename)
+            if len(entries):
+                with open(filename, 'rb') as f:
+                    f.seek(int(entries['offset'][-1]))
+                    num_boxes, feature_dim = _read_header(f.read(RECORD_HEADER.size), 0)[3:]
+                end = int(entries['offset'][-1]) + record_size(num_boxes, feature_dim)
+        self.image_ids = set(entries['image_id'].tolist())
+        # drop whatever an interrupted run wrote after the last indexed record
+        self._data = open(filename, 'r+b' if end else 'wb')
+        self._data.truncate(end)
+        self._data.seek(end)
+        # the committed index entries are kept on disk, only a torn or dangling tail is cut off, so a
+        # crash before the first flush() leaves the previous index intact
+        idx_filename = index_filename(filename)
+        if mode == 'a' and os.path.exists(idx_filename):
+            self._index = open(idx_filename, 'r+b')
+            self._index.truncate(len(entries) * INDEX_DTYPE.itemsize)
+            self._index.seek(len(entries) * INDEX_DTYPE.itemsize)
+        else:
+            self._index = open(idx_filename, 'wb')
+        self._offset = end
+
+    def write(self, image_id, image_w, image_h, boxes, features):
+        boxes = np.ascontiguousarray(boxes, dtype=FLOAT_DTYPE).reshape(-1, 4)
+        features = np.ascontiguousarray(features, dtype=FLOAT_DTYPE)
+        if features.ndim != 2:
+            features = features.reshape(len(boxes), -1)
+        num_boxes, feature_dim = features.shape
+        self._data.write(RECORD_HEADER.pack(RECORD_MAGIC, int(image_id), int(image_w), int(image_h),
+                                            num_boxes, feature_dim))
+        self._data.write(boxes.tobytes())
+        self._data.write(features.tobytes())
+        self._index.write(np.array([(int(image_id), self._offset)], dtype=INDEX_DTYPE).tobytes())
+        self._offset += record_size(num_boxes, feature_dim)
+        self.image_ids.add(int(image_id))
+
+    def flush(self):
+        # the data goes first, so that the index never points past the end of the data
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        if self._data is None:
+            return
+        self.flush()
+        self._data.close()
+        self._index.close()
+        self._data = self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RegionRecordReader(object):
+    """Random access to the records of a file by image id.
+
+    get(image_id) returns a dict with the TSV fields, where boxes (num_boxes x 4) and features
+    (num_boxes x feature_dim) are read-only views of the memory-mapped file. Like FeatureStore, the file
+    is mapped lazily and again after a fork.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        entries = _load_index(filename)
+        order = np.argsort(entries['image_id'], kind='mergesort')
+        self.ids = entries['image_id'][order]
+        self.offsets = entries['offset'][order]
+        self._written_offsets = entries['offset']
+        self._pid = None
+        self._mmap = None
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        with open(self.filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if len(self.ids) else b''
+        self._pid = os.getpid()
+
+    def _read(self, offset):
+        self._open()
+        image_id, image_w, image_h, num_boxes, feature_dim = _read_header(self._mmap, offset)
+        offset += RECORD_HEADER.size
+        boxes = np.frombuffer(self._mmap, dtype=FLOAT_DTYPE, count=num_boxes * 4, offset=offset)
+        offset += boxes.nbytes
+        features = np.frombuffer(self._mmap, dtype=FLOAT_DTYPE, count=num_boxes * feature_dim, offset=offset)
+        return {'image_id': image_id, 'image_w': image_w, 'image_h': image_h, 'num_boxes': num_boxes,
+                'boxes': boxes.reshape(num_boxes, 4), 'features': features.reshape(num_boxes, feature_dim)}
+
+    def offset(self, image_id):
+        pos = np.searchsorted(self.ids, image_id)
+        if pos == len(self.ids) or self.ids[pos] != image_id:
+            raise KeyError('Unknown image id: {}'.format(image_id))
+        return int(self.offsets[pos])
+
+    def get(self, image_id):
+        return self._read(self.offset(int(image_id)))
+
+    def __contains__(self, image_id):
+        pos = np.searchsorted(self.ids, int(image_id))
+        return pos < len(self.ids) and self.ids[pos] == int(image_id)
+
+    def __iter__(self):
+        """Yields the records in file order, i.e. with sequential reads."""
+        for offset in self._written_offsets:
+            yield self._read(int(offset))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        if self._pid == os.getpid() and isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = None
+        self._pid = None
+
+
+def merge_records(filenames, out_filename, block_size=64 * 2 ** 20):
+    """Concatenates record files and their indexes, copying bytes without parsing the records."""
+    base = 0
+    with open(out_filename, 'wb') as out, open(index_filename(out_filename), 'wb') as out_index:
+        for filename in filenames:
+            entries = _load_index(filename)
+            if not len(entries):
+                continue
+            with open(filename, 'rb') as f:
+                f.seek(int(entries['offset'][-1]))
+                num_boxes, feature_dim = _read_header(f.read(RECORD_HEADER.size), 0)[3:]
+                size = int(entries['offset'][-1]) + record_size(num_boxes, feature_dim)
+                # anything after the last indexed record is an unfinished write
+                f.seek(0)
+                remaining = size
+                while remaining > 0:
+                    block = f.read(min(block_size, remaining))
+                    if not block:
+                        raise IOError('{} is shorter than its index'.format(filename))
+                    out.write(block)
+                    remaining -= len(block)
+            entries['offset'] += base
+            out_index.write(entries.tobytes())
+            base += size
+    return base
+
+
+def decode_tsv_array(encoded, num_boxes, columns=None):
+    """Decodes a base64 field of generate_tsv.py. Boxes were written as float32 or float64 depending on
+    the dtype of the image scale, so the dtype is inferred from the length when columns is given."""
+    raw = base64.b64decode(encoded)
+    if num_boxes == 0:
+        return np.zeros((0, columns or 0), dtype=np.float32)
+    dtype = np.float32
+    if columns is not None and len(raw) == num_boxes * columns * 8:
+        dtype = np.float64
+    return np.frombuffer(raw, dtype=dtype).reshape(num_boxes, -1).astype(np.float32)
+
+
+def convert_tsv(tsv_filenames, out_filename):
+    """Converts TSV files of generate_tsv.py into one record file, returns the number of records."""
+    csv.field_size_limit(sys.maxsize)
+    count = 0
+    with RegionRecordWriter(out_filename) as writer:
+        for tsv_filename in tsv_filenames:
+            with open(tsv_filename) as tsv_file:
+                reader = csv.DictReader(tsv_file, delimiter='\t', fieldnames=TSV_FIELDNAMES)
+                for item in reader:
+                    num_boxes = int(item['num_boxes'])
+                    writer.write(int(item['image_id']), int(item['image_w']), int(item['image_h']),
+                                 decode_tsv_array(item['boxes'], num_boxes, columns=4),
+                                 decode_tsv_array(item['features'], num_boxes))
+                    count += 1
+    return count
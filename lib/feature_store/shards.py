@@ -0,0 +1,125 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Deterministic sharding of the image list and merging of per-shard feature files.
+
+Shard k of N holds the images k, k + N, k + 2N, ... of the sorted image list, like the per-GPU split of
+generate_tsv.py. The assignment only depends on the image list, so a failed shard can be re-run on its
+own, and row r of shard k is row r * N + k of the merged file, which is therefore identical to the
+output of a single-process extraction.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import h5py
+import numpy as np
+
+from feature_store.journal import write_ids_map
+from feature_store.h5_writer import RAGGED_OFFSETS, RAGGED_COUNTS
+
+
+def shard_name(split, shard, num_shards):
+    """Base name of the output files of a shard, the split itself when not sharding."""
+    if num_shards == 1:
+        return split
+    return '{}.shard{}-of-{}'.format(split, shard, num_shards)
+
+
+def shard_items(items, shard, num_shards):
+    """Returns the items assigned to a shard."""
+    if not 0 <= shard < num_shards:
+        raise ValueError('Shard {} does not exist, expected 0 <= shard < {}'.format(shard, num_shards))
+    return items[shard::num_shards]
+
+
+def load_shard_ids(ids_map_filename, shard, num_shards, num_rows):
+    """Reads the image ids of a shard, checking that every row of the shard has been extracted."""
+    with open(ids_map_filename) as f:
+        image_ix_to_id = json.load(f)['image_ix_to_id']
+    missing = [row for row in range(num_rows) if str(row) not in image_ix_to_id]
+    if missing:
+        raise ValueError('Shard {} of {} is incomplete ({} of {} images missing), re-run it with --shards {}'.format(
+            shard, num_shards, len(missing), num_rows, shard))
+    return [image_ix_to_id[str(row)] for row in range(num_rows)]
+
+
+def merge_shards(shard_files, out_filename, ids_map_filename, block_rows=256):
+    """Interleaves the datasets of the shard files back into one file in the original image order.
+
+    shard_files lists the (hdf5 file, ids map file) of every shard, in shard order. The merged datasets
+    keep the storage type, compression and chunking of the shard datasets.
+    """
+    num_shards = len(shard_files)
+    shards = [h5py.File(h5_filename, 'r') for h5_filename, _ in shard_files]
+    try:
+        names = sorted(shards[0].keys())
+        ragged = RAGGED_OFFSETS in shards[0]
+        shard_rows = [shard[RAGGED_OFFSETS if ragged else names[0]].shape[0] for shard in shards]
+        num_images = sum(shard_rows)
+        for k, shard in enumerate(shards):
+            if shard_rows[k] != len(range(k, num_images, num_shards)):
+                raise ValueError('{} has {} rows, which does not match a {}-way split of {} images'.format(
+                    shard_files[k][0], shard_rows[k], num_shards, num_images))
+
+        shard_ids = [load_shard_ids(ids_map, k, num_shards, shard_rows[k])
+                     for k, (_, ids_map) in enumerate(shard_files)]
+        indices = {'image_id_to_ix': {}, 'image_ix_to_id': {}}
+        for k, image_ids in enumerate(shard_ids):
+            for row, image_id in enumerate(image_ids):
+                indices['image_id_to_ix'][image_id] = row * num_shards + k
+                indices['image_ix_to_id'][row * num_shards + k] = image_id
+
+        with h5py.File(out_filename, 'w') as out:
+            if ragged:
+                merge_ragged(shards, out, num_images)
+                names = []
+            for name in names:
+                src = shards[0][name]
+                dst = out.create_dataset(name, (num_images,) + src.shape[1:], dtype=src.dtype,
+                                         chunks=src.chunks, compression=src.compression,
+                                         compression_opts=src.compression_opts)
+                # block_rows rows of every shard make one contiguous block of the merged dataset
+                for start in range(0, shard_rows[0], block_rows):
+                    end = start + block_rows
+                    block = np.empty((min(end * num_shards, num_images) - start * num_shards,) + src.shape[1:],
+                                     dtype=src.dtype)
+                    for k, shard in enumerate(shards):
+                        block[k::num_shards] = shard[name][start:min(end, shard_rows[k])]
+                    dst[start * num_shards:start * num_shards + len(block)] = block
+    finally:
+        for shard in shards:
+            shard.close()
+    write_ids_map(indices, ids_map_filename)
+    return num_images
+
+
+def merge_ragged(shards, out, num_images, block_boxes=4096):
+    """Concatenates the flat datasets of ragged shards and interleaves their image offsets and counts."""
+    num_shards = len(shards)
+    names = [name for name in sorted(shards[0].keys()) if name not in (RAGGED_OFFSETS, RAGGED_COUNTS)]
+    lengths = [shard[names[0]].shape[0] for shard in shards]
+    offsets = np.empty(num_images, dtype=np.int64)
+    counts = np.empty(num_images, dtype=np.int32)
+    for name in names:
+        src = shards[0][name]
+        dst = out.create_dataset(name, (sum(lengths),) + src.shape[1:], dtype=src.dtype, chunks=src.chunks,
+                                 compression=src.compression, compression_opts=src.compression_opts)
+        base = 0
+        for shard, length in zip(shards, lengths):
+            for start in range(0, length, block_boxes):
+                end = min(start + block_boxes, length)
+                dst[base + start:base + end] = shard[name][start:end]
+            base += length
+    base = 0
+    for k, (shard, length) in enumerate(zip(shards, lengths)):
+        offsets[k::num_shards] = shard[RAGGED_OFFSETS][:] + base
+        counts[k::num_shards] = shard[RAGGED_COUNTS][:]
+        base += length
+    out.create_dataset(RAGGED_OFFSETS, data=offsets)
+    out.create_dataset(RAGGED_COUNTS, data=counts)
@@ -0,0 +1,148 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Export of a trained detector as one TorchScript artifact, and the loader used at inference.
+
+The dense stages are traced: RCNN_base, the convolutional part of the RPN (_RPN.head), RCNN_top with the
+pooling of _head_to_tail, RCNN_cls_score and RCNN_bbox_pred. They run without Python dispatch and without
+the model code, only from the artifact. Proposal generation and ROI pooling stay in Python: NMS and the
+ROI pooling/align/crop kernels are compiled extensions that TorchScript cannot trace, and the anchors of
+a feature map size are computed once by _ProposalLayer and then reused.
+
+The artifact is a zip file holding one TorchScript file per stage plus meta.json (classes, base depth,
+pooling settings). ExportedDetector is a _fasterRCNN whose stages are the loaded TorchScript modules, so
+forward(), extract_base_feat() and extract_roi_feats() behave like the eager model.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+import zipfile
+
+import torch
+import torch.nn as nn
+
+from model.utils.config import cfg
+from model.utils.telemetry import span
+from model.faster_rcnn.faster_rcnn import _fasterRCNN
+
+TRACED_STAGES = ('RCNN_base', 'RPN_head', 'RCNN_top', 'RCNN_cls_score', 'RCNN_bbox_pred')
+META_NAME = 'meta.json'
+
+
+def _jit_api():
+    jit = getattr(torch, 'jit', None)
+    if jit is None or not hasattr(jit, 'save') or not hasattr(jit, 'load'):
+        raise RuntimeError('Exporting the detector needs torch.jit.save/load (PyTorch 1.0 or later), found {}'.format(
+            torch.__version__))
+    return jit
+
+
+class _RPNHead(nn.Module):
+    def __init__(self, rpn):
+        super(_RPNHead, self).__init__()
+        self.rpn = rpn
+
+    def forward(self, base_feat):
+        _, _, rpn_cls_prob, rpn_bbox_pred = self.rpn.head(base_feat)
+        return rpn_cls_prob, rpn_bbox_pred
+
+
+class _HeadToTail(nn.Module):
+    def __init__(self, model):
+        super(_HeadToTail, self).__init__()
+        self.model = model
+
+    def forward(self, pool5):
+        return self.model._head_to_tail(pool5)
+
+
+class _ExportedRPN(nn.Module):
+    """Test-time _RPN: the traced convolutions followed by the proposal layer of the eager model."""
+
+    def __init__(self, head, proposal):
+        super(_ExportedRPN, self).__init__()
+        self.head = head
+        self.RPN_proposal = proposal
+
+    def forward(self, base_feat, im_info, gt_boxes, num_boxes):
+        if self.training:
+            raise NotImplementedError('An exported detector can only be used for inference')
+        with span('rpn'):
+            rpn_cls_prob, rpn_bbox_pred = self.head(base_feat)
+        with span('proposal_nms'):
+            rois = self.RPN_proposal((rpn_cls_prob.data, rpn_bbox_pred.data, im_info, 'TEST'))
+        return rois, 0, 0
+
+
+def export_detector(model, im_data, filename):
+    """Traces the stages of an eval-mode detector on the example input im_data (1 x 3 x H x W) and
+    writes the artifact. Returns the meta data stored with it."""
+    jit = _jit_api()
+    model.eval()
+    with torch.no_grad():
+        base_feat = model.RCNN_base(im_data)
+        pooled = base_feat.new(2, model.dout_base_model, cfg.POOLING_SIZE, cfg.POOLING_SIZE).normal_()
+        fc7 = model._head_to_tail(pooled)
+        traced = {
+            'RCNN_base': jit.trace(model.RCNN_base, (im_data,)),
+            'RPN_head': jit.trace(_RPNHead(model.RCNN_rpn), (base_feat,)),
+            'RCNN_top': jit.trace(_HeadToTail(model), (pooled,)),
+            'RCNN_cls_score': jit.trace(model.RCNN_cls_score, (fc7,)),
+            'RCNN_bbox_pred': jit.trace(model.RCNN_bbox_pred, (fc7,)),
+        }
+    meta = {'classes': list(model.classes), 'class_agnostic': bool(model.class_agnostic),
+            'dout_base_model': model.dout_base_model, 'pooling_mode': cfg.POOLING_MODE,
+            'pooling_size': cfg.POOLING_SIZE, 'crop_resize_with_max_pool': cfg.CROP_RESIZE_WITH_MAX_POOL,
+            'anchor_scales': list(cfg.ANCHOR_SCALES), 'anchor_ratios': list(cfg.ANCHOR_RATIOS),
+            'feat_stride': list(cfg.FEAT_STRIDE), 'torch_version': torch.__version__}
+    with zipfile.ZipFile(filename, 'w') as archive:
+        for name in TRACED_STAGES:
+            buf = io.BytesIO()
+            jit.save(traced[name], buf)
+            archive.writestr(name + '.pt', buf.getvalue())
+        archive.writestr(META_NAME, json.dumps(meta, indent=2))
+    return meta
+
+
+class ExportedDetector(_fasterRCNN):
+    """Inference-only detector running the traced stages of an artifact written by export_detector()."""
+
+    def __init__(self, filename, device):
+        jit = _jit_api()
+        with zipfile.ZipFile(filename) as archive:
+            meta = json.loads(archive.read(META_NAME).decode('utf-8'))
+            stages = {name: jit.load(io.BytesIO(archive.read(name + '.pt')), map_location=device)
+                      for name in TRACED_STAGES}
+        # the proposal and ROI pooling layers are built from cfg, which has to match the exported model
+        cfg.POOLING_MODE = meta['pooling_mode']
+        cfg.POOLING_SIZE = meta['pooling_size']
+        cfg.CROP_RESIZE_WITH_MAX_POOL = meta['crop_resize_with_max_pool']
+        cfg.ANCHOR_SCALES = meta['anchor_scales']
+        cfg.ANCHOR_RATIOS = meta['anchor_ratios']
+        cfg.FEAT_STRIDE = meta['feat_stride']
+
+        self.dout_base_model = meta['dout_base_model']
+        self.meta = meta
+        _fasterRCNN.__init__(self, meta['classes'], meta['class_agnostic'])
+        self.RCNN_base = stages['RCNN_base']
+        self.RCNN_rpn = _ExportedRPN(stages['RPN_head'], self.RCNN_rpn.RPN_proposal)
+        self.RCNN_top = stages['RCNN_top']
+        self.RCNN_cls_score = stages['RCNN_cls_score']
+        self.RCNN_bbox_pred = stages['RCNN_bbox_pred']
+        self.printed = True
+        self.to(device)
+        self.eval()
+
+    def _head_to_tail(self, pool5):
+        return self.RCNN_top(pool5)
+
+    def train(self, mode=True):
+        if mode:
+            raise NotImplementedError('An exported detector can only be used for inference')
+        return nn.Module.train(self, False)
@@ -7,6 +7,7 @@ import torchvision.models as models
 from torch.autograd import Variable
 import numpy as np
 from model.utils.config import cfg
+from model.utils.telemetry import span
 from model.rpn.rpn import _RPN
 from model.roi_pooling.modules.roi_pool import _RoIPooling
 from model.roi_crop.modules.roi_crop import _RoICrop
@@ -14,7 +15,8 @@ from model.roi_align.modules.roi_align import RoIAlignAvg
 from model.rpn.proposal_target_layer_cascade import _ProposalTargetLayer
 import time
 import pdb
-from model.utils.net_utils import _smooth_l1_loss, _crop_pool_layer, _affine_grid_gen, _affine_theta
+from model.utils.net_utils import _smooth_l1_loss, _crop_pool_layer, _affine_grid_gen, _affine_theta, \
+    InputNormalizer
 
 
 class _fasterRCNN(nn.Module):
@@ -37,29 +39,49 @@ class _fasterRCNN(nn.Module):
 
         self.grid_size = cfg.POOLING_SIZE * 2 if cfg.CROP_RESIZE_WITH_MAX_POOL else cfg.POOLING_SIZE
         self.RCNN_roi_crop = _RoICrop()
+        # uint8 images (cfg.INPUT_UINT8) are cast, mean subtracted and transposed here before RCNN_base
+        self.RCNN_input = InputNormalizer()
         self.printed = False
 
-    def forward(self, im_data, im_info, gt_boxes, num_boxes, return_feats=False, oracle_rois=None):
+    def forward(self, im_data, im_info, gt_boxes, num_boxes, return_feats=False, oracle_rois=None, base_feat=None):
         """
 
-        :param im_data:
+        :param im_data: B x 3 x H x W float images minus cfg.PIXEL_MEANS, or B x H x W x 3 uint8 BGR images
         :param im_info:
         :param gt_boxes:
         :param num_boxes:
         :param return_feats:
         :param oracle_rois: Use GT ROIs for feature extraction (NOT SUPPORTED DURING TRAINING!!!)
+                            Either R x 5 for a single image or B x R x 5 for a batch, where column 0 is the
+                            index of the image in the batch.
+        :param base_feat: Base feature map of im_data computed beforehand (e.g. cached), skips RCNN_base
         :return:
         """
         if self.training and oracle_rois is not None:
             raise NotImplementedError("We do not support using oracle ROIs during training phase.")
         batch_size = im_data.size(0)
 
+        if oracle_rois is not None:
+            # the proposals would be thrown away, skip the RPN altogether
+            if base_feat is None:
+                with span('backbone'):
+                    base_feat = self.RCNN_base(self.RCNN_input(im_data))
+            rois = torch.from_numpy(oracle_rois).float()
+            if rois.dim() == 2:
+                rois = torch.unsqueeze(rois, dim=0)
+            rois, cls_prob, bbox_pred, pooled_feat = self.extract_roi_feats(base_feat, rois)
+            if not return_feats:
+                return rois, cls_prob, bbox_pred, 0, 0, 0, 0, None
+            return rois, cls_prob, bbox_pred, 0, 0, 0, 0, None, pooled_feat
+
         im_info = im_info.data
         gt_boxes = gt_boxes.data
         num_boxes = num_boxes.data
 
         # feed image data to base model to obtain base feature map
-        base_feat = self.RCNN_base(im_data)
+        if base_feat is None:
+            with span('backbone'):
+                base_feat = self.RCNN_base(self.RCNN_input(im_data))
         if not self.printed:
             print("base_feat: {}".format(base_feat.shape))
 
@@ -86,39 +108,28 @@ class _fasterRCNN(nn.Module):
             rpn_loss_cls = 0
             rpn_loss_bbox = 0
 
-        if oracle_rois is not None:
-            rois = torch.from_numpy(oracle_rois).float()
-            rois = torch.unsqueeze(rois, dim=0)
-
         if not self.printed:
             print("rois.Variable.shape: {}".format(rois.shape))
             print("rois: {}".format(rois))
 
-        rois = Variable(rois).cuda()
+        rois = Variable(rois.to(base_feat.device))
 
         # do roi pooling based on predicted rois
-
-        if cfg.POOLING_MODE == 'crop':
-            # pdb.set_trace()
-            # pooled_feat_anchor = _crop_pool_layer(base_feat, rois.view(-1, 5))
-            grid_xy = _affine_grid_gen(rois.view(-1, 5), base_feat.size()[2:], self.grid_size)
-            grid_yx = torch.stack([grid_xy.data[:, :, :, 1], grid_xy.data[:, :, :, 0]], 3).contiguous()
-            pooled_feat = self.RCNN_roi_crop(base_feat, Variable(grid_yx).detach())
-            if cfg.CROP_RESIZE_WITH_MAX_POOL:
-                pooled_feat = F.max_pool2d(pooled_feat, 2, 2)
-        elif cfg.POOLING_MODE == 'align':
-            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
-        elif cfg.POOLING_MODE == 'pool':
-            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+        with span('roi_pool'):
+            pooled_feat = self._pool_rois(base_feat, rois)
 
         if not self.printed:
             print("pooled_feat.shape: {}".format(pooled_feat.shape))
 
-        # feed pooled features to top model
-        pooled_feat = self._head_to_tail(pooled_feat)
+        with span('head'):
+            # feed pooled features to top model
+            pooled_feat = self._head_to_tail(pooled_feat)
 
-        # compute bbox offset
-        bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+            # compute bbox offset
+            bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+
+            # compute object classification score
+            cls_score = self.RCNN_cls_score(pooled_feat)
 
         if self.training and not self.class_agnostic:
             # select the corresponding columns according to roi labels
@@ -128,7 +139,6 @@ class _fasterRCNN(nn.Module):
             bbox_pred = bbox_pred_select.squeeze(1)
 
         # compute object classification probability
-        cls_score = self.RCNN_cls_score(pooled_feat)
         cls_prob = F.softmax(cls_score)
 
         RCNN_loss_cls = 0
@@ -151,10 +161,48 @@ class _fasterRCNN(nn.Module):
             return rois, cls_prob, bbox_pred, rpn_loss_cls, rpn_loss_bbox, RCNN_loss_cls, RCNN_loss_bbox, rois_label, \
                    pooled_feat
 
+    def _pool_rois(self, base_feat, rois):
+        if cfg.POOLING_MODE == 'crop':
+            # pdb.set_trace()
+            # pooled_feat_anchor = _crop_pool_layer(base_feat, rois.view(-1, 5))
+            grid_xy = _affine_grid_gen(rois.view(-1, 5), base_feat.size()[2:], self.grid_size)
+            grid_yx = torch.stack([grid_xy.data[:, :, :, 1], grid_xy.data[:, :, :, 0]], 3).contiguous()
+            pooled_feat = self.RCNN_roi_crop(base_feat, Variable(grid_yx).detach())
+            if cfg.CROP_RESIZE_WITH_MAX_POOL:
+                pooled_feat = F.max_pool2d(pooled_feat, 2, 2)
+        elif cfg.POOLING_MODE == 'align':
+            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
+        elif cfg.POOLING_MODE == 'pool':
+            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+        return pooled_feat
+
+    def extract_roi_feats(self, base_feat, rois):
+        """
+        Runs only ROI pooling and the head on given ROIs, without the RPN.
+
+        :param base_feat: base feature map of a batch of images, as returned by extract_base_feat
+        :param rois: B x R x 5 ROIs in network input coordinates, column 0 is the index of the image in the batch
+        :return: rois, cls_prob (B x R x C), bbox_pred (B x R x 4C) and pooled_feat (BR x feature length)
+        """
+        batch_size = rois.size(0)
+        rois = Variable(rois.type_as(base_feat.data))
+
+        with span('roi_pool'):
+            pooled_feat = self._pool_rois(base_feat, rois)
+        with span('head'):
+            pooled_feat = self._head_to_tail(pooled_feat)
+            bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+            cls_prob = F.softmax(self.RCNN_cls_score(pooled_feat))
+
+        cls_prob = cls_prob.view(batch_size, rois.size(1), -1)
+        bbox_pred = bbox_pred.view(batch_size, rois.size(1), -1)
+        return rois, cls_prob, bbox_pred, pooled_feat
+
     def extract_base_feat(self, im_data):
         # feed image data to base model to obtain base feature map
-        im_data = im_data.cuda()
-        base_feat = self.RCNN_base(im_data)
+        im_data = im_data.to(next(self.parameters()).device)
+        with span('backbone'):
+            base_feat = self.RCNN_base(self.RCNN_input(im_data))
         return base_feat
 
     def _init_weights(self):
@@ -18,4 +18,6 @@ def nms(dets, thresh, force_cpu=False):
     # original: return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
     # ---pytorch version---
 
-    return nms_gpu(dets, thresh) if force_cpu == False else nms_cpu(dets, thresh)
+    if force_cpu or not dets.is_cuda:
+        return nms_cpu(dets.cpu(), thresh).to(dets.device)
+    return nms_gpu(dets, thresh)
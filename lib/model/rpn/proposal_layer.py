@@ -36,6 +36,8 @@ class _ProposalLayer(nn.Module):
         self._anchors = torch.from_numpy(generate_anchors(scales=np.array(scales), 
             ratios=np.array(ratios))).float()
         self._num_anchors = self._anchors.size(0)
+        # anchors of all feature map positions, per feature map size and tensor type
+        self._shifted_anchors = {}
 
         # rois blob: holds R regions of interest, each is a 5-tuple
         # (n, x1, y1, x2, y2) specifying an image batch index n and a
@@ -77,20 +79,8 @@ class _ProposalLayer(nn.Module):
         batch_size = bbox_deltas.size(0)
 
         feat_height, feat_width = scores.size(2), scores.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(scores).float()
-
-        A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(scores)
-        # anchors = self._anchors.view(1, A, 4) + shifts.view(1, K, 4).permute(1, 0, 2).contiguous()
-        anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        anchors = anchors.view(1, K * A, 4).expand(batch_size, K * A, 4)
+        anchors = self.shifted_anchors(feat_height, feat_width, scores)
+        anchors = anchors.view(1, -1, 4).expand(batch_size, anchors.size(0), 4)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
@@ -160,6 +150,29 @@ class _ProposalLayer(nn.Module):
 
         return output
 
+    def shifted_anchors(self, feat_height, feat_width, like):
+        """The K*A x 4 anchors of a feature map, computed once per size; like gives the tensor type."""
+        key = (feat_height, feat_width, like.type(), like.get_device() if like.is_cuda else -1)
+        if key not in self._shifted_anchors:
+            if len(self._shifted_anchors) >= 64:
+                # datasets with many image sizes would otherwise keep the anchors of all of them
+                self._shifted_anchors.clear()
+            shift_x = np.arange(0, feat_width) * self._feat_stride
+            shift_y = np.arange(0, feat_height) * self._feat_stride
+            shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+            shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
+                                      shift_x.ravel(), shift_y.ravel())).transpose())
+            shifts = shifts.contiguous().type_as(like).float()
+
+            A = self._num_anchors
+            K = shifts.size(0)
+
+            self._anchors = self._anchors.type_as(like)
+            # anchors = self._anchors.view(1, A, 4) + shifts.view(1, K, 4).permute(1, 0, 2).contiguous()
+            anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
+            self._shifted_anchors[key] = anchors.view(K * A, 4)
+        return self._shifted_anchors[key]
+
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
         pass
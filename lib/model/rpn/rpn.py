@@ -8,6 +8,7 @@ from model.utils.config import cfg
 from .proposal_layer import _ProposalLayer
 from .anchor_target_layer import _AnchorTargetLayer
 from model.utils.net_utils import _smooth_l1_loss
+from model.utils.telemetry import span
 
 import numpy as np
 import math
@@ -49,35 +50,43 @@ class _RPN(nn.Module):
     @staticmethod
     def reshape(x, d):
         input_shape = x.size()
+        # -1 instead of input_shape[1] * input_shape[2] / d, so that a traced graph keeps the size dynamic
         x = x.view(
             input_shape[0],
             int(d),
-            int(float(input_shape[1] * input_shape[2]) / float(d)),
+            -1,
             input_shape[3]
         )
         return x
 
-    def forward(self, base_feat, im_info, gt_boxes, num_boxes):
-
-        batch_size = base_feat.size(0)
-
+    def head(self, base_feat):
+        """The convolutional part of the RPN, returns the anchor scores and box offsets."""
         # return feature map after convrelu layer
         rpn_conv1 = F.relu(self.RPN_Conv(base_feat), inplace=True)
         # get rpn classification score
         rpn_cls_score = self.RPN_cls_score(rpn_conv1)
 
         rpn_cls_score_reshape = self.reshape(rpn_cls_score, 2)
-        rpn_cls_prob_reshape = F.softmax(rpn_cls_score_reshape)
+        rpn_cls_prob_reshape = F.softmax(rpn_cls_score_reshape, 1)
         rpn_cls_prob = self.reshape(rpn_cls_prob_reshape, self.nc_score_out)
 
         # get rpn offsets to the anchor boxes
         rpn_bbox_pred = self.RPN_bbox_pred(rpn_conv1)
+        return rpn_cls_score, rpn_cls_score_reshape, rpn_cls_prob, rpn_bbox_pred
+
+    def forward(self, base_feat, im_info, gt_boxes, num_boxes):
+
+        batch_size = base_feat.size(0)
+
+        with span('rpn'):
+            rpn_cls_score, rpn_cls_score_reshape, rpn_cls_prob, rpn_bbox_pred = self.head(base_feat)
 
         # proposal layer
         cfg_key = 'TRAIN' if self.training else 'TEST'
 
-        rois = self.RPN_proposal((rpn_cls_prob.data, rpn_bbox_pred.data,
-                                 im_info, cfg_key))
+        with span('proposal_nms'):
+            rois = self.RPN_proposal((rpn_cls_prob.data, rpn_bbox_pred.data,
+                                     im_info, cfg_key))
 
         self.rpn_loss_cls = 0
         self.rpn_loss_box = 0
@@ -32,6 +32,34 @@ def im_list_to_blob(ims):
 
     return blob
 
+def mean_pixel(pixel_means):
+    """The uint8 BGR pixel closest to pixel_means, used to pad uint8 blobs: after the mean subtraction
+    on the device the padding is within 0.5 of the zero padding of float blobs."""
+    return np.round(np.asarray(pixel_means).reshape(3)).astype(np.uint8)
+
+
+def im_list_to_uint8_blob(ims, pixel_means):
+    """Like im_list_to_blob for uint8 images that still hold the mean (cfg.INPUT_UINT8)."""
+    max_shape = np.array([im.shape for im in ims]).max(axis=0)
+    num_images = len(ims)
+    blob = np.empty((num_images, max_shape[0], max_shape[1], 3), dtype=np.uint8)
+    blob[...] = mean_pixel(pixel_means)
+    for i in xrange(num_images):
+        im = ims[i]
+        blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
+
+    return blob
+
+
+def resize_to_scale(im, target_size):
+    """Resizes im so that its shortest side is target_size, like prep_im_for_blob() without converting it
+    to float32 or subtracting the mean."""
+    im_scale = float(target_size) / float(np.min(im.shape[0:2]))
+    im = cv2.resize(np.ascontiguousarray(im), None, None, fx=im_scale, fy=im_scale,
+                    interpolation=cv2.INTER_LINEAR)
+    return im, im_scale
+
+
 def prep_im_for_blob(im, pixel_means, target_size, max_size):
     """Mean subtract and scale an image for use in a blob."""
 
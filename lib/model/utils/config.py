@@ -65,6 +65,14 @@ __C.TRAIN.SCALES = (600,)
 # Max pixel size of the longest side of a scaled input image
 __C.TRAIN.MAX_SIZE = 1000
 
+# Directory of pre-resized uint8 images written by build_image_cache.py, read
+# instead of decoding and resizing the images (empty to always decode)
+__C.TRAIN.IMAGE_CACHE = ''
+
+# Keep the training roidb in flat shared-memory arrays instead of a list of dicts
+# (see lib/roi_data_layer/columnar_roidb.py)
+__C.TRAIN.COLUMNAR_ROIDB = False
+
 # Trim size for input images to create minibatch
 __C.TRAIN.TRIM_HEIGHT = 600
 __C.TRAIN.TRIM_WIDTH = 600
@@ -256,6 +264,15 @@ __C.DEDUP_BOXES = 1. / 16.
 # they were trained with
 __C.PIXEL_MEANS = np.array([[[102.9801, 115.9465, 122.7717]]])
 
+# Image decoder (see lib/model/utils/image_io.py): 'scipy', 'cv2' (decodes
+# straight to BGR) or 'pil' (decodes JPEGs at a reduced size when they are
+# shrunk anyway)
+__C.IMAGE_DECODER = 'scipy'
+
+# Ship the images as uint8 BGR (N x H x W x 3) from the loaders and let the
+# model cast, subtract PIXEL_MEANS and transpose them on the device
+__C.INPUT_UINT8 = False
+
 # For reproducibility
 __C.RNG_SEED = 3
 
@@ -0,0 +1,62 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Device selection and thread settings for inference on GPU or CPU.
+
+The model, the input holders and every tensor created during the forward pass follow the device
+returned by inference_device(), so the same scripts run on CUDA hosts and CPU-only hosts.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+
+from model.utils.config import cfg
+
+
+def inference_device(cuda):
+    """torch.device('cuda') for --cuda, torch.device('cpu') otherwise."""
+    if cuda and not torch.cuda.is_available():
+        raise ValueError('--cuda was given, but no CUDA device is available')
+    return torch.device('cuda' if cuda else 'cpu')
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    """Sets the threads used inside one op (e.g. a convolution) and to run independent ops in parallel.
+
+    0 keeps the PyTorch default. Returns the resulting (intra-op, inter-op) thread counts; the inter-op
+    count is None for PyTorch versions without an inter-op pool setting.
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    inter_op = None
+    if hasattr(torch, 'set_num_interop_threads'):
+        if inter_op_threads > 0:
+            torch.set_num_interop_threads(inter_op_threads)
+        inter_op = torch.get_num_interop_threads()
+    elif inter_op_threads > 0:
+        print('Warning: this PyTorch version has no inter-op thread setting, ignoring {} inter-op threads'.format(
+            inter_op_threads))
+    return torch.get_num_threads(), inter_op
+
+
+def check_device_support(device, batch_size=1):
+    """Raises ValueError for cfg.POOLING_MODE settings without a CPU implementation."""
+    if device.type != 'cpu':
+        return
+    if cfg.POOLING_MODE == 'crop':
+        raise ValueError("POOLING_MODE 'crop' only has a CUDA implementation, use 'align' on CPU")
+    if cfg.POOLING_MODE == 'pool' and batch_size > 1:
+        raise ValueError("The CPU implementation of POOLING_MODE 'pool' handles one image at a time, "
+                         "use 'align' or a batch size of 1")
+
+
+def place_model(model, device):
+    """Moves the model to the device and records the choice in cfg.CUDA and cfg.USE_GPU_NMS."""
+    cfg.CUDA = device.type == 'cuda'
+    cfg.USE_GPU_NMS = cfg.CUDA
+    return model.to(device)
@@ -0,0 +1,88 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Image decoding for training, testing and feature extraction, with selectable backends.
+
+cfg.IMAGE_DECODER picks the backend:
+  - scipy: scipy.misc.imread in RGB, flipped to BGR (the original code path).
+  - cv2:   cv2.imread, which decodes straight to BGR without the flip and its copy. The EXIF orientation
+           is ignored like by the other backends, so that the pixels match the annotated boxes.
+  - pil:   PIL, using Image.draft() for JPEGs: when the image is going to be shrunk anyway, the decoder
+           scales it down by 1/2, 1/4 or 1/8 in the DCT domain, which skips most of the decoding work.
+           The image is never reduced below the size it is resized to.
+
+read_image() returns the image together with its scale relative to the file, so that callers working
+in original image coordinates (roidb boxes, extracted boxes) can fold it into their resize factor.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from model.utils.config import cfg
+
+DECODERS = ('scipy', 'cv2', 'pil')
+
+
+def _gray_to_bgr(im):
+    if len(im.shape) == 2:
+        im = im[:, :, np.newaxis]
+        im = np.concatenate((im, im, im), axis=2)
+    return im
+
+
+def _read_scipy(path, target_size, max_size):
+    from scipy.misc import imread
+    # rgb -> bgr
+    return _gray_to_bgr(np.array(imread(path, mode='RGB')))[:, :, ::-1], 1.
+
+
+def _read_cv2(path, target_size, max_size):
+    im = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if im is None:
+        raise IOError('Cannot decode image {}'.format(path))
+    return im, 1.
+
+
+def _read_pil(path, target_size, max_size):
+    im = Image.open(path)
+    width, height = im.size
+    scale = resize_scale(height, width, target_size, max_size) if target_size is not None else 1.
+    if scale < 1:
+        # the JPEG decoder picks the largest reduction that keeps at least the requested size
+        im.draft('RGB', (int(np.ceil(width * scale)), int(np.ceil(height * scale))))
+    decoded_scale = float(min(im.size)) / min(width, height)
+    im = np.asarray(im.convert('RGB'))
+    # rgb -> bgr
+    return np.ascontiguousarray(im[:, :, ::-1]), decoded_scale
+
+
+_READERS = {'scipy': _read_scipy, 'cv2': _read_cv2, 'pil': _read_pil}
+
+
+def resize_scale(height, width, target_size, max_size=None):
+    """The factor that resizes the shortest side to target_size, capped so that the longest side stays
+    within max_size."""
+    scale = float(target_size) / float(min(height, width))
+    if max_size is not None and np.round(scale * max(height, width)) > max_size:
+        scale = float(max_size) / float(max(height, width))
+    return scale
+
+
+def read_image(path, target_size=None, max_size=None, backend=None):
+    """Reads path as an H x W x 3 uint8 BGR image.
+
+    target_size/max_size describe the resize that follows (see resize_scale), the pil backend uses them
+    to decode JPEGs at a reduced size. Returns the image and its scale relative to the image file, which
+    is 1 unless the image was decoded at a reduced size.
+    """
+    backend = backend or cfg.IMAGE_DECODER
+    if backend not in _READERS:
+        raise ValueError('Unknown image decoder {}, expected one of {}'.format(backend, DECODERS))
+    return _READERS[backend](path, target_size, max_size)
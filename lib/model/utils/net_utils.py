@@ -23,6 +23,33 @@ def load_net(fname, net):
         param = torch.from_numpy(np.asarray(h5f[k]))
         v.copy_(param)
 
+class InputNormalizer(nn.Module):
+    """Turns uint8 BGR images (N x H x W x 3, cfg.INPUT_UINT8) into the float N x 3 x H x W input of the
+    backbone minus cfg.PIXEL_MEANS, on the device the images were copied to. Float input is passed through.
+
+    The means are not a buffer, so checkpoints are the same with and without the module.
+    """
+
+    def __init__(self, pixel_means=None):
+        super(InputNormalizer, self).__init__()
+        self.pixel_means = np.asarray(cfg.PIXEL_MEANS if pixel_means is None else pixel_means,
+                                      dtype=np.float32).reshape(1, 3, 1, 1)
+        self._means = {}
+
+    def _device_means(self, x):
+        key = (x.device.type, x.device.index)
+        if key not in self._means:
+            self._means[key] = torch.from_numpy(self.pixel_means).to(x.device)
+        return self._means[key]
+
+    def forward(self, im_data):
+        if im_data.dtype != torch.uint8:
+            return im_data
+        # one kernel each for the cast, the NHWC -> NCHW copy and the subtraction, all on the device
+        x = im_data.permute(0, 3, 1, 2).float()
+        return x - self._device_means(x)
+
+
 def weights_normal_init(model, dev=0.01):
     if isinstance(model, list):
         for m in model:
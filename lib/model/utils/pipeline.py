@@ -0,0 +1,233 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Producer/consumer helpers that overlap image decoding and result writing with the network.
+
+OrderedPrefetcher runs the decode/preprocess function of every image on a bounded pool of worker
+threads and hands the results to the main thread strictly in input order. AsyncWriter drains the
+network outputs into a sink (e.g. an HDF5 file) on a background thread. Both keep track of how long
+each side waited for the other so that the slowest stage can be identified.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue  # Python 3
+
+
+class OrderedPrefetcher(object):
+    """Maps fn over items on a pool of worker threads and yields the results in input order.
+
+    At most max_pending items are being processed or waiting to be consumed at any time, so the
+    workers stall instead of filling memory when the consumer is the bottleneck. With num_workers=0
+    fn runs inline on the consumer thread.
+    """
+
+    def __init__(self, fn, items, num_workers=4, max_pending=16):
+        self._fn = fn
+        self._items = iter(items)
+        self._num_workers = num_workers
+        self._max_pending = max(max_pending, 1)
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._slots = threading.Semaphore(self._max_pending)
+        self._results = {}
+        self._next_seq = 0
+        self._num_items = None
+        self._stopped = False
+
+        # stats
+        self.busy_time = 0.  # summed over workers
+        self.slot_wait = 0.  # workers blocked because the consumer is behind
+        self.consumer_wait = 0.  # consumer blocked because the workers are behind
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.num_consumed = 0
+
+        self._threads = []
+        for _ in range(num_workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            tic = time.time()
+            self._slots.acquire()
+            wait = time.time() - tic
+            with self._lock:
+                self.slot_wait += wait
+                if self._stopped:
+                    return
+                try:
+                    item = next(self._items)
+                except StopIteration:
+                    if self._num_items is None:
+                        self._num_items = self._next_seq
+                    self._slots.release()
+                    self._ready.notify_all()
+                    return
+                seq = self._next_seq
+                self._next_seq += 1
+
+            tic = time.time()
+            try:
+                result = (True, self._fn(item))
+            except Exception:
+                result = (False, sys.exc_info()[1])
+            busy = time.time() - tic
+
+            with self._lock:
+                self.busy_time += busy
+                self._results[seq] = result
+                self._ready.notify_all()
+
+    def __iter__(self):
+        if self._num_workers == 0:
+            for item in self._items:
+                tic = time.time()
+                result = self._fn(item)
+                self.busy_time += time.time() - tic
+                self.num_consumed += 1
+                yield result
+            return
+
+        seq = 0
+        while True:
+            tic = time.time()
+            with self._lock:
+                while seq not in self._results and (self._num_items is None or seq < self._num_items):
+                    self._ready.wait()
+                self.consumer_wait += time.time() - tic
+                if seq not in self._results:
+                    return
+                depth = len(self._results)
+                self.depth_sum += depth
+                self.depth_max = max(self.depth_max, depth)
+                ok, result = self._results.pop(seq)
+            self._slots.release()
+            if not ok:
+                self.close()
+                raise result
+            self.num_consumed += 1
+            seq += 1
+            yield result
+
+    @property
+    def depth(self):
+        """Number of results decoded ahead of the consumer."""
+        return len(self._results)
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+        # wake up workers blocked on a free slot so that they can exit
+        for _ in self._threads:
+            self._slots.release()
+
+    def summary(self):
+        mean_depth = self.depth_sum / max(self.num_consumed, 1)
+        return ('decode: {} workers busy {:.1f}s, waited {:.1f}s for a free slot, '
+                'consumer waited {:.1f}s, queue depth mean {:.1f} max {}/{}').format(
+            self._num_workers, self.busy_time, self.slot_wait, self.consumer_wait,
+            mean_depth, self.depth_max, self._max_pending)
+
+
+class AsyncWriter(object):
+    """Calls fn(*args) for every put() on a single background thread.
+
+    put() blocks when max_pending writes are queued. An exception raised by fn is re-raised by the
+    next put() or by close().
+    """
+
+    def __init__(self, fn, max_pending=16):
+        self._fn = fn
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._max_pending = max_pending
+        self._error = None
+
+        # stats
+        self.busy_time = 0.
+        self.idle_wait = 0.  # writer waiting for results
+        self.put_wait = 0.  # producer blocked because the writer is behind
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.num_put = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            tic = time.time()
+            args = self._queue.get()
+            self.idle_wait += time.time() - tic
+            if args is None:
+                return
+            if self._error is not None:
+                # keep draining so that producers never block on a dead writer
+                continue
+            tic = time.time()
+            try:
+                self._fn(*args)
+            except Exception:
+                self._error = sys.exc_info()[1]
+            self.busy_time += time.time() - tic
+
+    def put(self, *args):
+        if self._error is not None:
+            raise self._error
+        depth = self._queue.qsize()
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.num_put += 1
+        tic = time.time()
+        self._queue.put(args)
+        self.put_wait += time.time() - tic
+
+    @property
+    def depth(self):
+        """Number of results waiting to be written."""
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def summary(self):
+        mean_depth = self.depth_sum / max(self.num_put, 1)
+        return ('write: busy {:.1f}s, idle {:.1f}s, producer waited {:.1f}s, '
+                'queue depth mean {:.1f} max {}/{}').format(
+            self.busy_time, self.idle_wait, self.put_wait, mean_depth, self.depth_max, self._max_pending)
+
+
+def pipeline_report(prefetcher, writer, elapsed):
+    """Describes the time spent in each stage and names the one that limits throughput."""
+    lines = [prefetcher.summary()]
+    if writer is not None:
+        lines.append(writer.summary())
+    # The consumer only waits on the decoders when decoding is slower than the network, and only
+    # waits on the writer when writing is slower; otherwise the network itself is the bottleneck.
+    waits = {'decode': prefetcher.consumer_wait,
+             'write': writer.put_wait if writer is not None else 0.}
+    stage = max(waits, key=waits.get)
+    if waits[stage] < 0.05 * elapsed:
+        stage = 'network'
+    lines.append('bottleneck: {} (network thread waited {:.1f}s on decode, {:.1f}s on write, total {:.1f}s)'.format(
+        stage, waits['decode'], waits['write'], elapsed))
+    return '\n'.join(lines)
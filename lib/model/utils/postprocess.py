@@ -0,0 +1,186 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Detection post-processing shared by test_net.py, demo.py and the feature extractors.
+
+decode_boxes() turns the ROIs and regression deltas of a batch into per-class boxes in original image
+coordinates, detect() runs per-class NMS for all classes with a single NMS call and keeps the
+max_per_image best detections, and best_class_boxes() picks the box of the highest scoring class of
+every ROI with one gather.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+from model.utils.config import cfg
+from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+from model.nms.nms_wrapper import nms
+
+# float32 coordinates below this are spaced at most 1/256 px apart, see class_aware_nms()
+MAX_FLOAT32_SHIFT = 2. ** 15
+
+_normalize_constants = {}
+
+
+def bbox_normalize_constants(like):
+    """cfg.TRAIN.BBOX_NORMALIZE_STDS/MEANS as tensors of the type and device of like, created once."""
+    stds, means = tuple(cfg.TRAIN.BBOX_NORMALIZE_STDS), tuple(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
+    key = (like.type(), like.get_device() if like.is_cuda else -1, stds, means)
+    if key not in _normalize_constants:
+        _normalize_constants[key] = (like.new(stds), like.new(means))
+    return _normalize_constants[key]
+
+
+def decode_boxes(rois, bbox_pred, im_info, im_scales, num_classes, class_agnostic=False):
+    """Applies the regression deltas to the ROIs of a batch.
+
+    rois is B x R x 5, bbox_pred B x R x 4C (B x R x 4 when class agnostic) and im_scales holds the
+    resize factor of every image. Returns B x R x 4C (or B x R x 4) boxes clipped to the network input
+    and scaled back to the original images.
+    """
+    batch_size = rois.size(0)
+    boxes = rois[:, :, 1:5]
+
+    if cfg.TEST.BBOX_REG:
+        # Apply bounding-box regression deltas
+        box_deltas = bbox_pred
+        if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
+            # Optionally normalize targets by a precomputed mean and stdev
+            bbox_stds, bbox_means = bbox_normalize_constants(box_deltas)
+            box_deltas = box_deltas.contiguous().view(-1, 4) * bbox_stds + bbox_means
+            if class_agnostic:
+                box_deltas = box_deltas.view(batch_size, -1, 4)
+            else:
+                box_deltas = box_deltas.view(batch_size, -1, 4 * num_classes)
+
+        pred_boxes = bbox_transform_inv(boxes, box_deltas, batch_size)
+        pred_boxes = clip_boxes(pred_boxes, im_info, batch_size)
+    else:
+        # Simply repeat the boxes, once for each class
+        pred_boxes = boxes.repeat(1, 1, 1 if class_agnostic else num_classes)
+
+    for b in range(batch_size):
+        pred_boxes[b] /= float(im_scales[b])
+    return pred_boxes
+
+
+def best_class_boxes(scores, pred_boxes):
+    """For R x C scores and R x 4C boxes, returns the R x 4 boxes of the highest scoring class of every
+    ROI together with the R x 1 scores and indices of that class."""
+    max_scores, class_ixs = torch.max(scores, 1)
+    if pred_boxes.size(1) == 4:
+        # class agnostic regression
+        return pred_boxes, max_scores, class_ixs
+    num_rois = pred_boxes.size(0)
+    gather_ixs = class_ixs.view(num_rois, 1, 1).expand(num_rois, 1, 4)
+    boxes = pred_boxes.contiguous().view(num_rois, -1, 4).gather(1, gather_ixs).view(num_rois, 4)
+    return boxes, max_scores, class_ixs
+
+
+def class_aware_nms(scores, pred_boxes, thresh=0., nms_thresh=None, force_cpu=None):
+    """Per-class NMS of the detections scoring above thresh, for all foreground classes at once.
+
+    The boxes of every class are shifted by a class dependent offset larger than any coordinate, so that
+    boxes of different classes never overlap and a single NMS call gives the result of one call per class.
+    With many classes the shifted coordinates get large (about 1.6e6 for the 1600 VG classes), so the CPU
+    NMS gets them in float64. The GPU kernel only takes float32: there the classes are split into groups
+    whose shifted coordinates stay below MAX_FLOAT32_SHIFT, with one NMS call per group.
+    Returns the kept detections as K x 5 (x1, y1, x2, y2, score) sorted by decreasing score, with their
+    class and ROI indices.
+    """
+    if nms_thresh is None:
+        nms_thresh = cfg.TEST.NMS
+    if force_cpu is None:
+        force_cpu = not cfg.USE_GPU_NMS
+    num_rois, num_classes = scores.size()
+
+    candidates = torch.nonzero(scores[:, 1:] > thresh)
+    if candidates.numel() == 0:
+        return scores.new(0, 5), candidates.new(0), candidates.new(0)
+    roi_ixs, class_ixs = candidates[:, 0], candidates[:, 1] + 1
+    det_scores = scores[roi_ixs, class_ixs]
+    if pred_boxes.size(1) == 4:
+        det_boxes = pred_boxes[roi_ixs]
+    else:
+        det_boxes = pred_boxes.contiguous().view(num_rois, num_classes, 4)[roi_ixs, class_ixs]
+
+    # nms expects the detections sorted by decreasing score
+    _, order = torch.sort(det_scores, 0, True)
+    stride = float(det_boxes.max()) + 1
+    sorted_classes = class_ixs[order]
+    if force_cpu or not det_boxes.is_cuda:
+        offsets = sorted_classes.double() * stride
+        dets = torch.cat((det_boxes[order].double() + offsets.unsqueeze(1),
+                          det_scores[order].double().unsqueeze(1)), 1)
+        keep = nms(dets, nms_thresh, force_cpu=True).view(-1).long().type_as(order)
+    else:
+        classes_per_call = max(int(MAX_FLOAT32_SHIFT // stride), 1)
+        groups, group_classes = (sorted_classes - 1) // classes_per_call, (sorted_classes - 1) % classes_per_call
+        dets = torch.cat((det_boxes[order] + (group_classes.type_as(det_boxes) * stride).unsqueeze(1),
+                          det_scores[order].unsqueeze(1)), 1)
+        keep = []
+        for group in range(int(groups.max()) + 1):
+            members = torch.nonzero(groups == group).view(-1)
+            if members.numel() > 0:
+                keep.append(members[nms(dets[members], nms_thresh).view(-1).long().type_as(members)])
+        # back to decreasing score order
+        keep = torch.sort(torch.cat(keep), 0)[0]
+    keep = order[keep]
+    return torch.cat((det_boxes[keep], det_scores[keep].unsqueeze(1)), 1), class_ixs[keep], roi_ixs[keep]
+
+
+def nms_max_confidence(scores, boxes, thresh=0., nms_thresh=None, force_cpu=None):
+    """The highest class score of every ROI that survives per-class NMS over the class agnostic R x 4
+    boxes, as a numpy array (0 for ROIs without a surviving score above thresh).
+
+    A detection is only suppressed by higher scoring ones, so the scores above thresh are the same as
+    without the threshold, while the NMS call only sees the detections above it.
+    """
+    dets, _, roi_ixs = class_aware_nms(scores, boxes, thresh, nms_thresh, force_cpu)
+    max_conf = np.zeros(scores.size(0), dtype=np.float32)
+    np.maximum.at(max_conf, roi_ixs.cpu().numpy(), dets[:, 4].cpu().numpy())
+    return max_conf
+
+
+def per_class_nms_max_confidence(scores, boxes, nms_thresh=None, force_cpu=None):
+    """nms_max_confidence() over all scores with one NMS call per class, like generate_tsv.py. Bounded to
+    C NMS calls of R boxes, for when the scores below a threshold are needed as well."""
+    if nms_thresh is None:
+        nms_thresh = cfg.TEST.NMS
+    if force_cpu is None:
+        force_cpu = not cfg.USE_GPU_NMS
+    max_conf = np.zeros(scores.size(0), dtype=np.float32)
+    for j in range(1, scores.size(1)):
+        cls_scores = scores[:, j]
+        _, order = torch.sort(cls_scores, 0, True)
+        dets = torch.cat((boxes, cls_scores.unsqueeze(1)), 1)[order]
+        keep = order[nms(dets, nms_thresh, force_cpu=force_cpu).view(-1).long().type_as(order)]
+        np.maximum.at(max_conf, keep.cpu().numpy(), cls_scores[keep].cpu().numpy())
+    return max_conf
+
+
+def limit_detections(dets, class_ixs, max_per_image=100):
+    """Keeps the max_per_image highest scoring detections over all classes (0 keeps all of them)."""
+    if max_per_image <= 0 or dets.size(0) <= max_per_image:
+        return dets, class_ixs
+    _, top = torch.topk(dets[:, 4], max_per_image)
+    return dets[top], class_ixs[top]
+
+
+def detect(scores, pred_boxes, thresh=0., max_per_image=100, nms_thresh=None, force_cpu=None):
+    """class_aware_nms() followed by limit_detections(), returns (dets, class_ixs) of one image."""
+    dets, class_ixs, _ = class_aware_nms(scores, pred_boxes, thresh, nms_thresh, force_cpu)
+    return limit_detections(dets, class_ixs, max_per_image=max_per_image)
+
+
+def dets_per_class(dets, class_ixs, num_classes):
+    """Splits detections into the per-class N x 5 numpy arrays of all_boxes (index 0 is background)."""
+    dets = dets.cpu().numpy()
+    class_ixs = class_ixs.cpu().numpy()
+    return [dets[class_ixs == j] if j > 0 else np.zeros((0, 5), dtype=np.float32) for j in range(num_classes)]
@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Reduced-precision inference for selected stages of a detector.
+
+A stage ('base' is RCNN_base, 'head' is RCNN_top with RCNN_cls_score and RCNN_bbox_pred) is converted
+to float16 or bfloat16 and wrapped so that it casts its input down and its output back to float32.
+Everything between and after the stages stays float32: the RPN and proposal NMS, the ROI pooling
+kernels (which only exist for float32), box decoding (bbox_transform_inv, clip_boxes) and detection NMS.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+
+PRECISIONS = ('float32', 'float16', 'bfloat16')
+PRECISION_STAGES = {'base': ('RCNN_base',), 'head': ('RCNN_top', 'RCNN_cls_score', 'RCNN_bbox_pred')}
+
+
+def precision_dtype(precision, device):
+    """The torch dtype of a PRECISIONS name, checking that the device can run it."""
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(precision, PRECISIONS))
+    dtype = getattr(torch, precision, None)
+    if dtype is None:
+        raise RuntimeError('PyTorch {} has no {} tensors'.format(torch.__version__, precision))
+    if precision == 'float16' and device.type == 'cpu':
+        raise ValueError('float16 convolutions are only implemented for CUDA, use bfloat16 on the CPU')
+    return dtype
+
+
+class ReducedPrecision(nn.Module):
+    """Runs a module in dtype, with float32 input and output."""
+
+    def __init__(self, module, dtype):
+        super(ReducedPrecision, self).__init__()
+        self.module = module.to(dtype)
+        self.dtype = dtype
+
+    def forward(self, x):
+        return self.module(x.to(self.dtype)).float()
+
+
+def set_inference_precision(model, precision, device, stages=('base', 'head')):
+    """Converts the given stages of an inference model to precision, in place."""
+    if precision == 'float32':
+        return model
+    dtype = precision_dtype(precision, device)
+    unknown = [stage for stage in stages if stage not in PRECISION_STAGES]
+    if unknown:
+        raise ValueError('Unknown stages {}, expected some of {}'.format(unknown, sorted(PRECISION_STAGES)))
+    for stage in stages:
+        for name in PRECISION_STAGES[stage]:
+            setattr(model, name, ReducedPrecision(getattr(model, name), dtype))
+    return model
+
+
+def parameter_bytes(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters())
@@ -0,0 +1,118 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Opt-in int8 quantization of the resnet/vgg16 detectors for CPU inference.
+
+  - dynamic: the nn.Linear layers (RCNN_cls_score, RCNN_bbox_pred and the fc layers of the vgg16 head)
+    get int8 weights, their inputs are quantized on the fly. No calibration is needed.
+  - static: additionally runs the convolutions of the given stages ('base' is RCNN_base, 'top' is the
+    RCNN_top applied to every pooled ROI, i.e. layer4 of the resnets) in int8. The activation ranges are
+    observed on a few calibration images before the stages are converted. The stages are rewritten with
+    FX graph mode, which also handles the residual additions of the resnet blocks.
+
+The quantized stages take and return float tensors, so the RPN, ROI pooling and the post-processing are
+unchanged. Quantized kernels only exist for the CPU. The torch.quantization APIs are not part of every
+PyTorch version this repository runs on, so they are looked up when quantization is requested.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+
+import torch
+import torch.nn as nn
+
+from model.utils.config import cfg
+
+QUANTIZE_MODES = ('none', 'dynamic', 'static')
+STATIC_STAGES = {'base': 'RCNN_base', 'top': 'RCNN_top'}
+
+
+def _quantization_api(fx=False):
+    quantization = getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        raise RuntimeError('int8 quantization needs a PyTorch version with torch.quantization (1.3 or later), '
+                           'found {}'.format(torch.__version__))
+    if fx:
+        try:
+            from torch.quantization import quantize_fx
+        except ImportError:
+            raise RuntimeError('static quantization needs FX graph mode quantization (PyTorch 1.8 or later), '
+                               'found {}'.format(torch.__version__))
+        return quantization, quantize_fx
+    return quantization
+
+
+def quantize_linear_layers(model):
+    """Replaces the nn.Linear layers of the model with dynamically quantized int8 layers, in place."""
+    quantization = _quantization_api()
+    return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _prepare_fx(quantize_fx, module, qconfig, example_input):
+    try:
+        return quantize_fx.prepare_fx(module, {'': qconfig}, example_inputs=(example_input,))
+    except TypeError:
+        # PyTorch < 1.13 has no example_inputs argument
+        return quantize_fx.prepare_fx(module, {'': qconfig})
+
+
+def _stage_example(model, stage, example_input):
+    if stage == 'base':
+        return example_input
+    # RCNN_top sees pooled ROIs, flattened for the fc layers of vgg16
+    pooled = torch.zeros(1, model.dout_base_model, cfg.POOLING_SIZE, cfg.POOLING_SIZE)
+    return pooled.view(1, -1) if isinstance(model.RCNN_top[0], nn.Linear) else pooled
+
+
+def quantize_static_stages(model, stages, calibrate, example_input, backend='fbgemm'):
+    """Quantizes the convolutions of the given stages to int8, in place.
+
+    calibrate(model) must run the model on the calibration images; it is called once with observers in
+    place of the stages. example_input is an input of the first stage (only its shape and type matter).
+    """
+    quantization, quantize_fx = _quantization_api(fx=True)
+    torch.backends.quantized.engine = backend
+    qconfig = quantization.get_default_qconfig(backend)
+    unknown = [stage for stage in stages if stage not in STATIC_STAGES]
+    if unknown:
+        raise ValueError('Unknown stages {}, expected some of {}'.format(unknown, sorted(STATIC_STAGES)))
+
+    for stage in stages:
+        name = STATIC_STAGES[stage]
+        setattr(model, name, _prepare_fx(quantize_fx, getattr(model, name), qconfig,
+                                         _stage_example(model, stage, example_input)))
+    model.eval()
+    with torch.no_grad():
+        calibrate(model)
+    for stage in stages:
+        name = STATIC_STAGES[stage]
+        setattr(model, name, quantize_fx.convert_fx(getattr(model, name)))
+    return model
+
+
+def quantize_model(model, mode, device, static_stages=('base',), calibrate=None, example_input=None):
+    """Applies a QUANTIZE_MODES mode to a detector on the CPU; the linear layers are quantized last, so
+    that calibration observes the float head."""
+    if mode not in QUANTIZE_MODES:
+        raise ValueError('Unknown quantization mode {}, expected one of {}'.format(mode, QUANTIZE_MODES))
+    if mode == 'none':
+        return model
+    if device.type != 'cpu':
+        raise ValueError('int8 quantized kernels only run on the CPU, drop --cuda to use --quantize')
+    if mode == 'static':
+        if calibrate is None:
+            raise ValueError('static quantization needs calibration images')
+        quantize_static_stages(model, static_stages, calibrate, example_input)
+    return quantize_linear_layers(model)
+
+
+def model_size_mb(model):
+    """Size of the serialized state dict in MB, to compare the float and int8 weights."""
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2 ** 20
@@ -0,0 +1,181 @@
+# --------------------------------------------------------
+# Pytorch Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Per-stage timing of inference, from image decoding to writing the features.
+
+The stages are marked in the code with `with span('backbone'):` blocks. Until a StageTimer is installed,
+span() returns a shared no-op context manager, so the instrumentation costs one function call per stage.
+An installed timer records the duration of every span (synchronizing CUDA around the DEVICE_STAGES when
+sync_cuda is set, otherwise the asynchronous kernels would be charged to whichever stage waits for them),
+counts the images passed to tick() and writes a JSON line with p50/p95/p99 latencies and images/s every
+interval seconds. The host stages are not synchronized: on the worker threads that would stall them on the
+kernels of the network and serialize the pipeline.
+
+Spans may be entered from several threads (the decode workers of OrderedPrefetcher, the AsyncWriter), so
+stages running in parallel with the network can add up to more than the wall clock time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+# the stages in pipeline order, the ones marked in the model run inside forward()
+STAGES = ('decode', 'resize', 'h2d', 'backbone', 'rpn', 'proposal_nms', 'roi_pool', 'head', 'postprocess',
+          'hdf5_write')
+# the stages launching CUDA kernels, all of them on the thread running the model
+DEVICE_STAGES = frozenset(('h2d', 'backbone', 'rpn', 'proposal_nms', 'roi_pool', 'head'))
+
+_timer = None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+        self._sync = timer.sync_cuda and name in DEVICE_STAGES
+
+    def __enter__(self):
+        if self._sync:
+            torch.cuda.synchronize()
+        self._tic = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self._sync:
+            torch.cuda.synchronize()
+        self._timer.add(self._name, time.time() - self._tic)
+        return False
+
+
+def span(name):
+    """Context manager timing the stage name with the installed StageTimer, a no-op without one."""
+    if _timer is None:
+        return _NULL_SPAN
+    return _Span(_timer, name)
+
+
+def _percentiles(durations):
+    ms = 1000 * np.asarray(durations)
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'count': len(ms), 'total_s': float(ms.sum() / 1000), 'mean_ms': float(ms.mean()),
+            'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+class StageTimer(object):
+    """Collects span durations and image counts, see the module docstring.
+
+    out is a file name the JSON lines are appended to, or None for stdout; interval <= 0 only writes the
+    final line from close().
+    """
+
+    def __init__(self, out=None, interval=30., sync_cuda=False):
+        self.sync_cuda = sync_cuda
+        self._out = out
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._window = {}
+        self._start = self._last_emit = time.time()
+        self._num_images = self._window_images = 0
+
+    def install(self):
+        """Makes span() record into this timer."""
+        global _timer
+        _timer = self
+        return self
+
+    def uninstall(self):
+        global _timer
+        if _timer is self:
+            _timer = None
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._durations.setdefault(name, []).append(seconds)
+            self._window.setdefault(name, []).append(seconds)
+
+    def tick(self, num_images=1):
+        """Counts finished images and writes a JSON line when the interval has passed."""
+        self._num_images += num_images
+        self._window_images += num_images
+        if self._interval > 0 and time.time() - self._last_emit >= self._interval:
+            self.emit()
+
+    def _stage_stats(self, durations):
+        order = [name for name in STAGES if name in durations] + sorted(set(durations) - set(STAGES))
+        return [(name, _percentiles(durations[name])) for name in order]
+
+    def _write(self, record):
+        line = json.dumps(record)
+        if self._out is None:
+            print(line)
+            sys.stdout.flush()
+        else:
+            with open(self._out, 'a') as f:
+                f.write(line + '\n')
+
+    def emit(self, final=False):
+        """Writes the statistics of the spans since the last line (all spans for the final line)."""
+        now = time.time()
+        with self._lock:
+            durations = self._durations if final else self._window
+            stages = self._stage_stats(durations)
+            self._window = {}
+        window_images, window_elapsed = self._window_images, now - self._last_emit
+        self._window_images, self._last_emit = 0, now
+        elapsed = now - self._start
+        record = {'elapsed_s': elapsed, 'images': self._num_images,
+                  'images_per_sec': self._num_images / elapsed if elapsed > 0 else 0.,
+                  'window_images_per_sec': window_images / window_elapsed if window_elapsed > 0 else 0.,
+                  'stages': dict(stages)}
+        if final:
+            record['final'] = True
+            record['dominant_stage'] = max(stages, key=lambda stage: stage[1]['total_s'])[0] if stages else None
+        self._write(record)
+        return record
+
+    def summary(self):
+        """A table of every stage and the one that took the most time."""
+        with self._lock:
+            stages = self._stage_stats(self._durations)
+        elapsed = time.time() - self._start
+        if not stages:
+            return 'No stages were timed'
+        timed = sum(stats['total_s'] for _, stats in stages)
+        lines = ['{:<13} {:>7} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+            'stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'total s', 'share')]
+        for name, stats in stages:
+            lines.append('{:<13} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>6.1%}'.format(
+                name, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['total_s'],
+                stats['total_s'] / timed))
+        dominant, stats = max(stages, key=lambda stage: stage[1]['total_s'])
+        lines.append('{} images in {:.1f}s ({:.2f} images/s), dominant stage: {} ({:.1%} of timed)'.format(
+            self._num_images, elapsed, self._num_images / elapsed if elapsed > 0 else 0., dominant,
+            stats['total_s'] / timed))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Writes the final JSON line and stops recording."""
+        self.uninstall()
+        return self.emit(final=True)
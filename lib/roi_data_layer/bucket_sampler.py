@@ -0,0 +1,109 @@
+"""Training batches of one scale and similar aspect ratios.
+
+The default sampler of trainval_net.py batches consecutive images of the aspect ratio ordering and
+get_minibatch() draws a scale of cfg.TRAIN.SCALES for every image independently, so with several
+scales the images of a batch are resized to different sizes and roibatchLoader.load_batch() pads
+them to the largest one. BucketBatchSampler draws the scale of every image first and batches the
+images of each scale in ratio order: all images of a batch are cropped and padded to the same
+(height, width), the bucket of the scale and the ratio of the batch, and there is no padding between
+them beyond what the aspect ratio grouping needs.
+
+padding_overhead() counts the pixels of the padded blobs of an epoch against the pixels of the images
+in them, compare_samplers() does it for both samplers.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import numpy.random as npr
+from torch.utils.data.sampler import Sampler
+
+from roi_data_layer.roibatchLoader import group_ratio
+
+
+def fixed_group_batches(ratio_list, batch_size, num_scales):
+  """The batches of trainval_net.sampler as (index, scale_ind, ratio) keys: consecutive indices of the
+  ratio ordering, each with its own random scale."""
+  batches = []
+  for start in range(0, len(ratio_list), batch_size):
+    end = min(start + batch_size, len(ratio_list))
+    ratio = group_ratio(ratio_list[start], ratio_list[end - 1])
+    batches.append([(index, int(npr.randint(num_scales)), float(ratio)) for index in range(start, end)])
+  return batches
+
+
+class BucketBatchSampler(Sampler):
+  """Yields lists of (index, scale_ind, ratio) keys of roibatchLoader, see the module docstring.
+
+  ratio_list is the sorted ratio list of combined_roidb(). Every epoch the scales are drawn again and
+  the batches are shuffled; the last batch of every scale may be smaller than batch_size.
+  """
+
+  def __init__(self, ratio_list, batch_size, num_scales):
+    self.ratio_list = np.asarray(ratio_list)
+    self.batch_size = batch_size
+    self.num_scales = num_scales
+    self._batches = None
+
+  def plan_epoch(self):
+    """Draws the batches of an epoch."""
+    scale_inds = npr.randint(0, self.num_scales, size=len(self.ratio_list))
+    batches = []
+    for scale_ind in range(self.num_scales):
+      # the indices of ratio_list are in ascending ratio order
+      indices = np.flatnonzero(scale_inds == scale_ind)
+      for start in range(0, len(indices), self.batch_size):
+        group = indices[start:start + self.batch_size]
+        ratio = group_ratio(self.ratio_list[group[0]], self.ratio_list[group[-1]])
+        batches.append([(int(index), scale_ind, float(ratio)) for index in group])
+    return [batches[i] for i in npr.permutation(len(batches))]
+
+  def __iter__(self):
+    batches = self._batches if self._batches is not None else self.plan_epoch()
+    self._batches = None
+    return iter(batches)
+
+  def __len__(self):
+    # the number of batches depends on the drawn scales, the planned epoch is the next one iterated
+    if self._batches is None:
+      self._batches = self.plan_epoch()
+    return len(self._batches)
+
+
+def padded_size(height, width, target_size, ratio):
+  """The (height, width) roibatchLoader pads an image of height x width to when it is resized to
+  target_size in a group of ratio, and the number of image pixels in it."""
+  scale = float(target_size) / min(height, width)
+  height, width = int(round(height * scale)), int(round(width * scale))
+  if ratio < 1:
+    pad_height, pad_width = int(np.ceil(width / ratio)), width
+  elif ratio > 1:
+    pad_height, pad_width = height, int(np.ceil(height * ratio))
+  else:
+    pad_height = pad_width = min(height, width)
+  return pad_height, pad_width, min(height, pad_height) * min(width, pad_width)
+
+
+def padding_overhead(batches, sizes, scales):
+  """Returns the pixels of the blobs of batches (lists of (index, scale_ind, ratio) keys) and of the
+  images in them. sizes holds the (height, width) of the image at every index of the ratio ordering.
+
+  A blob is as large as the largest padded image of its batch, like in roibatchLoader.load_batch().
+  """
+  blob_pixels, image_pixels = 0, 0
+  for batch in batches:
+    pads = [padded_size(sizes[index][0], sizes[index][1], scales[scale_ind], ratio)
+            for index, scale_ind, ratio in batch]
+    blob_pixels += len(batch) * max(pad[0] for pad in pads) * max(pad[1] for pad in pads)
+    image_pixels += sum(pad[2] for pad in pads)
+  return blob_pixels, image_pixels
+
+
+def compare_samplers(ratio_list, sizes, batch_size, scales):
+  """The padded pixels of an epoch with trainval_net.sampler and with BucketBatchSampler, as a dict of
+  (blob pixels, image pixels) per sampler."""
+  return {'sampler': padding_overhead(fixed_group_batches(ratio_list, batch_size, len(scales)), sizes, scales),
+          'bucket': padding_overhead(BucketBatchSampler(ratio_list, batch_size, len(scales)).plan_epoch(),
+                                     sizes, scales)}
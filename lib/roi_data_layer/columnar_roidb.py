@@ -0,0 +1,133 @@
+"""A columnar, shared-memory copy of a training roidb.
+
+A roidb is a list with one dict per image, holding small numpy arrays and the scipy.sparse gt_overlaps.
+Every DataLoader worker forked from the trainer touches these objects when it reads them (and the
+garbage collector touches all of them), so their reference counts are written and the pages holding
+them are copied into every worker, one page per few objects. With VG/COCO-sized roidbs and 8 workers
+this adds gigabytes of resident memory.
+
+ColumnarRoidb stores the same data in a handful of flat arrays: the boxes, classes, areas and crowd
+flags of all images concatenated, with per-image offsets into them, and per-image width, height,
+flipped, need_crop and img_id. The image paths are one utf-8 byte buffer with offsets. share_memory()
+moves every column into shared memory, so workers started with spawn map the same pages instead of
+receiving a pickled copy.
+
+Indexing returns a small dict with the keys get_minibatch() and roibatchLoader read, whose arrays are
+views of the columns; gt_overlaps is replaced by the per-box crowd flag get_minibatch() derives from it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+BOX_COLUMNS = ('boxes', 'gt_classes', 'seg_areas', 'crowd')
+
+
+def _concat(arrays, shape, dtype):
+  if not arrays:
+    return np.zeros(shape, dtype=dtype)
+  return np.ascontiguousarray(np.concatenate(arrays), dtype=dtype)
+
+
+def _offsets(lengths):
+  offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  return offsets
+
+
+def _seg_areas(entry):
+  # append_flipped_images() does not copy seg_areas, flipping does not change them
+  if 'seg_areas' in entry:
+    return entry['seg_areas']
+  boxes = entry['boxes'].astype(np.float32)
+  return (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+
+def _crowd(entry):
+  # crowd boxes have an overlap of -1 with every class, see get_minibatch()
+  return ~np.all(entry['gt_overlaps'].toarray() > -1.0, axis=1)
+
+
+class ColumnarRoidb(object):
+  """A roidb prepared by prepare_roidb() and rank_roidb_ratio(), stored as flat arrays.
+
+  roidb[i] returns the dict of image i, len() and iteration work like for the list.
+  """
+
+  def __init__(self, roidb):
+    columns = {}
+    columns['box_offsets'] = _offsets([len(entry['boxes']) for entry in roidb])
+    columns['boxes'] = _concat([entry['boxes'] for entry in roidb], (0, 4), np.float32)
+    columns['gt_classes'] = _concat([entry['gt_classes'] for entry in roidb], (0,), np.int32)
+    columns['seg_areas'] = _concat([_seg_areas(entry) for entry in roidb], (0,), np.float32)
+    columns['crowd'] = _concat([_crowd(entry) for entry in roidb], (0,), np.uint8)
+
+    columns['width'] = np.array([entry['width'] for entry in roidb], dtype=np.int32)
+    columns['height'] = np.array([entry['height'] for entry in roidb], dtype=np.int32)
+    columns['flipped'] = np.array([entry['flipped'] for entry in roidb], dtype=np.uint8)
+    columns['need_crop'] = np.array([entry.get('need_crop', 0) for entry in roidb], dtype=np.uint8)
+    columns['img_id'] = np.array([entry['img_id'] for entry in roidb], dtype=np.int64)
+
+    paths = [entry['image'].encode('utf-8') for entry in roidb]
+    columns['image_offsets'] = _offsets([len(path) for path in paths])
+    columns['image_bytes'] = np.frombuffer(b''.join(paths), dtype=np.uint8).copy()
+    self._set_columns(columns)
+    self._tensors = None
+
+  def _set_columns(self, columns):
+    self._columns = columns
+    for name, column in columns.items():
+      setattr(self, name, column)
+
+  def share_memory(self):
+    """Moves the columns into shared memory, returns self."""
+    if self._tensors is None:
+      self._tensors = dict((name, torch.from_numpy(column).share_memory_())
+                           for name, column in self._columns.items())
+      self._set_columns(dict((name, tensor.numpy()) for name, tensor in self._tensors.items()))
+    return self
+
+  def __getstate__(self):
+    # shared tensors are sent to spawned workers as handles of their shared memory
+    if self._tensors is not None:
+      return {'tensors': self._tensors}
+    return {'columns': self._columns}
+
+  def __setstate__(self, state):
+    self._tensors = state.get('tensors')
+    if self._tensors is not None:
+      self._set_columns(dict((name, tensor.numpy()) for name, tensor in self._tensors.items()))
+    else:
+      self._set_columns(state['columns'])
+
+  @property
+  def nbytes(self):
+    return sum(column.nbytes for column in self._columns.values())
+
+  def image_path(self, i):
+    start, end = self.image_offsets[i], self.image_offsets[i + 1]
+    return self.image_bytes[start:end].tobytes().decode('utf-8')
+
+  def __len__(self):
+    return len(self.width)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    start, end = self.box_offsets[i], self.box_offsets[i + 1]
+    entry = dict((name, self._columns[name][start:end]) for name in BOX_COLUMNS)
+    entry['crowd'] = entry['crowd'].astype(bool)
+    entry['width'] = int(self.width[i])
+    entry['height'] = int(self.height[i])
+    entry['flipped'] = bool(self.flipped[i])
+    entry['need_crop'] = int(self.need_crop[i])
+    entry['img_id'] = int(self.img_id[i])
+    entry['image'] = self.image_path(i)
+    return entry
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
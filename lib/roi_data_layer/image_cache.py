@@ -0,0 +1,135 @@
+"""Pre-resized uint8 copies of the training images, stored in memory-mappable shards.
+
+get_minibatch() decodes every image again in every epoch and resizes it to one of cfg.TRAIN.SCALES.
+build_image_cache() does this once per (image, scale): the resized BGR pixels are appended to
+{directory}/shard{K}.bin as raw uint8, and index.npy records where every image is, its resized shape
+and its scale factor, with the image paths and scales in index.json. Flipped roidb entries share the
+pixels of their original image, get_minibatch() flips the cached view.
+
+The mean is not subtracted in the cache: it is applied when the blob is built, while converting the
+cached uint8 pixels to float32. Subtracting the mean before or after the (linear) resize gives the same
+image up to the rounding of the resized pixels to uint8.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+from model.utils.blob import resize_to_scale
+from model.utils.image_io import read_image
+from model.utils.pipeline import OrderedPrefetcher
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('height', '<i4'), ('width', '<i4'),
+                        ('im_scale', '<f8')])
+INDEX_NAME = 'index.npy'
+META_NAME = 'index.json'
+
+
+def shard_filename(directory, shard):
+  return os.path.join(directory, 'shard{}.bin'.format(shard))
+
+
+def _prepare(path, scales):
+  # decoded once for the largest scale, the scale factors are relative to the image file
+  im, decoded_scale = read_image(path, max(scales))
+  resized = []
+  for target_size in scales:
+    im_resized, im_scale = resize_to_scale(im, target_size)
+    resized.append((im_resized, im_scale * decoded_scale))
+  return resized
+
+
+def build_image_cache(roidb, directory, scales, shard_bytes=2 ** 30, num_workers=8):
+  """Writes the images of a roidb at every scale of scales to the cache directory.
+
+  Images are decoded and resized on num_workers threads; a new shard is started once the current one
+  holds more than shard_bytes. Returns the number of cached images.
+  """
+  paths = sorted(set(entry['image'] for entry in roidb))
+  scales = [int(s) for s in scales]
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  index = np.zeros((len(paths), len(scales)), dtype=INDEX_DTYPE)
+
+  shard, offset = 0, 0
+  out = open(shard_filename(directory, shard), 'wb')
+  prefetcher = OrderedPrefetcher(lambda path: _prepare(path, scales), paths, num_workers=num_workers,
+                                 max_pending=4 * max(num_workers, 1))
+  for i, resized in enumerate(prefetcher):
+    for j, (im, im_scale) in enumerate(resized):
+      if offset > 0 and offset + im.nbytes > shard_bytes:
+        out.close()
+        shard, offset = shard + 1, 0
+        out = open(shard_filename(directory, shard), 'wb')
+      out.write(im.tobytes())
+      index[i, j] = (shard, offset, im.shape[0], im.shape[1], im_scale)
+      offset += im.nbytes
+    if (i + 1) % 1000 == 0:
+      print('cached {}/{} images'.format(i + 1, len(paths)))
+  out.close()
+
+  # the index is written last, a cache without one is incomplete and never read
+  np.save(os.path.join(directory, INDEX_NAME), index)
+  with open(os.path.join(directory, META_NAME), 'w') as f:
+    json.dump({'scales': scales, 'num_shards': shard + 1, 'images': paths}, f)
+  return len(paths)
+
+
+class ImageCache(object):
+  """Read access to a directory written by build_image_cache().
+
+  The shards are memory-mapped on first use in every process, so a cache opened before the DataLoader
+  forks its workers is not shared between them.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open(os.path.join(directory, META_NAME)) as f:
+      meta = json.load(f)
+    self.scales = meta['scales']
+    self._scale_ix = dict((s, j) for j, s in enumerate(self.scales))
+    self._image_ix = dict((path, i) for i, path in enumerate(meta['images']))
+    self._num_shards = meta['num_shards']
+    self._index = np.load(os.path.join(directory, INDEX_NAME))
+    self._shards = None
+    self._pid = None
+
+  def __len__(self):
+    return len(self._image_ix)
+
+  def _shard(self, shard):
+    if self._pid != os.getpid():
+      self._shards = [None] * self._num_shards
+      self._pid = os.getpid()
+    if self._shards[shard] is None:
+      self._shards[shard] = np.memmap(shard_filename(self.directory, shard), dtype=np.uint8, mode='r')
+    return self._shards[shard]
+
+  def get(self, path, target_size):
+    """The cached H x W x 3 uint8 BGR pixels of path resized to target_size and the scale factor, or None
+    if the image or the scale is not cached."""
+    i = self._image_ix.get(path)
+    j = self._scale_ix.get(int(target_size))
+    if i is None or j is None:
+      return None
+    entry = self._index[i, j]
+    num_bytes = int(entry['height']) * int(entry['width']) * 3
+    pixels = self._shard(int(entry['shard']))[int(entry['offset']):int(entry['offset']) + num_bytes]
+    return pixels.reshape(int(entry['height']), int(entry['width']), 3), float(entry['im_scale'])
+
+
+_caches = {}
+
+
+def image_cache(directory):
+  """The ImageCache of directory, opened once per process; None for an empty directory name."""
+  if not directory:
+    return None
+  if directory not in _caches:
+    _caches[directory] = ImageCache(directory)
+  return _caches[directory]
@@ -12,16 +12,24 @@ from __future__ import print_function
 
 import numpy as np
 import numpy.random as npr
-from scipy.misc import imread
 from model.utils.config import cfg
-from model.utils.blob import prep_im_for_blob, im_list_to_blob
+from model.utils.blob import prep_im_for_blob, im_list_to_blob, resize_to_scale, im_list_to_uint8_blob
+from model.utils.image_io import read_image
+from model.utils.telemetry import span
+from roi_data_layer.image_cache import image_cache
 import pdb
-def get_minibatch(roidb, num_classes):
-  """Given a roidb, construct a minibatch sampled from it."""
+def get_minibatch(roidb, num_classes, scale_inds=None):
+  """Given a roidb, construct a minibatch sampled from it.
+
+  scale_inds picks the index of cfg.TRAIN.SCALES of every image, random scales are sampled without it.
+  """
   num_images = len(roidb)
   # Sample random scales to use for each image in this batch
-  random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
-                  size=num_images)
+  if scale_inds is None:
+    random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
+                    size=num_images)
+  else:
+    random_scale_inds = scale_inds
   assert(cfg.TRAIN.BATCH_SIZE % num_images == 0), \
     'num_images ({}) must divide BATCH_SIZE ({})'. \
     format(num_images, cfg.TRAIN.BATCH_SIZE)
@@ -40,7 +48,12 @@ def get_minibatch(roidb, num_classes):
     gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
   else:
     # For the COCO ground truth boxes, exclude the ones that are ''iscrowd'' 
-    gt_inds = np.where((roidb[0]['gt_classes'] != 0) & np.all(roidb[0]['gt_overlaps'].toarray() > -1.0, axis=1))[0]
+    if 'crowd' in roidb[0]:
+      # a ColumnarRoidb entry, the flag was derived from gt_overlaps when it was built
+      not_crowd = ~roidb[0]['crowd']
+    else:
+      not_crowd = np.all(roidb[0]['gt_overlaps'].toarray() > -1.0, axis=1)
+    gt_inds = np.where((roidb[0]['gt_classes'] != 0) & not_crowd)[0]
   gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
   gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
   gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
@@ -61,26 +74,43 @@ def _get_image_blob(roidb, scale_inds):
 
   processed_ims = []
   im_scales = []
+  cache = image_cache(cfg.TRAIN.IMAGE_CACHE)
   for i in range(num_images):
-    #im = cv2.imread(roidb[i]['image'])
-    im = imread(roidb[i]['image'], mode='RGB')
+    target_size = cfg.TRAIN.SCALES[scale_inds[i]]
+    cached = cache.get(roidb[i]['image'], target_size) if cache is not None else None
+    if cached is not None:
+      im, im_scale = cached
+      if roidb[i]['flipped']:
+        im = im[:, ::-1, :]
+      im_scales.append(im_scale)
+      if cfg.INPUT_UINT8:
+        processed_ims.append(im)
+      else:
+        # the mean is subtracted while converting the cached pixels to float32
+        processed_ims.append(np.subtract(im, cfg.PIXEL_MEANS, dtype=np.float32))
+      continue
 
-    if len(im.shape) == 2:
-      im = im[:,:,np.newaxis]
-      im = np.concatenate((im,im,im), axis=2)
-    # flip the channel, since the original one using cv2
-    # rgb -> bgr
-    im = im[:,:,::-1]
+    # BGR, possibly decoded at a reduced size (decoded_scale < 1)
+    with span('decode'):
+      im, decoded_scale = read_image(roidb[i]['image'], target_size)
 
     if roidb[i]['flipped']:
       im = im[:, ::-1, :]
-    target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-    im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                    cfg.TRAIN.MAX_SIZE)
-    im_scales.append(im_scale)
+    with span('resize'):
+      if cfg.INPUT_UINT8:
+        # the model subtracts the mean on the device
+        im, im_scale = resize_to_scale(im, target_size)
+      else:
+        im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
+                        cfg.TRAIN.MAX_SIZE)
+    # the gt boxes are in the coordinates of the image file
+    im_scales.append(im_scale * decoded_scale)
     processed_ims.append(im)
 
   # Create a blob to hold the input images
-  blob = im_list_to_blob(processed_ims)
+  if cfg.INPUT_UINT8:
+    blob = im_list_to_uint8_blob(processed_ims, cfg.PIXEL_MEANS)
+  else:
+    blob = im_list_to_blob(processed_ims)
 
   return blob, im_scales
@@ -6,12 +6,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+from multiprocessing.pool import ThreadPool
+
 import torch.utils.data as data
 from PIL import Image
 import torch
 
 from model.utils.config import cfg
 from roi_data_layer.minibatch import get_minibatch, get_minibatch
+from model.utils.blob import mean_pixel
 from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
 
 import numpy as np
@@ -19,8 +23,23 @@ import random
 import time
 import pdb
 
+
+def group_ratio(min_ratio, max_ratio):
+  """The aspect ratio every image of a group is cropped and padded to, given the smallest and the
+  largest ratio in the group."""
+  if max_ratio < 1:
+    # for ratio < 1, we preserve the leftmost in each batch.
+    return min_ratio
+  elif min_ratio > 1:
+    # for ratio > 1, we preserve the rightmost in each batch.
+    return max_ratio
+  # for ratio cross 1, we make it to be 1.
+  return 1
+
+
 class roibatchLoader(data.Dataset):
-  def __init__(self, roidb, ratio_list, ratio_index, batch_size, num_classes, training=True, normalize=None):
+  def __init__(self, roidb, ratio_list, ratio_index, batch_size, num_classes, training=True, normalize=None,
+               num_threads=4):
     self._roidb = roidb
     self._num_classes = num_classes
     # we make the height of image consistent to trim_height, trim_width
@@ -33,6 +52,10 @@ class roibatchLoader(data.Dataset):
     self.ratio_index = ratio_index
     self.batch_size = batch_size
     self.data_size = len(self.ratio_list)
+    # threads loading the images of a minibatch in load_batch()
+    self.num_threads = num_threads
+    self._pool = None
+    self._pool_pid = None
 
     # given the ratio_list, we want to make the ratio same for each batch.
     self.ratio_list_batch = torch.Tensor(self.data_size).zero_()
@@ -40,171 +63,186 @@ class roibatchLoader(data.Dataset):
     for i in range(num_batch):
         left_idx = i*batch_size
         right_idx = min((i+1)*batch_size-1, self.data_size-1)
-
-        if ratio_list[right_idx] < 1:
-            # for ratio < 1, we preserve the leftmost in each batch.
-            target_ratio = ratio_list[left_idx]
-        elif ratio_list[left_idx] > 1:
-            # for ratio > 1, we preserve the rightmost in each batch.
-            target_ratio = ratio_list[right_idx]
-        else:
-            # for ratio cross 1, we make it to be 1.
-            target_ratio = 1
-
+        target_ratio = group_ratio(ratio_list[left_idx], ratio_list[right_idx])
         self.ratio_list_batch[left_idx:(right_idx+1)] = target_ratio
 
 
-  def __getitem__(self, index):
-    if self.training:
-        index_ratio = int(self.ratio_index[index])
+  def _prepare_train(self, key):
+    """Loads the training image at index, shuffles its gt boxes and crops it to the ratio of its group.
+
+    key is an index of ratio_index, or an (index, scale_ind, ratio) tuple of a BucketBatchSampler,
+    which picks the training scale and the ratio of the batch instead. Returns the image (H x W x 3, a
+    view of the minibatch blob), im_info, the gt boxes and the (height, width) the image is padded to.
+    """
+    if isinstance(key, tuple):
+        index, scale_ind, ratio = key
+        scale_inds = [scale_ind]
     else:
-        index_ratio = index
+        index, scale_inds, ratio = key, None, self.ratio_list_batch[key]
+    index_ratio = int(self.ratio_index[index])
 
     # get the anchor index for current sample index
     # here we set the anchor index to the last one
     # sample in this group
-    minibatch_db = [self._roidb[index_ratio]]
-    blobs = get_minibatch(minibatch_db, self._num_classes)
+    entry = self._roidb[index_ratio]
+    blobs = get_minibatch([entry], self._num_classes, scale_inds)
     data = torch.from_numpy(blobs['data'])
     im_info = torch.from_numpy(blobs['im_info'])
     # we need to random shuffle the bounding box.
     data_height, data_width = data.size(1), data.size(2)
-    if self.training:
-        np.random.shuffle(blobs['gt_boxes'])
-        gt_boxes = torch.from_numpy(blobs['gt_boxes'])
-
-        ########################################################
-        # padding the input image to fixed size for each group #
-        ########################################################
-
-        # NOTE1: need to cope with the case where a group cover both conditions. (done)
-        # NOTE2: need to consider the situation for the tail samples. (no worry)
-        # NOTE3: need to implement a parallel data loader. (no worry)
-        # get the index range
-
-        # if the image need to crop, crop to the target size.
-        ratio = self.ratio_list_batch[index]
-
-        if self._roidb[index_ratio]['need_crop']:
-            if ratio < 1:
-                # this means that data_width << data_height, we need to crop the
-                # data_height
-                min_y = int(torch.min(gt_boxes[:,1]))
-                max_y = int(torch.max(gt_boxes[:,3]))
-                trim_size = int(np.floor(data_width / ratio))
-                if trim_size > data_height:
-                    trim_size = data_height                
-                box_region = max_y - min_y + 1
-                if min_y == 0:
-                    y_s = 0
+    np.random.shuffle(blobs['gt_boxes'])
+    gt_boxes = torch.from_numpy(blobs['gt_boxes'])
+
+    ########################################################
+    # padding the input image to fixed size for each group #
+    ########################################################
+
+    # NOTE1: need to cope with the case where a group cover both conditions. (done)
+    # NOTE2: need to consider the situation for the tail samples. (no worry)
+    # NOTE3: need to implement a parallel data loader. (no worry)
+    # get the index range
+
+    # if the image need to crop, crop to the target size.
+    if entry['need_crop']:
+        if ratio < 1:
+            # this means that data_width << data_height, we need to crop the
+            # data_height
+            min_y = int(torch.min(gt_boxes[:,1]))
+            max_y = int(torch.max(gt_boxes[:,3]))
+            trim_size = int(np.floor(data_width / ratio))
+            if trim_size > data_height:
+                trim_size = data_height                
+            box_region = max_y - min_y + 1
+            if min_y == 0:
+                y_s = 0
+            else:
+                if (box_region-trim_size) < 0:
+                    y_s_min = max(max_y-trim_size, 0)
+                    y_s_max = min(min_y, data_height-trim_size)
+                    if y_s_min == y_s_max:
+                        y_s = y_s_min
+                    else:
+                        y_s = np.random.choice(range(y_s_min, y_s_max))
                 else:
-                    if (box_region-trim_size) < 0:
-                        y_s_min = max(max_y-trim_size, 0)
-                        y_s_max = min(min_y, data_height-trim_size)
-                        if y_s_min == y_s_max:
-                            y_s = y_s_min
-                        else:
-                            y_s = np.random.choice(range(y_s_min, y_s_max))
+                    y_s_add = int((box_region-trim_size)/2)
+                    if y_s_add == 0:
+                        y_s = min_y
                     else:
-                        y_s_add = int((box_region-trim_size)/2)
-                        if y_s_add == 0:
-                            y_s = min_y
-                        else:
-                            y_s = np.random.choice(range(min_y, min_y+y_s_add))
-                # crop the image
-                data = data[:, y_s:(y_s + trim_size), :, :]
-
-                # shift y coordiante of gt_boxes
-                gt_boxes[:, 1] = gt_boxes[:, 1] - float(y_s)
-                gt_boxes[:, 3] = gt_boxes[:, 3] - float(y_s)
-
-                # update gt bounding box according the trip
-                gt_boxes[:, 1].clamp_(0, trim_size - 1)
-                gt_boxes[:, 3].clamp_(0, trim_size - 1)
+                        y_s = np.random.choice(range(min_y, min_y+y_s_add))
+            # crop the image
+            data = data[:, y_s:(y_s + trim_size), :, :]
 
+            # shift y coordiante of gt_boxes
+            gt_boxes[:, 1] = gt_boxes[:, 1] - float(y_s)
+            gt_boxes[:, 3] = gt_boxes[:, 3] - float(y_s)
+
+            # update gt bounding box according the trip
+            gt_boxes[:, 1].clamp_(0, trim_size - 1)
+            gt_boxes[:, 3].clamp_(0, trim_size - 1)
+
+        else:
+            # this means that data_width >> data_height, we need to crop the
+            # data_width
+            min_x = int(torch.min(gt_boxes[:,0]))
+            max_x = int(torch.max(gt_boxes[:,2]))
+            trim_size = int(np.ceil(data_height * ratio))
+            if trim_size > data_width:
+                trim_size = data_width                
+            box_region = max_x - min_x + 1
+            if min_x == 0:
+                x_s = 0
             else:
-                # this means that data_width >> data_height, we need to crop the
-                # data_width
-                min_x = int(torch.min(gt_boxes[:,0]))
-                max_x = int(torch.max(gt_boxes[:,2]))
-                trim_size = int(np.ceil(data_height * ratio))
-                if trim_size > data_width:
-                    trim_size = data_width                
-                box_region = max_x - min_x + 1
-                if min_x == 0:
-                    x_s = 0
+                if (box_region-trim_size) < 0:
+                    x_s_min = max(max_x-trim_size, 0)
+                    x_s_max = min(min_x, data_width-trim_size)
+                    if x_s_min == x_s_max:
+                        x_s = x_s_min
+                    else:
+                        x_s = np.random.choice(range(x_s_min, x_s_max))
                 else:
-                    if (box_region-trim_size) < 0:
-                        x_s_min = max(max_x-trim_size, 0)
-                        x_s_max = min(min_x, data_width-trim_size)
-                        if x_s_min == x_s_max:
-                            x_s = x_s_min
-                        else:
-                            x_s = np.random.choice(range(x_s_min, x_s_max))
+                    x_s_add = int((box_region-trim_size)/2)
+                    if x_s_add == 0:
+                        x_s = min_x
                     else:
-                        x_s_add = int((box_region-trim_size)/2)
-                        if x_s_add == 0:
-                            x_s = min_x
-                        else:
-                            x_s = np.random.choice(range(min_x, min_x+x_s_add))
-                # crop the image
-                data = data[:, :, x_s:(x_s + trim_size), :]
-
-                # shift x coordiante of gt_boxes
-                gt_boxes[:, 0] = gt_boxes[:, 0] - float(x_s)
-                gt_boxes[:, 2] = gt_boxes[:, 2] - float(x_s)
-                # update gt bounding box according the trip
-                gt_boxes[:, 0].clamp_(0, trim_size - 1)
-                gt_boxes[:, 2].clamp_(0, trim_size - 1)
-
-        # based on the ratio, padding the image.
-        if ratio < 1:
-            # this means that data_width < data_height
-            trim_size = int(np.floor(data_width / ratio))
+                        x_s = np.random.choice(range(min_x, min_x+x_s_add))
+            # crop the image
+            data = data[:, :, x_s:(x_s + trim_size), :]
 
-            padding_data = torch.FloatTensor(int(np.ceil(data_width / ratio)), \
-                                             data_width, 3).zero_()
-
-            padding_data[:data_height, :, :] = data[0]
-            # update im_info
-            im_info[0, 0] = padding_data.size(0)
-            # print("height %d %d \n" %(index, anchor_idx))
-        elif ratio > 1:
-            # this means that data_width > data_height
-            # if the image need to crop.
-            padding_data = torch.FloatTensor(data_height, \
-                                             int(np.ceil(data_height * ratio)), 3).zero_()
-            padding_data[:, :data_width, :] = data[0]
-            im_info[0, 1] = padding_data.size(1)
-        else:
-            trim_size = min(data_height, data_width)
-            padding_data = torch.FloatTensor(trim_size, trim_size, 3).zero_()
-            padding_data = data[0][:trim_size, :trim_size, :]
-            # gt_boxes.clamp_(0, trim_size)
-            gt_boxes[:, :4].clamp_(0, trim_size)
-            im_info[0, 0] = trim_size
-            im_info[0, 1] = trim_size
+            # shift x coordiante of gt_boxes
+            gt_boxes[:, 0] = gt_boxes[:, 0] - float(x_s)
+            gt_boxes[:, 2] = gt_boxes[:, 2] - float(x_s)
+            # update gt bounding box according the trip
+            gt_boxes[:, 0].clamp_(0, trim_size - 1)
+            gt_boxes[:, 2].clamp_(0, trim_size - 1)
 
+    data = data[0]
+    # based on the ratio, padding the image.
+    if ratio < 1:
+        # this means that data_width < data_height
+        pad_size = (int(np.ceil(data_width / ratio)), data_width)
+        # update im_info
+        im_info[0, 0] = pad_size[0]
+    elif ratio > 1:
+        # this means that data_width > data_height
+        # if the image need to crop.
+        pad_size = (data_height, int(np.ceil(data_height * ratio)))
+        im_info[0, 1] = pad_size[1]
+    else:
+        trim_size = min(data_height, data_width)
+        data = data[:trim_size, :trim_size, :]
+        # gt_boxes.clamp_(0, trim_size)
+        gt_boxes[:, :4].clamp_(0, trim_size)
+        im_info[0, 0] = trim_size
+        im_info[0, 1] = trim_size
+        pad_size = (trim_size, trim_size)
 
-        # check the bounding box:
-        not_keep = (gt_boxes[:,0] == gt_boxes[:,2]) | (gt_boxes[:,1] == gt_boxes[:,3])
-        keep = torch.nonzero(not_keep == 0).view(-1)
+    return data, im_info.view(3), gt_boxes, pad_size
 
-        gt_boxes_padding = torch.FloatTensor(self.max_num_box, gt_boxes.size(1)).zero_()
-        if keep.numel() != 0:
-            gt_boxes = gt_boxes[keep]
-            num_boxes = min(gt_boxes.size(0), self.max_num_box)
-            gt_boxes_padding[:num_boxes,:] = gt_boxes[:num_boxes]
+  def _fill_gt_boxes(self, gt_boxes, gt_boxes_padding):
+    """Writes the valid gt boxes into the zeroed max_num_box x 5 gt_boxes_padding, returns their number."""
+    # check the bounding box:
+    not_keep = (gt_boxes[:,0] == gt_boxes[:,2]) | (gt_boxes[:,1] == gt_boxes[:,3])
+    keep = torch.nonzero(not_keep == 0).view(-1)
+
+    if keep.numel() != 0:
+        gt_boxes = gt_boxes[keep]
+        num_boxes = min(gt_boxes.size(0), self.max_num_box)
+        gt_boxes_padding[:num_boxes,:] = gt_boxes[:num_boxes]
+    else:
+        num_boxes = 0
+    return num_boxes
+
+  def __getitem__(self, index):
+    if self.training:
+        data, im_info, gt_boxes, (pad_height, pad_width) = self._prepare_train(index)
+
+        if cfg.INPUT_UINT8:
+            # H x W x 3 uint8, padded with the mean pixel; the model casts and transposes it on the device
+            padding_data = torch.ByteTensor(pad_height, pad_width, 3)
+            padding_data[:] = torch.from_numpy(mean_pixel(cfg.PIXEL_MEANS))
         else:
-            num_boxes = 0
+            padding_data = torch.FloatTensor(pad_height, pad_width, 3).zero_()
+        padding_data[:data.size(0), :data.size(1), :] = data
 
+        gt_boxes_padding = torch.FloatTensor(self.max_num_box, gt_boxes.size(1)).zero_()
+        num_boxes = self._fill_gt_boxes(gt_boxes, gt_boxes_padding)
+
+        if not cfg.INPUT_UINT8:
             # permute trim_data to adapt to downstream processing
-        padding_data = padding_data.permute(2, 0, 1).contiguous()
-        im_info = im_info.view(3)
+            padding_data = padding_data.permute(2, 0, 1).contiguous()
 
         return padding_data, im_info, gt_boxes_padding, num_boxes
     else:
-        data = data.permute(0, 3, 1, 2).contiguous().view(3, data_height, data_width)
+        minibatch_db = [self._roidb[index]]
+        blobs = get_minibatch(minibatch_db, self._num_classes)
+        data = torch.from_numpy(blobs['data'])
+        im_info = torch.from_numpy(blobs['im_info'])
+        data_height, data_width = data.size(1), data.size(2)
+
+        if cfg.INPUT_UINT8:
+            data = data.view(data_height, data_width, 3)
+        else:
+            data = data.permute(0, 3, 1, 2).contiguous().view(3, data_height, data_width)
         im_info = im_info.view(3)
 
         gt_boxes = torch.FloatTensor([1,1,1,1,1])
@@ -212,5 +250,76 @@ class roibatchLoader(data.Dataset):
 
         return data, im_info, gt_boxes, num_boxes
 
+  def _thread_pool(self):
+    # created lazily in every DataLoader worker, a pool does not survive a fork
+    if self._pool_pid != os.getpid():
+        self._pool = ThreadPool(self.num_threads) if self.num_threads > 1 else None
+        self._pool_pid = os.getpid()
+    return self._pool
+
+  def load_batch(self, indices):
+    """Collates the training images at indices (a group of ratio_index) into one minibatch.
+
+    The images are loaded on num_threads threads and copied straight into a single blob of the
+    largest padded size of the group, which is only zeroed where an image does not cover it. Returns
+    the im_data (B x 3 x H x W), im_info (B x 3), gt_boxes (B x max_num_box x 5) and num_boxes (B)
+    that the DataLoader would stack from __getitem__. With cfg.INPUT_UINT8, im_data is B x H x W x 3
+    uint8 padded with the mean pixel.
+    """
+    pool = self._thread_pool()
+    items = pool.map(self._prepare_train, indices) if pool is not None else \
+        [self._prepare_train(index) for index in indices]
+    batch_size = len(items)
+    height = max(pad_size[0] for _, _, _, pad_size in items)
+    width = max(pad_size[1] for _, _, _, pad_size in items)
+
+    im_info = torch.FloatTensor(batch_size, 3)
+    gt_boxes = torch.FloatTensor(batch_size, self.max_num_box, 5).zero_()
+    num_boxes = torch.LongTensor(batch_size)
+    if cfg.INPUT_UINT8:
+        im_data = torch.ByteTensor(batch_size, height, width, 3)
+        pad = torch.from_numpy(mean_pixel(cfg.PIXEL_MEANS))
+    else:
+        im_data = torch.FloatTensor(batch_size, 3, height, width)
+    for b, (data, info, boxes, _) in enumerate(items):
+        data_height, data_width = data.size(0), data.size(1)
+        if cfg.INPUT_UINT8:
+            im_data[b, :data_height, :data_width].copy_(data)
+            im_data[b, data_height:] = pad
+            im_data[b, :data_height, data_width:] = pad
+        else:
+            im_data[b, :, :data_height, :data_width].copy_(data.permute(2, 0, 1))
+            im_data[b, :, data_height:, :].zero_()
+            im_data[b, :, :data_height, data_width:].zero_()
+        im_info[b] = info
+        num_boxes[b] = self._fill_gt_boxes(boxes, gt_boxes[b])
+    return im_data, im_info, gt_boxes, num_boxes
+
   def __len__(self):
     return len(self._roidb)
+
+
+class roibatchGroupLoader(data.Dataset):
+  """Whole minibatches of a roibatchLoader: item i is the i-th group of batch_size consecutive
+  entries of ratio_index, collated by roibatchLoader.load_batch().
+
+  Use it with a DataLoader of batch_size=1 and collate_fn=unwrap_batch. With a BucketBatchSampler as
+  the DataLoader's sampler, the items are the batches of keys it yields instead.
+  """
+  def __init__(self, dataset):
+    self.dataset = dataset
+    self.batch_size = dataset.batch_size
+
+  def __getitem__(self, index):
+    if isinstance(index, list):
+      return self.dataset.load_batch(index)
+    start = index * self.batch_size
+    return self.dataset.load_batch(range(start, min(start + self.batch_size, self.dataset.data_size)))
+
+  def __len__(self):
+    return int(np.ceil(self.dataset.data_size / float(self.batch_size)))
+
+
+def unwrap_batch(items):
+  """collate_fn for roibatchGroupLoader, whose items are already minibatches."""
+  return items[0]
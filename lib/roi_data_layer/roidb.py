@@ -9,6 +9,7 @@ from datasets.factory import get_imdb
 import PIL
 import pdb
 from model.utils.config import cfg
+from roi_data_layer.columnar_roidb import ColumnarRoidb
 
 
 def prepare_roidb(imdb):
@@ -21,9 +22,8 @@ def prepare_roidb(imdb):
 
   roidb = imdb.roidb
   if not (imdb.name.startswith('coco')):
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-         for i in range(imdb.num_images)]
-         
+    sizes = imdb.image_sizes()
+
   for i in range(len(imdb.image_index)):
     roidb[i]['img_id'] = imdb.image_id_at(i)
     roidb[i]['image'] = imdb.image_path_at(i)
@@ -77,12 +77,8 @@ def rank_roidb_ratio(roidb):
 def filter_roidb(roidb):
     # filter the image without bounding box.
     print('before filtering, there are %d images...' % (len(roidb)))
-    i = 0
-    while i < len(roidb):
-      if len(roidb[i]['boxes']) == 0:
-        del roidb[i]
-        i -= 1
-      i += 1
+    keep = np.array([len(entry['boxes']) > 0 for entry in roidb], dtype=bool)
+    roidb[:] = [roidb[i] for i in np.flatnonzero(keep)]
 
     print('after filtering, there are %d images...' % (len(roidb)))
     return roidb
@@ -131,4 +127,10 @@ def combined_roidb(imdb_names, training=True):
 
   ratio_list, ratio_index = rank_roidb_ratio(roidb)
 
+  if training and cfg.TRAIN.COLUMNAR_ROIDB:
+    # the list is dropped here, the DataLoader workers only see the flat arrays
+    roidb = ColumnarRoidb(roidb).share_memory()
+    print('columnar roidb: {:d} images, {:d} boxes, {:.1f} MB'.format(
+      len(roidb), len(roidb.boxes), roidb.nbytes / 2. ** 20))
+
   return imdb, roidb, ratio_list, ratio_index
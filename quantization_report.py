@@ -0,0 +1,56 @@
+"""Compares the test_net.py --report lines of quantized (or --precision) runs with the float32 run of the same
+dataset and net.
+
+Example:
+    python test_net.py --dataset clevr --net res101 --report quant.jsonl
+    python test_net.py --dataset clevr --net res101 --quantize dynamic --report quant.jsonl
+    python test_net.py --dataset clevr --net res101 --quantize static --quantize_stages base,top --report quant.jsonl
+    python test_net.py --dataset clevr --net res101 --cuda --precision float16 --report quant.jsonl
+    python test_net.py --dataset clevr --net res101 --test_workers 4 --report quant.jsonl
+    python quantization_report.py quant.jsonl
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Summarize the accuracy/throughput of quantized test runs')
+    parser.add_argument('report', help='JSON lines written by test_net.py --report')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.report) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+
+    # the latest float run of every (dataset, net, device) is the baseline
+    baselines = {}
+    for run in runs:
+        if run['quantize'] == 'none' and run.get('precision', 'float32') == 'float32' and \
+                not run.get('test_workers'):
+            baselines[(run['dataset'], run['net'], run['device'])] = run
+
+    print('{:<12} {:<8} {:<16} {:>8} {:>9} {:>9} {:>8} {:>9} {:>9}'.format(
+        'dataset', 'net', 'quantize', 'mAP', 'delta', 'images/s', 'speedup', 'weights', 'e2e/s'))
+    for run in runs:
+        base = baselines.get((run['dataset'], run['net'], run['device']))
+        mode = run['quantize'] + ('(' + run['quantize_stages'] + ')' if run['quantize_stages'] else '')
+        if run.get('precision', 'float32') != 'float32':
+            mode = run['precision']
+        if run.get('test_workers'):
+            mode += '+{}w'.format(run['test_workers'])
+        delta = speedup = ''
+        if base is not None and run['mAP'] is not None and base['mAP'] is not None:
+            delta = '{:+.4f}'.format(run['mAP'] - base['mAP'])
+        if base is not None:
+            speedup = '{:.2f}x'.format(run['images_per_sec'] / base['images_per_sec'])
+        end_to_end = run.get('end_to_end_images_per_sec')
+        print('{:<12} {:<8} {:<16} {:>8} {:>9} {:>9.2f} {:>8} {:>7.1f}MB {:>9}'.format(
+            run['dataset'], run['net'], mode, '-' if run['mAP'] is None else '{:.4f}'.format(run['mAP']),
+            delta, run['images_per_sec'], speedup, run['model_mb'],
+            '-' if end_to_end is None else '{:.2f}'.format(end_to_end)))
@@ -18,16 +18,21 @@ import time
 import cv2
 import torch
 from torch.autograd import Variable
+from torch.utils.data.dataloader import default_collate
 import torch.nn as nn
 import torch.optim as optim
 import pickle
+import json
 from roi_data_layer.roidb import combined_roidb
 from roi_data_layer.roibatchLoader import roibatchLoader
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
-from model.rpn.bbox_transform import clip_boxes
-from model.nms.nms_wrapper import nms
-from model.rpn.bbox_transform import bbox_transform_inv
 from model.utils.net_utils import save_net, load_net, vis_detections
+from model.utils.device import inference_device, configure_threads, check_device_support, place_model
+from model.utils.postprocess import decode_boxes, detect, dets_per_class
+from model.utils.quantize import QUANTIZE_MODES, STATIC_STAGES, quantize_model, model_size_mb
+from model.utils.precision import PRECISIONS, PRECISION_STAGES, set_inference_precision
+from model.utils.telemetry import StageTimer, span
+from model.utils.pipeline import OrderedPrefetcher
 from model.faster_rcnn.vgg16 import vgg16
 from model.faster_rcnn.resnet import resnet
 
@@ -62,6 +67,34 @@ def parse_args():
     parser.add_argument('--cuda', dest='cuda',
                         help='whether use CUDA',
                         action='store_true')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='number of CPU threads used inside torch ops, 0 keeps the default')
+    parser.add_argument('--interop_threads', default=0, type=int,
+                        help='number of threads running independent torch ops in parallel, 0 keeps the default')
+    parser.add_argument('--quantize', default='none', choices=QUANTIZE_MODES,
+                        help='int8 CPU inference: dynamic quantizes the linear layers, static also the '
+                             '--quantize_stages convolutions')
+    parser.add_argument('--quantize_stages', default='base',
+                        help='comma separated stages for static quantization, some of {}'.format(
+                            ','.join(sorted(STATIC_STAGES))))
+    parser.add_argument('--calib_images', default=20, type=int,
+                        help='training images used to calibrate static quantization')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS,
+                        help='run --precision_stages in float16 (CUDA) or bfloat16; box decoding and NMS stay float32')
+    parser.add_argument('--precision_stages', default='base,head',
+                        help='comma separated stages run at --precision, of ' + ','.join(sorted(PRECISION_STAGES)))
+    parser.add_argument('--test_workers', default=0, type=int,
+                        help='threads decoding and resizing the test images ahead of the network, in image order; '
+                             '0 loads every image on the main thread')
+    parser.add_argument('--prefetch', default=16, type=int,
+                        help='images decoded ahead of the network with --test_workers')
+    parser.add_argument('--report', default=None,
+                        help='append the mAP and throughput of this run as a JSON line to this file')
+    parser.add_argument('--telemetry', default=None,
+                        help='time every stage and append p50/p95/p99 latencies as JSON lines to this file '
+                             '(- for stdout)')
+    parser.add_argument('--telemetry_interval', default=30., type=float,
+                        help='seconds between two --telemetry lines')
     parser.add_argument('--ls', dest='large_scale',
                         help='whether use large imag scale',
                         action='store_true')
@@ -95,6 +128,22 @@ lr = cfg.TRAIN.LEARNING_RATE
 momentum = cfg.TRAIN.MOMENTUM
 weight_decay = cfg.TRAIN.WEIGHT_DECAY
 
+def calibrate_model(model, args, num_classes, holders):
+    """Runs the model on args.calib_images images spread over the training split."""
+    im_data, im_info, gt_boxes, num_boxes = holders
+    _, roidb, ratio_list, ratio_index = combined_roidb(args.imdb_name, False)
+    dataset = roibatchLoader(roidb, ratio_list, ratio_index, 1, num_classes, training=False, normalize=False)
+    calib_ixs = np.linspace(0, len(dataset) - 1, min(args.calib_images, len(dataset))).astype(int).tolist()
+    loader = torch.utils.data.DataLoader(dataset, batch_size=1, sampler=calib_ixs, num_workers=0)
+    for data in loader:
+        im_data.data.resize_(data[0].size()).copy_(data[0])
+        im_info.data.resize_(data[1].size()).copy_(data[1])
+        gt_boxes.data.resize_(data[2].size()).copy_(data[2])
+        num_boxes.data.resize_(data[3].size()).copy_(data[3])
+        model(im_data, im_info, gt_boxes, num_boxes)
+    print('Calibrated on {} images of {}'.format(len(calib_ixs), args.imdb_name))
+
+
 if __name__ == '__main__':
 
     args = parse_args()
@@ -104,6 +153,8 @@ if __name__ == '__main__':
 
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = inference_device(args.cuda)
+    configure_threads(args.num_threads, args.interop_threads)
 
     np.random.seed(cfg.RNG_SEED)
     if args.dataset == "pascal_voc":
@@ -169,24 +220,23 @@ if __name__ == '__main__':
     fasterRCNN.create_architecture()
 
     print("load checkpoint %s" % (load_name))
-    checkpoint = torch.load(load_name)
+    checkpoint = torch.load(load_name, map_location=(lambda storage, loc: storage))
     fasterRCNN.load_state_dict(checkpoint['model'])
     if 'pooling_mode' in checkpoint.keys():
         cfg.POOLING_MODE = checkpoint['pooling_mode']
 
     print('load model successfully!')
     # initilize the tensor holder here.
-    im_data = torch.FloatTensor(1)
+    im_data = torch.ByteTensor(1) if cfg.INPUT_UINT8 else torch.FloatTensor(1)
     im_info = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
 
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the inference device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data, volatile=True)
@@ -194,11 +244,26 @@ if __name__ == '__main__':
     num_boxes = Variable(num_boxes, volatile=True)
     gt_boxes = Variable(gt_boxes, volatile=True)
 
-    if args.cuda:
-        cfg.CUDA = True
-
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN = place_model(fasterRCNN, device)
+    check_device_support(device, 1)
+
+    model_mb = model_size_mb(fasterRCNN)
+    if args.quantize != 'none':
+        fasterRCNN.eval()
+        fasterRCNN = quantize_model(fasterRCNN, args.quantize, device, args.quantize_stages.split(','),
+                                    calibrate=lambda model: calibrate_model(model, args, imdb.num_classes,
+                                                                            (im_data, im_info, gt_boxes, num_boxes)),
+                                    example_input=torch.zeros(1, 3, cfg.TEST.SCALES[0], cfg.TEST.MAX_SIZE))
+        print('{} int8 quantization: weights {:.1f} MB -> {:.1f} MB'.format(
+            args.quantize, model_mb, model_size_mb(fasterRCNN)))
+        model_mb = model_size_mb(fasterRCNN)
+    if args.precision != 'float32':
+        if args.quantize != 'none':
+            raise ValueError('--precision and --quantize cannot be combined')
+        fasterRCNN = set_inference_precision(fasterRCNN, args.precision, device, args.precision_stages.split(','))
+        print('{} {}: weights {:.1f} MB -> {:.1f} MB'.format(
+            args.precision_stages, args.precision, model_mb, model_size_mb(fasterRCNN)))
+        model_mb = model_size_mb(fasterRCNN)
 
     start = time.time()
     max_per_image = 100
@@ -222,24 +287,39 @@ if __name__ == '__main__':
     output_dir = get_output_dir(imdb, save_name)
     dataset = roibatchLoader(roidb, ratio_list, ratio_index, 1, \
                              imdb.num_classes, training=False, normalize=False)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=1,
-                                             shuffle=False, num_workers=0,
-                                             pin_memory=True)
-
-    data_iter = iter(dataloader)
+    prefetcher = None
+    if args.test_workers > 0:
+        # the results are stored by image index, so the images are handed over strictly in order
+        prefetcher = OrderedPrefetcher(lambda i: default_collate([dataset[i]]), range(num_images),
+                                       num_workers=args.test_workers, max_pending=args.prefetch)
+        data_iter = iter(prefetcher)
+    else:
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=1,
+                                                 shuffle=False, num_workers=0,
+                                                 pin_memory=True)
+        data_iter = iter(dataloader)
 
     _t = {'im_detect': time.time(), 'misc': time.time()}
     det_file = os.path.join(output_dir, 'detections.pkl')
 
     fasterRCNN.eval()
     empty_array = np.transpose(np.array([[], [], [], [], []]), (1, 0))
+    total_detect_time = total_nms_time = 0.
+    timer = None
+    if args.telemetry is not None:
+        # the loader decodes and resizes on this thread or on the --test_workers threads, those stages are
+        # timed as well
+        timer = StageTimer(None if args.telemetry == '-' else args.telemetry, args.telemetry_interval,
+                           sync_cuda=device.type == 'cuda').install()
+    loop_tic = time.time()
     for i in range(num_images):
 
         data = next(data_iter)
-        im_data.data.resize_(data[0].size()).copy_(data[0])
-        im_info.data.resize_(data[1].size()).copy_(data[1])
-        gt_boxes.data.resize_(data[2].size()).copy_(data[2])
-        num_boxes.data.resize_(data[3].size()).copy_(data[3])
+        with span('h2d'):
+            im_data.data.resize_(data[0].size()).copy_(data[0])
+            im_info.data.resize_(data[1].size()).copy_(data[1])
+            gt_boxes.data.resize_(data[2].size()).copy_(data[2])
+            num_boxes.data.resize_(data[3].size()).copy_(data[3])
 
         det_tic = time.time()
         rois, cls_prob, bbox_pred, \
@@ -248,29 +328,9 @@ if __name__ == '__main__':
         rois_label = fasterRCNN(im_data, im_info, gt_boxes, num_boxes)
 
         scores = cls_prob.data
-        boxes = rois.data[:, :, 1:5]
-
-        if cfg.TEST.BBOX_REG:
-            # Apply bounding-box regression deltas
-            box_deltas = bbox_pred.data
-            if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
-                # Optionally normalize targets by a precomputed mean and stdev
-                if args.class_agnostic:
-                    box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                 + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    box_deltas = box_deltas.view(1, -1, 4)
-                else:
-                    box_deltas = box_deltas.view(-1, 4) * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda() \
-                                 + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    box_deltas = box_deltas.view(1, -1, 4 * len(imdb.classes))
-
-            pred_boxes = bbox_transform_inv(boxes, box_deltas, 1)
-            pred_boxes = clip_boxes(pred_boxes, im_info.data, 1)
-        else:
-            # Simply repeat the boxes, once for each class
-            pred_boxes = np.tile(boxes, (1, scores.shape[1]))
-
-        pred_boxes /= data[1][0][2]
+        with span('postprocess'):
+            pred_boxes = decode_boxes(rois.data, bbox_pred.data, im_info.data, [data[1][0][2]], imdb.num_classes,
+                                      args.class_agnostic)
 
         scores = scores.squeeze()
         pred_boxes = pred_boxes.squeeze()
@@ -280,43 +340,26 @@ if __name__ == '__main__':
         if vis:
             im = cv2.imread(imdb.image_path_at(i))
             im2show = np.copy(im)
-        for j in xrange(1, imdb.num_classes):
-            inds = torch.nonzero(scores[:, j] > thresh).view(-1)
-            # if there is det
-            if inds.numel() > 0:
-                cls_scores = scores[:, j][inds]
-                _, order = torch.sort(cls_scores, 0, True)
-                if args.class_agnostic:
-                    cls_boxes = pred_boxes[inds, :]
-                else:
-                    cls_boxes = pred_boxes[inds][:, j * 4:(j + 1) * 4]
-
-                cls_dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)
-                # cls_dets = torch.cat((cls_boxes, cls_scores), 1)
-                cls_dets = cls_dets[order]
-                keep = nms(cls_dets, cfg.TEST.NMS)
-                cls_dets = cls_dets[keep.view(-1).long()]
-                if vis:
-                    im2show = vis_detections(im2show, imdb.classes[j], cls_dets.cpu().numpy(), 0.3)
-                all_boxes[j][i] = cls_dets.cpu().numpy()
-            else:
-                all_boxes[j][i] = empty_array
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
+        # per-class NMS and the max_per_image limit *over all classes*
+        with span('postprocess'):
+            dets, class_ixs = detect(scores, pred_boxes, thresh, max_per_image)
+        for j, cls_dets in enumerate(dets_per_class(dets, class_ixs, imdb.num_classes)):
+            if j == 0:
+                continue
+            all_boxes[j][i] = cls_dets if len(cls_dets) > 0 else empty_array
+            if vis and len(cls_dets) > 0:
+                im2show = vis_detections(im2show, imdb.classes[j], cls_dets, 0.3)
 
         misc_toc = time.time()
         nms_time = misc_toc - misc_tic
+        total_detect_time += detect_time
+        total_nms_time += nms_time
 
-        print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s   \r' \
-                         .format(i + 1, num_images, detect_time, nms_time))
+        if timer is not None:
+            timer.tick()
+        else:
+            print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s   \r' \
+                             .format(i + 1, num_images, detect_time, nms_time))
         # sys.stdout.flush()
 
         if vis:
@@ -325,11 +368,35 @@ if __name__ == '__main__':
             # cv2.imshow('test', im2show)
             # cv2.waitKey(0)
 
+    # from the first decoded image to the last detection, including the time the network waited for images
+    loop_time = time.time() - loop_tic
+    if prefetcher is not None:
+        prefetcher.close()
+        print(prefetcher.summary())
+
     with open(det_file, 'wb') as f:
         pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
 
+    if timer is not None:
+        timer.close()
+        print(timer.summary())
+
     print('Evaluating detections')
-    imdb.evaluate_detections(all_boxes, output_dir)
+    mean_ap = imdb.evaluate_detections(all_boxes, output_dir)
 
     end = time.time()
     print("test time: %0.4fs" % (end - start))
+    images_per_sec = num_images / (total_detect_time + total_nms_time)
+    print('{:.2f} images/s ({:.1f} ms detect, {:.1f} ms nms per image)'.format(
+        images_per_sec, 1000 * total_detect_time / num_images, 1000 * total_nms_time / num_images))
+    print('end to end: {:.2f} images/s with {} loader threads'.format(num_images / loop_time, args.test_workers))
+    if args.report is not None:
+        with open(args.report, 'a') as f:
+            f.write(json.dumps({'dataset': args.dataset, 'net': args.net, 'device': str(device),
+                                'threads': torch.get_num_threads(), 'quantize': args.quantize,
+                                'quantize_stages': args.quantize_stages if args.quantize == 'static' else '',
+                                'precision': args.precision,
+                                'num_images': num_images, 'mAP': None if mean_ap is None else float(mean_ap),
+                                'images_per_sec': images_per_sec, 'model_mb': model_mb,
+                                'test_workers': args.test_workers,
+                                'end_to_end_images_per_sec': num_images / loop_time}) + '\n')
@@ -25,7 +25,8 @@ import torchvision.transforms as transforms
 from torch.utils.data.sampler import Sampler
 
 from roi_data_layer.roidb import combined_roidb
-from roi_data_layer.roibatchLoader import roibatchLoader
+from roi_data_layer.roibatchLoader import roibatchLoader, roibatchGroupLoader, unwrap_batch
+from roi_data_layer.bucket_sampler import BucketBatchSampler, compare_samplers
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from model.utils.net_utils import weights_normal_init, save_net, load_net, \
     adjust_learning_rate, save_checkpoint, clip_gradient
@@ -79,6 +80,16 @@ def parse_args():
     parser.add_argument('--cag', dest='class_agnostic',
                         help='whether perform class_agnostic bbox regression',
                         action='store_true')
+    parser.add_argument('--group_batches', action='store_true',
+                        help='collate every minibatch at once from its aspect ratio group into a single blob')
+    parser.add_argument('--batch_threads', default=4, type=int,
+                        help='threads loading the images of a minibatch with --group_batches')
+    parser.add_argument('--bucket_scales', action='store_true',
+                        help='batch images of one training scale and similar aspect ratios (TRAIN.SCALES)')
+    parser.add_argument('--image_cache', default=None,
+                        help='read the images pre-resized by build_image_cache.py from this directory')
+    parser.add_argument('--columnar_roidb', action='store_true',
+                        help='keep the roidb in flat shared-memory arrays shared by the DataLoader workers')
 
     # config optimization
     parser.add_argument('--o', dest='optimizer',
@@ -193,6 +204,10 @@ if __name__ == '__main__':
         cfg_from_file(args.cfg_file)
     if args.set_cfgs is not None:
         cfg_from_list(args.set_cfgs)
+    if args.image_cache is not None:
+        cfg.TRAIN.IMAGE_CACHE = args.image_cache
+    if args.columnar_roidb:
+        cfg.TRAIN.COLUMNAR_ROIDB = True
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -218,13 +233,36 @@ if __name__ == '__main__':
     sampler_batch = sampler(train_size, args.batch_size)
 
     dataset = roibatchLoader(roidb, ratio_list, ratio_index, args.batch_size, \
-                             imdb.num_classes, training=True)
-
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
-                                             sampler=sampler_batch, num_workers=args.num_workers)
+                             imdb.num_classes, training=True, num_threads=args.batch_threads)
+
+    if args.bucket_scales:
+        sizes = [(roidb[i]['height'], roidb[i]['width']) for i in ratio_index]
+        padding = compare_samplers(ratio_list, sizes, args.batch_size, cfg.TRAIN.SCALES)
+        for name in ('sampler', 'bucket'):
+            blob_pixels, image_pixels = padding[name]
+            print('{:<8} padded pixels per epoch: {:.1f} M ({:.1%} of the image pixels)'.format(
+                name, (blob_pixels - image_pixels) / 1e6, (blob_pixels - image_pixels) / float(image_pixels)))
+        bucket_sampler = BucketBatchSampler(ratio_list, args.batch_size, len(cfg.TRAIN.SCALES))
+
+    if args.group_batches:
+        # the groups are shuffled like sampler_batch shuffles the batches of consecutive indices
+        if args.bucket_scales:
+            dataloader = torch.utils.data.DataLoader(roibatchGroupLoader(dataset), batch_size=1,
+                                                     sampler=bucket_sampler, collate_fn=unwrap_batch,
+                                                     num_workers=args.num_workers)
+        else:
+            dataloader = torch.utils.data.DataLoader(roibatchGroupLoader(dataset), batch_size=1, shuffle=True,
+                                                     collate_fn=unwrap_batch, num_workers=args.num_workers)
+    elif args.bucket_scales:
+        # every image of a batch has the same padded size, so the default collate can stack them
+        dataloader = torch.utils.data.DataLoader(dataset, batch_sampler=bucket_sampler,
+                                                 num_workers=args.num_workers)
+    else:
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
+                                                 sampler=sampler_batch, num_workers=args.num_workers)
 
     # initilize the tensor holder here.
-    im_data = torch.FloatTensor(1)
+    im_data = torch.ByteTensor(1) if cfg.INPUT_UINT8 else torch.FloatTensor(1)
     im_info = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)